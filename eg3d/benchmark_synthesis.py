@@ -0,0 +1,88 @@
+""" Steady-state step time of eager and compiled G.synthesis. """
+from time import perf_counter
+
+import click
+import numpy as np
+import torch
+
+from camera_utils import LookAtPoseSampler, FOV_to_intrinsics
+from inversion.compiled import CompiledSynthesis
+from inversion.resident import load_network_data
+from inversion.utils import reload_modules
+
+
+def time_steps(synthesis, ws, c, *, num_warmup, num_steps, backward, device):
+    # Seconds of the first call (which captures and compiles) and of every steady-state step after the warmup.
+    def step():
+        synth_image = synthesis(ws, c=c, noise_mode='const')['image']
+        if backward:
+            synth_image.square().mean().backward()
+            ws.grad = None
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+
+    start_time = perf_counter()
+    step()
+    first_step = perf_counter() - start_time
+    for _ in range(num_warmup):
+        step()
+    step_times = []
+    for _ in range(num_steps):
+        start_time = perf_counter()
+        step()
+        step_times.append(perf_counter() - start_time)
+    return first_step, np.array(step_times)
+
+
+@click.command()
+@click.option('--network', 'network_pkl', help='Network pickle filename', required=True)
+@click.option('--device', 'device_name', help='Device to benchmark on', default='cpu', show_default=True)
+@click.option('--batch-size', help='Number of views rendered per step', type=int, default=1, show_default=True)
+@click.option('--num-steps', help='Number of timed steps', type=int, default=20, show_default=True)
+@click.option('--num-warmup', help='Number of untimed steps after the first', type=int, default=3, show_default=True)
+@click.option('--backward', help='Backpropagate to the latent like W inversion', type=bool, default=True,
+              show_default=True)
+@click.option('--mode', help='torch.compile mode', type=click.Choice(['default', 'reduce-overhead', 'max-autotune']),
+              default='default', show_default=True)
+@click.option('--seed', help='Random seed', type=int, default=0, show_default=True)
+def benchmark(
+        network_pkl: str,
+        device_name: str,
+        batch_size: int,
+        num_steps: int,
+        num_warmup: int,
+        backward: bool,
+        mode: str,
+        seed: int
+):
+    device = torch.device(device_name)
+    G = reload_modules(load_network_data(network_pkl)['G_ema']).eval().requires_grad_(False).to(device)
+    G.rendering_kwargs["ray_start"] = 2.35
+
+    cam2world_pose = LookAtPoseSampler.sample(np.pi / 2, np.pi / 2, torch.tensor([0, 0, 0.2], device=device),
+                                              radius=2.7, device=device)
+    intrinsics = FOV_to_intrinsics(18.837, device=device)
+    c = torch.cat([cam2world_pose.reshape(-1, 16), intrinsics.reshape(-1, 9)], 1).repeat(batch_size, 1)
+    z = torch.from_numpy(np.random.RandomState(seed).randn(batch_size, G.z_dim)).float().to(device)
+    with torch.no_grad():
+        ws = G.mapping(z, c, truncation_psi=0.7)
+    ws.requires_grad_(backward)
+
+    compiled = CompiledSynthesis(G, enabled=True, mode=None if mode == 'default' else mode)
+    paths = [("eager", G.synthesis), ("compiled", compiled)]
+    results = {}
+    for name, synthesis in paths:
+        first_step, step_times = time_steps(synthesis, ws, c, num_warmup=num_warmup, num_steps=num_steps,
+                                            backward=backward, device=device)
+        if name == "compiled" and compiled.compiled is None:
+            name = "compiled (fell back to eager)"
+        results[name] = step_times
+        print(f"{name:<30} first step {first_step * 1000:9.1f} ms   "
+              f"steady state median {np.median(step_times) * 1000:9.1f} ms, "
+              f"mean {np.mean(step_times) * 1000:9.1f} ms +- {np.std(step_times) * 1000:.1f}")
+    eager_median, compiled_median = [np.median(step_times) for step_times in results.values()]
+    print(f"speedup {eager_median / compiled_median:.2f}x")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -12,6 +12,7 @@ import legacy
 from inversion.image_selection import select_evenly
 from inversion.load_data import load
 from inversion.metrics import Metrics
+from inversion.poses import PoseTable
 from inversion.utils import interpolate_w_by_cam
 
 
@@ -74,7 +75,7 @@ def run(
             img = images[i]
             if "ws" in checkpoint.keys():
                 ws = [torch.tensor(w_).to(device) for w_ in checkpoint['ws']]
-                cs = [torch.tensor(c_).to(device) for c_ in checkpoint['cs']]
+                cs = PoseTable.from_cams([torch.tensor(c_).to(device) for c_ in checkpoint['cs']])
                 w = torch.tensor(interpolate_w_by_cam(ws, cs, img.c_item.c, device=device)).to(device)
             else:
                 w = torch.tensor(checkpoint["w"]).to(device)
@@ -12,6 +12,7 @@ import legacy
 from camera_utils import LookAtPoseSampler, LookAtPoseSamplerCustom
 from inversion.image_selection import select_evenly
 from inversion.load_data import load
+from inversion.poses import PoseTable
 from inversion.utils import interpolate_w_by_cam
 
 def normalize(x):
@@ -58,8 +59,8 @@ def run(
     video = imageio.get_writer(f'{rundir}/rotate.mp4', mode='I', fps=30, codec='libx264', bitrate='16M')
     print(f'Saving optimization progress video "{rundir}/rotate.mp4"')
     start_index, end_index = select_evenly(images, 2)
-    start_angle = images[start_index].c_item.xz_angle()
-    end_angle = images[end_index].c_item.xz_angle()
+    table = PoseTable.from_images(images)
+    start_angle, end_angle = table.yaw[start_index], table.yaw[end_index]
     position = list(np.linspace(0, 0.9, 135).tolist())
 
     for mag in tqdm(position[::-1] + position):
@@ -70,7 +71,7 @@ def run(
 
         if "ws" in checkpoint.keys():
             ws = [torch.tensor(w_).to(device) for w_ in checkpoint['ws']]
-            cs = [torch.tensor(c_).to(device) for c_ in checkpoint['cs']]
+            cs = PoseTable.from_cams([torch.tensor(c_).to(device) for c_ in checkpoint['cs']])
             w = torch.tensor(interpolate_w_by_cam(ws, cs, c_samples, device=device)).to(device)
         else:
             w = torch.tensor(checkpoint["w"]).to(device)
@@ -0,0 +1,51 @@
+import warnings
+
+import torch
+
+
+def _compile_errors() -> tuple:
+    # Errors raised while torch.compile captures or compiles a graph.
+    try:
+        from torch._dynamo.exc import TorchDynamoException
+    except ImportError:
+        return ()
+    return (TorchDynamoException,)
+
+
+def _signature(args, kwargs) -> tuple:
+    # Shapes and dtypes of the tensor arguments; each distinct signature is captured on its first call.
+    values = list(args) + [kwargs[key] for key in sorted(kwargs)]
+    return tuple((tuple(value.shape), value.dtype) if isinstance(value, torch.Tensor) else None for value in values)
+
+
+class CompiledSynthesis:
+    """G.synthesis compiled with torch.compile for the repeated same-shape calls of an inversion loop.
+
+    Falls back to eager mode when torch.compile is unavailable or fails to capture or compile the first call of a
+    shape. Errors of later calls, e.g. running out of memory, are raised as in eager mode.
+    """
+
+    def __init__(self, G, enabled: bool = True, mode: str = None):
+        self.eager = G.synthesis
+        self.compiled = None
+        self._captured = set()
+        if enabled:
+            if hasattr(torch, "compile"):
+                self.compiled = torch.compile(G.synthesis, mode=mode, dynamic=False)
+            else:
+                warnings.warn("torch.compile needs PyTorch 2, running G.synthesis eagerly")
+
+    def __call__(self, *args, **kwargs):
+        if self.compiled is None:
+            return self.eager(*args, **kwargs)
+        signature = _signature(args, kwargs)
+        if signature in self._captured:
+            return self.compiled(*args, **kwargs)
+        try:
+            result = self.compiled(*args, **kwargs)
+        except _compile_errors() as e:
+            warnings.warn(f"Compiling G.synthesis failed ({type(e).__name__}: {e}), falling back to eager mode")
+            self.compiled = None
+            return self.eager(*args, **kwargs)
+        self._captured.add(signature)
+        return result
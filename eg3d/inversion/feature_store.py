@@ -0,0 +1,44 @@
+import os
+import uuid
+from typing import Callable
+
+import numpy as np
+import torch
+
+
+class FeatureStore:
+    """Persists target-side features on disk, keyed by extractor tag and image content hash.
+
+    Target images never change, so features computed once can be reused by every later run and phase.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, tag: str, key: str) -> str:
+        return os.path.join(self.root, tag, key + '.npy')
+
+    def get(self, tag: str, key: str):
+        path = self._path(tag, key)
+        if not os.path.isfile(path):
+            return None
+        return torch.from_numpy(np.load(path))
+
+    def put(self, tag: str, key: str, feature: torch.Tensor):
+        path = self._path(tag, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_file = path + '.' + uuid.uuid4().hex + '.npy'
+        np.save(temp_file, feature.detach().cpu().numpy())
+        os.replace(temp_file, path)  # atomic
+
+    def get_or_compute(self, tag: str, key: str, compute: Callable[[], torch.Tensor]) -> torch.Tensor:
+        feature = self.get(tag, key)
+        if feature is None:
+            feature = compute().detach().cpu()
+            self.put(tag, key, feature)
+        return feature
+
+
+def dataset_store(file_name: str) -> FeatureStore:
+    # Features live in a cache folder beside the frames of the dataset.
+    return FeatureStore(os.path.join(os.path.dirname(file_name), 'feature_cache'))
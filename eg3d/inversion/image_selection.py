@@ -6,26 +6,21 @@ from typing import List
 
 from inversion.load_data import load
 from inversion.load_data import ImageItem
+from inversion.poses import PoseTable
 from inversion.plots import compare_cam_plot_interpolate
 
 
 def select_evenly(images: List[ImageItem], num_targets: int) -> List[int]:
-    all_angles = torch.tensor([item.c_item.xz_angle() for item in images])
-    min_angle = torch.min(all_angles)
-    max_angle = torch.max(all_angles)
+    table = PoseTable.from_images(images)
 
     if num_targets == 1:
         # select the most centered view
-        target_angles = [torch.pi / 2]
+        target_angles = torch.tensor([torch.pi / 2])
     else:
-        target_angles = torch.linspace(start=min_angle, end=max_angle, steps=num_targets)
+        target_angles = torch.linspace(start=table.yaw.min().item(), end=table.yaw.max().item(), steps=num_targets)
 
     # find the closest match in list and return index
-    target_indices = []
-    for target_angle in target_angles:
-        distance = torch.abs(all_angles - target_angle)
-        target_indices.append(torch.argmin(distance))
-    return target_indices
+    return table.nearest(target_angles).tolist()
 
 
 def select_evenly_interpolate(images: List[ImageItem], num_targets: int):
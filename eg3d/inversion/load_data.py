@@ -1,36 +1,147 @@
 import copy
 import fnmatch
+import hashlib
+import json
+import os
 import re
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from typing import Tuple, List
 
 from tqdm import tqdm
 import torch
-import PIL
+import PIL.Image
 import numpy as np
 
-import dnnlib
+from inversion.poses import PoseTable
+
+
+def load_frame(file_name: str, img_resolution: int) -> np.ndarray:
+    image = PIL.Image.open(file_name).convert('RGB')
+    w, h = image.size
+    s = min(w, h)
+    image = image.crop(((w - s) // 2, (h - s) // 2, (w + s) // 2, (h + s) // 2))
+    image = image.resize((img_resolution, img_resolution), PIL.Image.LANCZOS)
+    return np.array(image, dtype=np.uint8)
+
+
+class FrameSet:
+    """Loaded frames of a capture as one uint8 [F, 3, H, W] device tensor, and all cameras as one [N, 25] tensor.
+
+    Only loaded frames get a row; rows are appended in load order and the buffer grows by doubling. Float images are
+    only created per batch.
+    """
+
+    def __init__(self, file_names: List[str], labels: np.ndarray = None, img_resolution=512, device="cpu",
+                 cache: "FrameCache" = None, num_workers: int = 8):
+        self.file_names = file_names
+        self.img_resolution = img_resolution
+        self.device = device
+        self.num_workers = num_workers
+        self.cams = None if labels is None else torch.tensor(np.asarray(labels, dtype=np.float32), device=device)
+        self.frames = None  # [capacity, 3, H, W], rows [0, num_rows) hold the loaded frames
+        self.num_rows = 0
+        self._rows = np.full(len(file_names), -1, dtype=np.int64)  # row of every frame, -1 if not loaded
+        self._cache = cache  # frames decoded earlier, which also receives newly decoded frames
+
+    def __len__(self):
+        return len(self.file_names)
+
+    def is_loaded(self, index: int) -> bool:
+        return bool(self._rows[index] >= 0)
+
+    def _reserve(self, num_rows: int):
+        capacity = 0 if self.frames is None else len(self.frames)
+        if num_rows <= capacity:
+            return
+        capacity = min(max(num_rows, 2 * capacity), len(self))
+        frames = torch.empty([capacity, 3, self.img_resolution, self.img_resolution], dtype=torch.uint8,
+                             device=self.device)
+        if self.num_rows > 0:
+            frames[:self.num_rows] = self.frames[:self.num_rows]
+        self.frames = frames
+
+    def load(self, indices: List[int]):
+        # Decode all missing frames at once and append them as rows of the device tensor.
+        missing = [i for i in dict.fromkeys(int(i) for i in indices) if self._rows[i] < 0]
+        if len(missing) == 0:
+            return
+        missing = np.array(missing, dtype=np.int64)
+        cached = self._cache.decoded[missing] if self._cache is not None else np.zeros(len(missing), dtype=bool)
+        frames = np.empty([len(missing), self.img_resolution, self.img_resolution, 3], dtype=np.uint8)
+        if cached.any():
+            frames[cached] = self._cache.frames[missing[cached]]
+        if not cached.all():
+            decode = missing[~cached]
+            frames[~cached] = load_frames([self.file_names[i] for i in decode], self.img_resolution,
+                                          self.num_workers, verbose=len(decode) > 1)
+            if self._cache is not None:
+                self._cache.write(decode, frames[~cached])
+        self._reserve(self.num_rows + len(missing))
+        start, self.num_rows = self.num_rows, self.num_rows + len(missing)
+        self.frames[start:self.num_rows] = torch.from_numpy(frames).to(self.device).permute(0, 3, 1, 2)
+        self._rows[missing] = np.arange(start, self.num_rows)
+
+    def uint8(self, indices: List[int]) -> torch.Tensor:
+        indices = [int(i) for i in indices]
+        self.load(indices)
+        return self.frames[torch.from_numpy(self._rows[indices]).to(self.device)]
+
+    def target_batch(self, indices: List[int]) -> torch.Tensor:
+        # [B, 3, H, W] in [-1, 1]
+        return self.uint8(indices).to(torch.float32) / 255.0 * 2 - 1
+
+    def numpy(self, index: int) -> np.ndarray:
+        # [H, W, 3] uint8, only created on demand, e.g. for saving or videos.
+        if self._cache is not None and self._cache.decoded[index]:
+            return np.asarray(self._cache.frames[index])
+        return self.uint8([index])[0].permute(1, 2, 0).cpu().numpy()
 
 
 class ImageItem:
-    def __init__(self, file_name: str, c: torch.tensor = None, device="cuda", img_resolution=512):
+    def __init__(self, file_name: str, c: torch.tensor = None, device="cuda", img_resolution=512,
+                 frame_set: FrameSet = None, index: int = 0):
         self.file_name = file_name
         if c is not None:
             self.c_item = CamItem(c)
             self.original_c_item = CamItem(copy.deepcopy(c))
         self.device = device
+        self.img_resolution = img_resolution
+        self.w, self.h = img_resolution, img_resolution
 
-        # load image.
-        self.target_pil = PIL.Image.open(file_name).convert('RGB')
-        w, h = self.target_pil.size
-        s = min(w, h)
-        self.target_pil = self.target_pil.crop(((w - s) // 2, (h - s) // 2, (w + s) // 2, (h + s) // 2))
-        self.target_pil = self.target_pil.resize((img_resolution, img_resolution), PIL.Image.LANCZOS)
-        self.w, self.h = self.target_pil.size
-        self.t_uint8 = np.array(self.target_pil, dtype=np.uint8)
-
-        target_tensor = torch.tensor(self.t_uint8.transpose([2, 0, 1]), device=device)
-        self.target_tensor = target_tensor.unsqueeze(0).to(torch.float32) / 255.0 * 2 - 1
+        # Pixel data lives in the frame set of the dataset and is loaded on first access.
+        if frame_set is None:
+            frame_set = FrameSet([file_name], img_resolution=img_resolution, device=device)
+        self.frame_set = frame_set
+        self.index = index
+        self._content_hash = None
         self.feature = None
+        self.id_feature = None
+
+    @property
+    def t_uint8(self) -> np.ndarray:
+        return self.frame_set.numpy(self.index)
+
+    @property
+    def target_pil(self) -> PIL.Image.Image:
+        return PIL.Image.fromarray(np.ascontiguousarray(self.t_uint8), 'RGB')
+
+    @property
+    def content_hash(self) -> str:
+        if self._content_hash is None:
+            self._content_hash = hashlib.md5(np.ascontiguousarray(self.t_uint8).tobytes()).hexdigest()
+        return self._content_hash
+
+    @property
+    def target_tensor(self) -> torch.Tensor:
+        # [1, 3, H, W] in [-1, 1], normalized from the packed uint8 row on every access; loops use target_batch.
+        return self.frame_set.target_batch([self.index])
+
+    def is_decoded(self) -> bool:
+        return self.frame_set.is_loaded(self.index)
+
+    def load(self):
+        self.frame_set.load([self.index])
 
 
 class CamItem:
@@ -57,9 +168,8 @@ class CamItem:
         return [x, y, z]
 
     def xz_angle(self):
-        x, y, z = self.xyz()
-        angle = torch.arctan2(z, x)
-        return angle
+        # Yaw of the camera, see PoseTable; use a PoseTable to get the angles of many cameras at once.
+        return PoseTable(self.c).yaw[0]
 
     def direction(self):
         direction = torch.matmul(self.rotation().to("cpu"), torch.tensor([[0.0], [0.0], [-1.0]]).to("cpu"))
@@ -67,30 +177,147 @@ class CamItem:
         return direction / mag
 
 
-def load(folder: str, img_resolution: int, device="cpu") -> List[ImageItem]:
-    dataset_kwargs = dnnlib.EasyDict(class_name='training.dataset.ImageFolderDataset', path=folder,
-                                     use_labels=True, max_size=None, xflip=False)
-    dataset = dnnlib.util.construct_class_by_name(**dataset_kwargs)
-    images = []
+def list_frames(folder: str) -> Tuple[List[str], dict]:
+    all_fnames = {os.path.relpath(os.path.join(root, fname), start=folder) for root, _dirs, files in os.walk(folder)
+                  for fname in files}
+    file_names = sorted(fnmatch.filter(all_fnames, "[!epoch][!crop]*[0-9].png"))
+    with open(os.path.join(folder, 'dataset.json')) as f:
+        label_dict = dict(json.load(f)['labels'])
+    return file_names, label_dict
+
 
-    use_file_names = sorted(fnmatch.filter(dataset._image_fnames, "[!epoch][!crop]*[0-9].png"))
-    # use_file_names_sorted = ["" for _ in range(len(use_file_names))]
-    # for file_name in use_file_names:
-    #     index = re.findall(r'\d+', file_name)[0]
-    #     use_file_names_sorted[int(index)] = file_name
-    # use_file_names = use_file_names_sorted
+def _frame_cache_paths(folder: str, img_resolution: int) -> Tuple[str, str, str, str]:
+    prefix = os.path.join(folder, f'frames_{img_resolution}')
+    return prefix + '.npy', prefix + '_labels.npy', prefix + '.json', prefix + '_decoded.npy'
 
-    label_dict = dataset.load_label_dict()
 
-    for filename in tqdm(use_file_names, desc="Loading Data"):
-        target_fname = dataset._path + "/" + filename
-        c = torch.tensor(label_dict[filename]).to(device)[None, ...]
-        images.append(ImageItem(target_fname, c, device, img_resolution))
+def _fingerprint(folder: str, file_names: List[str]) -> str:
+    md5 = hashlib.md5()
+    for fname in file_names + ['dataset.json']:
+        stat = os.stat(os.path.join(folder, fname))
+        md5.update(f'{fname}:{stat.st_size}:{stat.st_mtime_ns}'.encode('utf-8'))
+    return md5.hexdigest()
+
+
+class FrameCache:
+    """Decoded frames of a capture folder in a memory-mapped frames_<res>.npy.
+
+    The file holds all frames from the start and is filled as frames are decoded, so lazy loading builds the
+    cache over time. frames_<res>_decoded.npy marks the frames written so far; caches without it are complete.
+    """
+
+    def __init__(self, folder: str, img_resolution: int, file_names: List[str]):
+        self.folder = folder
+        self.img_resolution = img_resolution
+        self.file_names = file_names
+        self.frames_path, self.labels_path, self.index_path, self.decoded_path = \
+            _frame_cache_paths(folder, img_resolution)
+        self.frames = None  # [N, H, W, 3] uint8, memory-mapped
+        self.decoded = None  # [N] bool
+
+    def open(self) -> bool:
+        # False if there is no cache, or the frames changed since it was created.
+        if not all(os.path.isfile(path) for path in (self.frames_path, self.labels_path, self.index_path)):
+            return False
+        with open(self.index_path) as f:
+            index = json.load(f)
+        if index['file_names'] != self.file_names or \
+                index['fingerprint'] != _fingerprint(self.folder, self.file_names):
+            return False
+        self.frames = np.load(self.frames_path, mmap_mode='r')
+        self.decoded = np.load(self.decoded_path) if os.path.isfile(self.decoded_path) else \
+            np.ones(len(self.file_names), dtype=bool)
+        return True
+
+    def create(self, labels: np.ndarray):
+        # Replaces an outdated cache; its index goes first, so it is not used while it is rewritten.
+        for path in (self.index_path, self.decoded_path):
+            if os.path.isfile(path):
+                os.remove(path)
+        res = self.img_resolution
+        self.frames = np.lib.format.open_memmap(self.frames_path, mode='w+', dtype=np.uint8,
+                                                shape=(len(self.file_names), res, res, 3))
+        self.decoded = np.zeros(len(self.file_names), dtype=bool)
+        self._save_decoded()
+        np.save(self.labels_path, labels)
+        # The index is written last, so a cache is only used once it is set up.
+        with open(self.index_path, 'w') as f:
+            json.dump({'file_names': self.file_names, 'fingerprint': _fingerprint(self.folder, self.file_names)}, f)
+
+    def labels(self) -> np.ndarray:
+        return np.load(self.labels_path)
+
+    def write(self, indices: np.ndarray, frames: np.ndarray):
+        if self.frames.mode not in ('r+', 'w+'):
+            self.frames = np.load(self.frames_path, mmap_mode='r+')
+        self.frames[indices] = frames
+        self.frames.flush()
+        # Marked after the frames are written, so the mask never claims a frame that is not on disk.
+        self.decoded[indices] = True
+        self._save_decoded()
+
+    def _save_decoded(self):
+        if os.path.isfile(self.decoded_path):
+            self.decoded |= np.load(self.decoded_path)  # frames written by other processes meanwhile
+        temp_file = self.decoded_path + '.' + uuid.uuid4().hex + '.npy'
+        np.save(temp_file, self.decoded)
+        os.replace(temp_file, self.decoded_path)  # atomic
+
+
+def load_frames(file_names: List[str], img_resolution: int, num_workers: int = 8, verbose=True) -> np.ndarray:
+    # PIL releases the GIL while decoding and resizing, so threads scale here.
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        frames = pool.map(lambda fname: load_frame(fname, img_resolution), file_names)
+        if verbose:
+            frames = tqdm(frames, total=len(file_names), desc="Loading Data")
+        return np.stack(list(frames))
+
+
+def load(folder: str, img_resolution: int, device="cpu", num_workers: int = 8, use_cache: bool = True,
+         lazy: bool = False) -> List[ImageItem]:
+    file_names, label_dict = list_frames(folder)
+
+    # Frames are written to the cache as they are decoded, by lazy loads as well.
+    cache = FrameCache(folder, img_resolution, file_names) if use_cache else None
+    if cache is not None and cache.open():
+        labels = cache.labels()
+    else:
+        labels = np.array([label_dict[fname] for fname in file_names], dtype=np.float32)
+        if cache is not None:
+            cache.create(labels)
+
+    frame_set = FrameSet([folder + "/" + fname for fname in file_names], labels, img_resolution, device,
+                         cache=cache, num_workers=num_workers)
+    if not lazy:
+        frame_set.load(range(len(frame_set)))
+
+    images = []
+    for index, (target_fname, label) in enumerate(zip(frame_set.file_names, labels)):
+        c = torch.tensor(label).to(device)[None, ...]
+        images.append(ImageItem(target_fname, c, device, img_resolution, frame_set=frame_set, index=index))
 
     return images
 
 
+def prefetch(images: List[ImageItem], indices: List[int]):
+    # Decode the given frames in parallel and move them to their device.
+    items = [images[i] for i in indices]
+    frame_sets = {id(item.frame_set): item.frame_set for item in items}
+    for frame_set in frame_sets.values():
+        frame_set.load([item.index for item in items if item.frame_set is frame_set])
+
+
+def target_batch(images: List[ImageItem], indices: List[int]) -> torch.Tensor:
+    # Normalized target images of the given items as one [B, 3, H, W] batch.
+    items = [images[i] for i in indices]
+    frame_set = items[0].frame_set
+    if all(item.frame_set is frame_set for item in items):
+        return frame_set.target_batch([item.index for item in items])
+    return torch.cat([item.frame_set.target_batch([item.index]) for item in items])
+
+
 if __name__ == "__main__":
     images = load("../../dataset_preprocessing/ffhq/1", 512)
-    for img in images:
-        print(img.file_name, img.c_item.xz_angle() / torch.pi, *img.c_item.xyz())
+    table = PoseTable.from_images(images)
+    for img, yaw in zip(images, table.yaw):
+        print(img.file_name, yaw / torch.pi, *img.c_item.xyz())
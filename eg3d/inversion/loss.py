@@ -5,7 +5,10 @@ import torch.nn.functional as F
 from models.encoders.model_irse import Backbone
 
 
-def mse(target_images: torch.tensor, synth_images: torch.tensor):
+def mse(target_images: torch.tensor, synth_images: torch.tensor, reduce: bool = True):
+    # reduce=False returns one value per image.
+    if not reduce:
+        return (target_images - synth_images).square().mean(dim=[1, 2, 3])
     return (target_images - synth_images).square().mean()
 
 
@@ -14,6 +17,7 @@ def perc(
         synth_images: torch.tensor,
         vgg: torch.nn.Module,
         downsampling: bool,
+        reduce: bool = True
 ):
     # Downsample image to 256x256 if it's larger than that. VGG was built for 224x224 images.
     if synth_images.shape[2] > 256 and downsampling:
@@ -21,7 +25,9 @@ def perc(
 
     # Features for synth images.
     synth_features = vgg(synth_images)  # , resize_images=False, return_lpips=True)
-    return (target_feature.to("cuda") - synth_features).square().sum().mean()
+    if not reduce:
+        return (target_feature.to(synth_features.device) - synth_features).square().sum(dim=1)
+    return (target_feature.to(synth_features.device) - synth_features).square().sum().mean()
 
 
 def noise_reg(noise_bufs):
@@ -38,13 +44,13 @@ def noise_reg(noise_bufs):
 
 
 class IDLoss(torch.nn.Module):
-    def __init__(self):
+    def __init__(self, device="cuda"):
         super(IDLoss, self).__init__()
         self.facenet = Backbone(input_size=112, num_layers=50, drop_ratio=0.6, mode="ir_se")
         self.facenet.load_state_dict(torch.load("pretrained_models/model_ir_se50.pth"))
         self.face_pool = torch.nn.AdaptiveAvgPool2d((112, 112))
         self.facenet.eval()
-        self.facenet = self.facenet.to("cuda")
+        self.facenet = self.facenet.to(device)
 
     def extract_feats(self, x):
         if x.shape[2] > 256:
@@ -52,13 +58,19 @@ class IDLoss(torch.nn.Module):
         x = x[:, :, 35:223, 32:220]  # Crop interesting region
         x = self.face_pool(x)
         x_feats = self.facenet(x)
-        return x_feats[0]
+        return x_feats
 
-    def forward(self, synth_image, target_image):
+    def forward(self, synth_image, target_image=None, target_feats=None, reduce=True):
+        # Mean over the batch, so a batch of views matches the average of per-view losses.
+        # Precomputed target embeddings (see create_id_features) skip the target forward pass.
+        # reduce=False returns one loss per image.
         x_feats = self.extract_feats(synth_image)
-        y_feats = self.extract_feats(target_image)
-        y_feats = y_feats.detach()
-        return 1 - y_feats.dot(x_feats)
+        if target_feats is None:
+            target_feats = self.extract_feats(target_image)
+        y_feats = target_feats.detach()
+        if not reduce:
+            return 1 - (y_feats * x_feats).sum(dim=1)
+        return (1 - (y_feats * x_feats).sum(dim=1)).mean()
 
 
 class DepthLoss:
@@ -81,9 +93,9 @@ class DepthLoss:
 
 
 class DepthLossAll:
-    def __init__(self, num_targets, depth_image_size=128, depth_multiplier=1.0):
+    def __init__(self, num_targets, depth_image_size=128, depth_multiplier=1.0, device="cuda"):
         # cs, ws, H, W
-        self.depth_list = torch.zeros([num_targets, num_targets, depth_image_size, depth_image_size], dtype=torch.float32).to("cuda")
+        self.depth_list = torch.zeros([num_targets, num_targets, depth_image_size, depth_image_size], dtype=torch.float32).to(device)
         # cs
         self.initialized_list = np.zeros([num_targets]).astype(bool)
         self.depth_multiplier = depth_multiplier
@@ -92,7 +104,16 @@ class DepthLossAll:
         loss = 0
         if self.initialized_list[view_index]:
             loss += mse(depth_image, torch.mean(self.depth_list[view_index], dim=0)) * self.depth_multiplier
-        self.depth_list[view_index, w_index] = depth_image.detach()[0]
+        self.depth_list[view_index, w_index] = depth_image.detach()[0].float()
+        return loss
+
+    def batched(self, view_index, depth_images):
+        # depth_images: [ws, 1, H, W], every latent rendered from the same view.
+        loss = 0
+        if self.initialized_list[view_index]:
+            mean_depth = torch.mean(self.depth_list[view_index], dim=0)
+            loss += (depth_images[:, 0] - mean_depth).square().mean(dim=[1, 2]).sum() * self.depth_multiplier
+        self.depth_list[view_index] = depth_images.detach()[:, 0].float()
         return loss
 
 
@@ -8,6 +8,8 @@ from pytorch_msssim import MS_SSIM
 import torchvision.transforms.functional as F
 import torchvision.transforms as trans
 from inversion.custom_vgg import NvidiaVGG16
+from inversion.feature_store import dataset_store
+from inversion.load_data import target_batch
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -21,6 +23,7 @@ class Metrics:
         self.mse_module = torch.nn.MSELoss()
         self.lpips_module = NvidiaVGG16()
         self.ms_ssim_module = MS_SSIM(data_range=1, size_average=True, channel=3)
+        self.ms_ssim_batch_module = MS_SSIM(data_range=1, size_average=False, channel=3)
 
         self.facenet = IR_101(input_size=112)
         self.facenet.load_state_dict(torch.load("pretrained_models/CurricularFace_Backbone.pth", map_location=device))
@@ -34,6 +37,10 @@ class Metrics:
         self.universal_transform = trans.Compose([
             trans.Resize((256, 256))
         ])
+        # Feature store tags of the cached target side, named after the metric configuration.
+        self.lpips_tag = f"eval_lpips_{type(self.lpips_module).__name__}_256"
+        self.face_tag = "eval_face_mtcnn_112_256"
+        self.id_tag = "eval_id_CurricularFace_mtcnn_256"
 
     def mse(self, X, Y):
         X = self.universal_transform(X)
@@ -82,23 +89,135 @@ class Metrics:
         with torch.no_grad():
             return float(self.ms_ssim_module(X.unsqueeze(0).to(device), Y.unsqueeze(0).to(device)))
 
+    def align_batch(self, X):
+        # Aligned 112x112 face crops of a [B, 3, H, W] batch; None where no face is detected.
+        # Same uint8 conversion as F.to_pil_image, then one batched detection.
+        X = ((self.universal_transform(X) + 1) / 2).cpu().mul(255).byte()
+        with torch.no_grad():
+            faces, _ = self.mtcnn.align_batch(X)
+        return faces
+
+    def id_features(self, faces):
+        # Identity embeddings [B, 512] of aligned crops, with a mask of the crops that exist.
+        valid = torch.tensor([face is not None for face in faces], device=device)
+        features = torch.zeros([len(faces), 512], device=device)
+        if valid.any():
+            crops = torch.stack([self.id_transform(face) for face in faces if face is not None]).to(device)
+            with torch.no_grad():
+                features[valid] = self.facenet(crops)
+        return features, valid
+
+    def lpips_features(self, X):
+        with torch.no_grad():
+            return self.lpips_module(self.universal_transform(X.to(device)))
+
+    def target_features(self, images, indices, use_store=True):
+        # LPIPS features, identity embeddings and their mask for the target frames at indices.
+        # Targets never change, so they are cached beside the dataset and only missing frames are computed.
+        if not use_store:
+            Y = target_batch(images, indices)
+            return (self.lpips_features(Y), *self.id_features(self.align_batch(Y)))
+
+        store = dataset_store(images[indices[0]].file_name)
+        keys = [images[i].content_hash for i in indices]
+        cached = [[store.get(self.lpips_tag, key), store.get(self.id_tag, key)] for key in keys]
+
+        missing = [n for n, (lpips, _) in enumerate(cached) if lpips is None]
+        if len(missing) > 0:
+            Y = target_batch(images, [indices[n] for n in missing])
+            for n, lpips in zip(missing, self.lpips_features(Y)):
+                store.put(self.lpips_tag, keys[n], lpips)
+                cached[n][0] = lpips.cpu()
+
+        missing = [n for n, (_, id_feature) in enumerate(cached) if id_feature is None]
+        if len(missing) > 0:
+            # Aligned crops are cached as well, MTCNN only runs on frames without one.
+            # Frames without a detected face are stored as empty arrays.
+            faces = [store.get(self.face_tag, keys[n]) for n in missing]
+            detect = [m for m, face in enumerate(faces) if face is None]
+            if len(detect) > 0:
+                detected = self.align_batch(target_batch(images, [indices[missing[m]] for m in detect]))
+                for m, face in zip(detect, detected):
+                    faces[m] = torch.from_numpy(np.array(face)) if face is not None else \
+                        torch.zeros([0], dtype=torch.uint8)
+                    store.put(self.face_tag, keys[missing[m]], faces[m])
+            faces = [PIL.Image.fromarray(face.numpy()) if face.numel() > 0 else None for face in faces]
+            id_features, valid = self.id_features(faces)
+            for n, id_feature, is_valid in zip(missing, id_features, valid):
+                id_feature = id_feature if is_valid else torch.zeros([0])
+                store.put(self.id_tag, keys[n], id_feature)
+                cached[n][1] = id_feature.cpu()
+
+        lpips = torch.stack([lpips for lpips, _ in cached]).to(device)
+        valid = torch.tensor([id_feature.numel() > 0 for _, id_feature in cached], device=device)
+        id_features = torch.stack([id_feature if id_feature.numel() > 0 else torch.zeros([512])
+                                   for _, id_feature in cached]).to(device)
+        return lpips, id_features, valid
+
+    def evaluate_batch(self, X, Y, Y_features=None):
+        # All metrics for a batch of reconstructions X and targets Y ([B, 3, H, W]), one value per frame.
+        # Y_features are the target-side (lpips, id, valid) features, e.g. from target_features.
+        # Metrics are computed on device and read back once per batch.
+        if Y_features is None:
+            Y_features = (self.lpips_features(Y), *self.id_features(self.align_batch(Y)))
+        Y_lpips, Y_id, Y_valid = Y_features
+        X_lpips = self.lpips_features(X)
+        X_id, X_valid = self.id_features(self.align_batch(X))
+        X = self.universal_transform(X.to(device))
+        Y = self.universal_transform(Y.to(device))
+        with torch.no_grad():
+            mse = (Y - X).square().mean(dim=[1, 2, 3])
+            ms_ssim = self.ms_ssim_batch_module((X + 1) / 2, (Y + 1) / 2)
+            lpips = (X_lpips - Y_lpips).square().sum(dim=1)
+        id_sim = (X_id * Y_id).sum(dim=1)
+        valid = (X_valid & Y_valid).cpu().numpy()
+        return {
+            "mse": mse.cpu().numpy(),
+            "ms_ssim": ms_ssim.cpu().numpy(),
+            "lpips": lpips.cpu().numpy(),
+            "id_sim": [float(value) if is_valid else None for value, is_valid in zip(id_sim.cpu().numpy(), valid)],
+        }
+
 
 class DepthMetric:
+    """Per-pixel standard deviation of the depth rendered for each view by different latents.
+
+    Running mean and variance are accumulated per view (Welford), so memory stays O(views x H x W).
+    """
+
     def __init__(self, num_targets):
-        self.depth_array = np.zeros([num_targets, num_targets, 128, 128])
         self.num_targets = num_targets
-        self.counter = np.zeros(num_targets, dtype=int)
+        self.counter = torch.zeros(num_targets, dtype=torch.int64)
+        self.mean = None
+        self.m2 = None
 
     def update(self, view_index, depth_image):
-        self.depth_array[view_index, self.counter[view_index]] = depth_image[0].detach().cpu().numpy()
-        self.counter[view_index] += 1
+        self.update_batch([view_index], depth_image.unsqueeze(0))
+
+    def update_batch(self, view_indices, depth_images):
+        # One depth image [B, 1, H, W] per view; each view at most once per call.
+        view_indices = torch.as_tensor(view_indices, dtype=torch.int64).reshape(-1)
+        assert len(view_indices.unique()) == len(view_indices)
+        depth_images = depth_images[:, 0].detach().float()
+        if self.mean is None:
+            shape = [self.num_targets] + list(depth_images.shape[1:])
+            self.mean = torch.zeros(shape, dtype=torch.float32, device=depth_images.device)
+            self.m2 = torch.zeros(shape, dtype=torch.float32, device=depth_images.device)
+
+        self.counter[view_indices] += 1
+        count = self.counter[view_indices].to(depth_images.device).float()[:, None, None]
+        index = view_indices.to(depth_images.device)
+        delta = depth_images - self.mean[index]
+        self.mean[index] += delta / count
+        self.m2[index] += delta * (depth_images - self.mean[index])
 
     def calc_mean_stddev(self, path=None):
-        std = np.std(self.depth_array, axis=1)
+        count = self.counter.to(self.m2.device).float().clamp(min=1)[:, None, None]
+        std = torch.sqrt(self.m2 / count).cpu().numpy()
         print(std.shape)
         if path is not None:
-            PIL.Image.fromarray(std[self.num_targets // 2], mode='L').save(path)
-        return np.mean(std)
+            PIL.Image.fromarray(std[self.num_targets // 2].astype(np.float64), mode='L').save(path)
+        return float(np.mean(std))
 
 
 if __name__ == "__main__":
@@ -1,15 +1,18 @@
-import copy
 from typing import List
 import numpy as np
-import PIL.Image
 import torch
 from tqdm import tqdm
 from torch.utils.tensorboard import SummaryWriter
 
-from inversion.utils import create_vgg_features, create_w_stats, interpolate_w_by_cam
+from inversion.utils import loss_models, create_vgg_features, create_id_features, create_w_stats, \
+    interpolate_ws_by_cams, reload_modules, cache_cameras
 from inversion.loss import perc, mse, IDLoss, DepthLossAll
 from inversion.custom_vgg import CustomVGG, NvidiaVGG16
-from inversion.load_data import ImageItem
+from inversion.load_data import ImageItem, target_batch
+from inversion.poses import PoseTable
+from inversion.compiled import CompiledSynthesis
+from inversion.precision import Precision
+from inversion.telemetry import Telemetry
 
 
 def project(
@@ -26,37 +29,45 @@ def project(
         target_indices: List[int],
         inter_indices: List[int],
         downsampling=True,
-        writer: SummaryWriter,
+        writer: SummaryWriter,  # or Telemetry
         continue_checkpoint,
         use_interpolation,
         use_depth_reg: bool,
-        use_w_norm_reg: bool
+        use_w_norm_reg: bool,
+        interpolation_kernel: str = "linear",
+        precision: str = "fp32",
+        compiled: bool = False
 ):
-    assert images[0].target_tensor[0].shape == (G.img_channels, G.img_resolution, G.img_resolution)
+    used_images = [images[i] for i in list(target_indices) + list(inter_indices)]
+    assert used_images[0].target_tensor[0].shape == (G.img_channels, G.img_resolution, G.img_resolution)
 
-    G = copy.deepcopy(G).eval().requires_grad_(False).to(device)
+    # The depth step renders depth only, which the pickled code cannot do.
+    G = cache_cameras(reload_modules(G).eval().requires_grad_(False).to(device))
     _, w_std = create_w_stats(G, w_avg_samples, device)
+    amp = Precision(precision, device)
+    synthesis = CompiledSynthesis(G, enabled=compiled)
     w_checkpoint = np.load(continue_checkpoint)
     w_checkpoint = torch.tensor(w_checkpoint[("w")]).to(device)
-    vgg = NvidiaVGG16(device)
-    create_vgg_features(images, vgg, downsampling=downsampling)
-    id_loss_model = IDLoss()
-    depth_loss_model = DepthLossAll(num_targets=len(target_indices))
-
-    w_opt_list = []
-    for _ in range(len(target_indices)):
-        w_opt = w_checkpoint.detach().clone()
-        w_opt.requires_grad = True
-        w_opt_list.append(w_opt)
-
-    w_out = torch.zeros([num_steps, len(target_indices)] + list(w_opt_list[0].shape[1:]), dtype=torch.float32, device="cpu")
-    optimizer = torch.optim.Adam(w_opt_list, betas=(0.9, 0.999), lr=initial_learning_rate)
-
-    # optimize camera parameters of input data
-    cam_parameters = []
-    for img in images:
-        img.c_item.c.requires_grad = True
-        cam_parameters.append(img.c_item.c)
+    vgg, id_loss_model = loss_models(device)
+    create_vgg_features(used_images, vgg, downsampling=downsampling)
+    create_id_features(used_images, id_loss_model)
+    depth_loss_model = DepthLossAll(num_targets=len(target_indices), device=device)
+
+    # One latent per target view, stacked so that all views run through G.synthesis as a single batch.
+    num_views = len(target_indices)
+    w_opt = w_checkpoint.detach().clone().repeat(num_views, 1, 1)
+    w_opt.requires_grad = True
+
+    w_out = torch.zeros([num_steps] + list(w_opt.shape), dtype=torch.float32, device="cpu", pin_memory=w_opt.is_cuda)
+    telemetry = Telemetry.wrap(writer)
+    optimizer = torch.optim.Adam([w_opt], betas=(0.9, 0.999), lr=initial_learning_rate)
+
+    # Anchor cameras of the per-view latents, used by the interpolation step.
+    anchor_table = PoseTable.from_cams([images[i].c_item.c for i in target_indices])
+    # Cameras are concatenated once, so the camera cache finds the same tensors at every step.
+    cams = torch.cat([images[i].c_item.c for i in target_indices])
+    depth_cams = [images[i].c_item.c.repeat(num_views, 1) for i in target_indices]
+    inter_cams = torch.cat([images[i].c_item.c for i in inter_indices]) if use_interpolation else None
 
     for step in tqdm(range(num_steps)):
         # Learning rate schedule.
@@ -69,99 +80,87 @@ def project(
             param_group['lr'] = lr
 
         # normal step
-        agg_mse_loss = 0
-        agg_perc_loss = 0
-        agg_w_norm_loss = 0
-        agg_loss = 0
-        agg_id_loss = 0
-        for count, pair in enumerate(zip(target_indices, w_opt_list)):
-            i, w_opt = pair
-            synth = G.synthesis(w_opt, c=images[i].c_item.c, noise_mode='const')
-            synth_image = synth['image']
-            perc_loss = perc(images[i].feature, synth_image, vgg=vgg, downsampling=downsampling)
-            mse_loss = mse(images[i].target_tensor, synth_image)
-            w_norm_loss = 0
-            if use_w_norm_reg:
-                w_norm_loss = mse(w_opt, w_checkpoint)
-            id_loss = id_loss_model(synth_image=synth_image, target_image=images[i].target_tensor)
-            loss = 0.1 * mse_loss + perc_loss + 1.0 * w_norm_loss + id_loss
-            loss.backward()
-            agg_mse_loss += mse_loss
-            agg_perc_loss += perc_loss
-            agg_w_norm_loss += w_norm_loss
-            agg_id_loss = id_loss
-            agg_loss += loss
-
-        writer.add_scalar('W/ID Loss', agg_id_loss / len(target_indices), step)
-        writer.add_scalar('W/MSE Loss', agg_mse_loss / len(target_indices), step)
-        writer.add_scalar('W/Perceptual Loss', agg_perc_loss / len(target_indices), step)
-        writer.add_scalar('W/Dist to Avg Loss', agg_w_norm_loss / len(target_indices), step)
-        writer.add_scalar('W/Combined Loss', agg_loss / len(target_indices), step)
-        optimizer.step()
+        # Losses are per-view means; scaling by num_views matches summing the per-view losses.
+        target_images = target_batch(images, target_indices)
+        target_features = torch.cat([images[i].feature for i in target_indices])
+        target_id_features = torch.cat([images[i].id_feature for i in target_indices])
+        with amp.autocast():
+            synth_images = synthesis(w_opt, c=cams, noise_mode='const')['image']
+            perc_loss = perc(target_features, synth_images, vgg=vgg, downsampling=downsampling) / num_views
+            mse_loss = mse(target_images, synth_images)
+            id_loss = id_loss_model(synth_image=synth_images, target_feats=target_id_features)
+        w_norm_loss = 0
+        if use_w_norm_reg:
+            w_norm_loss = mse(w_opt, w_checkpoint)
+        loss = 0.1 * mse_loss + perc_loss + 1.0 * w_norm_loss + id_loss
+        amp.backward(loss * num_views)
+
+        telemetry.scalar('W/ID Loss', id_loss, step)
+        telemetry.scalar('W/MSE Loss', mse_loss, step)
+        telemetry.scalar('W/Perceptual Loss', perc_loss, step)
+        telemetry.scalar('W/Dist to Avg Loss', w_norm_loss, step)
+        telemetry.scalar('W/Combined Loss', loss, step)
+        amp.step(optimizer)
         optimizer.zero_grad(set_to_none=True)
 
         # depth step
         if step % 1 == 0 and use_depth_reg:
-            agg_depth_loss = 0
-            random_cam_index = np.random.choice(len(target_indices))
-            random_cam = images[target_indices[random_cam_index]].c_item.c
-            for w_index, w_opt in enumerate(w_opt_list):
-                image_depth = G.synthesis(w_opt, c=random_cam, noise_mode='const')['image_depth']
-                loss = depth_loss_model(view_index=random_cam_index, w_index=w_index, depth_image=image_depth)
-                if isinstance(loss, torch.Tensor):
-                    loss.backward()
-                agg_depth_loss += loss
+            random_cam_index = np.random.choice(num_views)
+            with amp.autocast():
+                image_depth = synthesis(w_opt, c=depth_cams[random_cam_index], noise_mode='const', outputs=('image_depth',))['image_depth']
+            loss = depth_loss_model.batched(view_index=random_cam_index, depth_images=image_depth.float())
+            if isinstance(loss, torch.Tensor):
+                amp.backward(loss)
             depth_loss_model.initialized_list[random_cam_index] = True
-            writer.add_scalar('W/Depth Loss', agg_depth_loss / len(target_indices), step)
-            optimizer.step()
+            telemetry.scalar('W/Depth Loss', loss / num_views, step)
+            amp.step(optimizer)
             optimizer.zero_grad(set_to_none=True)
 
         # interpolation step
         if use_interpolation:
-            perc_loss_agg = 0
-            mse_loss_agg = 0
-            for i in inter_indices:
-                target_img = images[i]
-                target_cam = target_img.c_item.c
-                selected_cams = [images[i].c_item.c for i in target_indices]
-                w = interpolate_w_by_cam(w_opt_list, selected_cams, target_cam)
-                synth_image = G.synthesis(w, c=target_cam, noise_mode='const')['image']
-                perc_loss = perc(target_img.feature, synth_image, vgg=vgg, downsampling=downsampling)
-                mse_loss = mse(target_img.target_tensor, synth_image)
-                id_loss = id_loss_model(synth_image=synth_image, target_image=images[i].target_tensor)
-                loss = 0.1 * mse_loss + perc_loss + id_loss
-                loss.backward()
-
-                perc_loss_agg += perc_loss
-                mse_loss_agg += mse_loss
-            optimizer.step()
+            num_inter = len(inter_indices)
+            w = interpolate_ws_by_cams(w_opt, anchor_table, inter_cams, kernel=interpolation_kernel)
+            target_images = target_batch(images, inter_indices)
+            target_features = torch.cat([images[i].feature for i in inter_indices])
+            target_id_features = torch.cat([images[i].id_feature for i in inter_indices])
+            with amp.autocast():
+                synth_images = synthesis(w, c=inter_cams, noise_mode='const')['image']
+                perc_loss = perc(target_features, synth_images, vgg=vgg, downsampling=downsampling) / num_inter
+                mse_loss = mse(target_images, synth_images)
+                id_loss = id_loss_model(synth_image=synth_images, target_feats=target_id_features)
+            loss = 0.1 * mse_loss + perc_loss + id_loss
+            amp.backward(loss * num_inter)
+            amp.step(optimizer)
             optimizer.zero_grad(set_to_none=True)
-            writer.add_scalar('W/Interpolate MSE', mse_loss_agg / len(inter_indices), step)
-            writer.add_scalar('W/Interpolate Perc', perc_loss_agg / len(inter_indices), step)
+            telemetry.scalar('W/Interpolate MSE', mse_loss, step)
+            telemetry.scalar('W/Interpolate Perc', perc_loss, step)
 
         # Save projected W for each optimization step.
-        for i, w_opt in enumerate(w_opt_list):
-            w_out[step][i] = w_opt.detach().cpu()[0]
+        w_out[step].copy_(w_opt.detach(), non_blocking=True)
 
         # save results
-        if step == num_steps - 1 or step % 25 == 0:
-            for count, pair in enumerate(zip(target_indices, w_opt_list)):
-                i, w_opt = pair
-                with torch.no_grad():
-                    synth_image = G.synthesis(w_opt, c=images[i].c_item.c, noise_mode='const')['image']
-                    synth_image = (synth_image + 1) * (255 / 2)
-                    synth_image = synth_image.clamp(0, 255).to(torch.uint8)[0]
-                target_image = ((images[i].target_tensor[0] + 1) * (255 / 2)).to(torch.uint8)
+        if telemetry.preview_due(step, num_steps):
+            with torch.no_grad(), amp.autocast():
+                synth_images = synthesis(w_opt, c=cams, noise_mode='const')['image']
+                synth_images = (synth_images + 1) * (255 / 2)
+                synth_images = synth_images.clamp(0, 255).to(torch.uint8)
+            for count, i in enumerate(target_indices):
+                synth_image = synth_images[count]
+                target_image = ((target_batch(images, [i])[0] + 1) * (255 / 2)).to(torch.uint8)
                 synth_image_comb = torch.concat([target_image, synth_image], dim=-1)
-                writer.add_image(f"W/Inversion {i}", synth_image_comb, global_step=step)
+                telemetry.image(f"W/Inversion {i}", synth_image_comb, step)
                 if i == 0:
-                    synth_image = synth_image.permute(1, 2, 0).cpu().numpy()
-                    PIL.Image.fromarray(synth_image, 'RGB').save(f'{outdir}/{step}.png')
-
-            w_opt_list_np = [w_opt.detach().cpu().numpy() for w_opt in w_opt_list]
-            cam_list_np = [images[i].c_item.c.detach().cpu().numpy() for i in target_indices]
-            np.savez(f'{outdir}/{step}_projected_w_mult.npz', ws=w_opt_list_np, cs=cam_list_np)
+                    telemetry.save_image(f'{outdir}/{step}.png', synth_image)
 
+        if step == num_steps - 1 or step % 25 == 0:
+            # Keep the [K, 1, num_ws, w_dim] layout of the per-view checkpoint files.
+            cam_list = torch.stack([images[i].c_item.c for i in target_indices])
+            telemetry.save_npz(f'{outdir}/{step}_projected_w_mult.npz', ws=w_opt[:, None], cs=cam_list)
+        telemetry.step(step)
+
+    telemetry.finish()
+    if w_opt.is_cuda:
+        torch.cuda.synchronize()  # last copies into w_out
     if w_out.shape[2] == 1:
         w_out = w_out.repeat([1, 1, G.mapping.num_ws, 1])
 
@@ -27,6 +27,32 @@ def compare_cam_plot(images: List[ImageItem], save_path):
     plt.savefig(save_path, dpi=300)
 
 
+def cam_change_plot(cams, original_cams, save_path, dpi=300):
+    # Same plot as compare_cam_plot from [N, 25] camera arrays. It draws on its own figure instead of the pyplot
+    # state machine, so it can run on a background thread (see inversion.telemetry).
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(projection='3d')
+
+    ax.scatter(0, 0, 0, marker="x", color="black")
+    ax.set_xlabel('X')
+    ax.set_ylabel('Y')
+    ax.set_zlabel('Z')
+    ax.set_ylim([-3, 3])
+    ax.set_xlim([-3, 3])
+    ax.set_zlim([-3, 3])
+
+    # translation column of the cam2world matrix
+    ax.scatter(cams[:, 3], cams[:, 7], cams[:, 11], marker="o", color="blue")
+    ax.scatter(original_cams[:, 3], original_cams[:, 7], original_cams[:, 11], marker="*", color="red")
+
+    ax.view_init(160, -90)
+    fig.savefig(save_path, dpi=dpi)
+
+
 def compare_cam_plot_interpolate(images_list: List[ImageItem], interpolated_list: List[ImageItem]):
     fig = plt.figure()
     ax = fig.add_subplot(projection='3d')
@@ -0,0 +1,95 @@
+from typing import List
+
+import torch
+
+
+class PoseTable:
+    """Structure-of-arrays table of cameras with precomputed position, view direction, yaw and pitch.
+
+    Yaw is the angle in the xz-plane, pitch the elevation above it. Yaw queries binary-search the sorted yaws; queries
+    with yaw and pitch find the nearest view on the view sphere.
+    """
+
+    def __init__(self, cs: torch.Tensor):
+        self.cs = cs.detach().reshape(-1, 25)
+        self.position = self.cs[:, [3, 7, 11]]  # translation column of the cam2world matrix
+        x, y, z = self.position.unbind(dim=1)
+        self.yaw = torch.arctan2(z, x)
+        self.pitch = torch.arctan2(y, torch.sqrt(x ** 2 + z ** 2))
+        self.direction = torch.nn.functional.normalize(self.position, dim=1)  # unit position on the view sphere
+        self.sorted_yaw, self.order = torch.sort(self.yaw, stable=True)
+
+    @classmethod
+    def from_cams(cls, cs: List[torch.Tensor]) -> "PoseTable":
+        return cls(torch.cat([c.detach().reshape(-1, 25) for c in cs]))
+
+    @classmethod
+    def from_images(cls, images) -> "PoseTable":
+        return cls.from_cams([img.c_item.c for img in images])
+
+    def __len__(self):
+        return len(self.yaw)
+
+    def _as_query(self, yaw) -> torch.Tensor:
+        return torch.as_tensor(yaw, dtype=self.yaw.dtype).to(self.yaw.device).reshape(-1)
+
+    @staticmethod
+    def directions(yaw: torch.Tensor, pitch: torch.Tensor) -> torch.Tensor:
+        # Unit vectors of the given angles, [N, 3]; the inverse of the yaw and pitch of a position.
+        return torch.stack([torch.cos(pitch) * torch.cos(yaw), torch.sin(pitch), torch.cos(pitch) * torch.sin(yaw)], 1)
+
+    def nearest(self, yaw, pitch=None) -> torch.Tensor:
+        # Index of the closest view for every query: by yaw alone, or by angle on the view sphere if pitch is given.
+        yaw = self._as_query(yaw)
+        if pitch is not None:
+            pitch = self._as_query(pitch).expand_as(yaw)
+            return (self.directions(yaw, pitch) @ self.direction.T).argmax(dim=1)
+        pos = torch.searchsorted(self.sorted_yaw, yaw)
+        left = (pos - 1).clamp(0, len(self) - 1)
+        right = pos.clamp(0, len(self) - 1)
+        take_left = (yaw - self.sorted_yaw[left]).abs() <= (self.sorted_yaw[right] - yaw).abs()
+        return self.order[torch.where(take_left, left, right)]
+
+    def interpolation_weights(self, yaw):
+        # For every query: the two views closest in yaw (ordered by index) and the linear blend factor between them.
+        # Queries outside the covered yaw range use the first or last view as is.
+        yaw = self._as_query(yaw)
+        n = len(self)
+        pos = torch.searchsorted(self.sorted_yaw, yaw)
+
+        # The two nearest views are always among the two sorted neighbours on either side.
+        candidates = (pos[:, None] + torch.arange(-2, 2, device=pos.device)).clamp(0, n - 1)
+        dist = (self.sorted_yaw[candidates] - yaw[:, None]).abs()
+        duplicate = torch.zeros_like(dist, dtype=torch.bool)
+        duplicate[:, 1:] = candidates[:, 1:] == candidates[:, :-1]
+        dist = dist.masked_fill(duplicate, float('inf'))
+        views = self.order[candidates.gather(1, dist.topk(min(2, n), dim=1, largest=False).indices)]
+        index_left = views.min(dim=1).values
+        index_right = views.max(dim=1).values
+
+        total_dist = (self.yaw[index_left] - self.yaw[index_right]).abs()
+        mag = ((self.yaw[index_left] - yaw).abs() / total_dist).clip(0, 1)
+
+        above = yaw >= self.yaw.max()
+        below = yaw <= self.yaw.min()
+        first, last = torch.zeros_like(index_left), torch.full_like(index_left, n - 1)
+        index_left = torch.where(above, last, torch.where(below, first, index_left))
+        index_right = torch.where(above, last, torch.where(below, first, index_right))
+        mag = torch.where(above | below, torch.zeros_like(mag), mag)
+        return index_left, index_right, mag
+
+    def blend_weights(self, queries: "PoseTable", kernel: str = "linear", sigma: float = 0.1) -> torch.Tensor:
+        # [M, K] weights of the K views of this table for each of the M query cameras; rows sum to one.
+        # 'linear' blends the two views closest in yaw, 'gaussian' weights all views by yaw and pitch distance.
+        if kernel == "linear":
+            index_left, index_right, mag = self.interpolation_weights(queries.yaw)
+            weights = torch.zeros([len(queries), len(self)], dtype=self.yaw.dtype, device=self.yaw.device)
+            weights.scatter_add_(1, index_left[:, None], (1 - mag)[:, None])
+            weights.scatter_add_(1, index_right[:, None], mag[:, None])
+            return weights
+        if kernel == "gaussian":
+            yaw = queries.yaw.to(self.yaw.device)
+            pitch = queries.pitch.to(self.pitch.device)
+            dist_sq = (yaw[:, None] - self.yaw[None]) ** 2 + (pitch[:, None] - self.pitch[None]) ** 2
+            return torch.softmax(-dist_sq / (2 * sigma ** 2), dim=1)
+        raise NotImplementedError("Select from linear and gaussian")
@@ -0,0 +1,39 @@
+import torch
+
+PRECISIONS = ("fp32", "fp16", "bf16")
+
+
+class Precision:
+    """Autocast mode of an inversion loop: fp32 (off), fp16 or bf16.
+
+    Parameters, latents and optimizer states stay fp32; only the forward passes of G, VGG and the ID network autocast.
+    """
+
+    def __init__(self, mode: str, device):
+        if mode not in PRECISIONS:
+            raise ValueError(f"Unknown precision {mode}, select from {', '.join(PRECISIONS)}")
+        self.mode = mode
+        self.device_type = torch.device(device).type
+        if mode == "fp16" and self.device_type != "cuda":
+            raise ValueError("fp16 autocast needs a GPU; use bf16 on the CPU")
+        self.dtype = torch.bfloat16 if mode == "bf16" else torch.float16
+        # fp16 gradients of small losses underflow; bf16 has the exponent range of fp32 and needs no scaling.
+        self.scaler = torch.cuda.amp.GradScaler(enabled=mode == "fp16")
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "fp32"
+
+    def autocast(self):
+        return torch.autocast(device_type=self.device_type, dtype=self.dtype, enabled=self.enabled)
+
+    def backward(self, loss: torch.Tensor):
+        self.scaler.scale(loss).backward()
+
+    def step(self, optimizer: torch.optim.Optimizer):
+        # Skips the step if the scaled gradients overflowed, then adapts the scale.
+        # Every backward pass is followed by one step, so each step updates the scale.
+        if not any(param.grad is not None for group in optimizer.param_groups for param in group['params']):
+            return  # nothing was backpropagated, e.g. the first depth step of a view
+        self.scaler.step(optimizer)
+        self.scaler.update()
@@ -1,12 +1,15 @@
 import copy
 from typing import List
-import PIL.Image
 import torch
 from tqdm import tqdm
 from torch.utils.tensorboard import SummaryWriter
 
-from inversion.load_data import ImageItem
-from inversion.utils import create_vgg_features
+from inversion.load_data import ImageItem, target_batch
+from inversion.snapshots import SnapshotStore
+from inversion.compiled import CompiledSynthesis
+from inversion.precision import Precision
+from inversion.telemetry import Telemetry
+from inversion.utils import loss_models, create_vgg_features, create_id_features
 from inversion.custom_vgg import CustomVGG, NvidiaVGG16
 from inversion.loss import mse, perc, IDLoss
 
@@ -23,21 +26,29 @@ def project_pti(
         device: torch.device,
         outdir: str,
         target_indices: List[int],
-        writer: SummaryWriter,
-        downsampling: bool
+        writer: SummaryWriter,  # or Telemetry
+        downsampling: bool,
+        snapshot_half: bool = False,
+        snapshot_path: str = None,
+        precision: str = "fp32",
+        compiled: bool = False
 ):
-    assert images[0].target_tensor[0].shape == (G.img_channels, G.img_resolution, G.img_resolution)
+    used_images = [images[i] for i in target_indices]
+    assert used_images[0].target_tensor[0].shape == (G.img_channels, G.img_resolution, G.img_resolution)
 
     G = copy.deepcopy(G).train().requires_grad_(True).to(device)  # type: ignore
     # vgg = CustomVGG("vgg19").to(device)
-    vgg = NvidiaVGG16(device=device)
-    create_vgg_features(images, vgg, downsampling)
-    id_loss_model = IDLoss()
+    vgg, id_loss_model = loss_models(device)
+    create_vgg_features(used_images, vgg, downsampling)
+    create_id_features(used_images, id_loss_model)
 
     w_pivot = w_pivot.to(device).detach()
     optimizer = torch.optim.Adam(G.parameters(), betas=(0.9, 0.999), lr=initial_learning_rate)
 
-    out_params = []
+    out_params = SnapshotStore(G, half=snapshot_half, mmap_path=snapshot_path)
+    telemetry = Telemetry.wrap(writer)
+    amp = Precision(precision, device)
+    synthesis = CompiledSynthesis(G, enabled=compiled)
 
     pbar = tqdm(range(num_steps))
     for step in pbar:
@@ -47,45 +58,46 @@ def project_pti(
         agg_loss = 0
 
         for i in target_indices:
-            synth_images = G.synthesis(w_pivot, c=images[i].c_item.c, noise_mode='const')['image']
-            perc_loss = perc(images[i].feature, synth_images, vgg, downsampling=downsampling)
-            mse_loss = mse(images[i].target_tensor, synth_images)
-            id_loss = id_loss_model(synth_image=synth_images, target_image=images[i].target_tensor)
+            with amp.autocast():
+                synth_images = synthesis(w_pivot, c=images[i].c_item.c, noise_mode='const')['image']
+                perc_loss = perc(images[i].feature, synth_images, vgg, downsampling=downsampling)
+                mse_loss = mse(target_batch(images, [i]), synth_images)
+                id_loss = id_loss_model(synth_image=synth_images, target_feats=images[i].id_feature)
 
             loss = 0.1 * mse_loss + perc_loss + id_loss
-            loss.backward()
+            amp.backward(loss)
 
             agg_mse_loss += mse_loss
             agg_perc_loss += perc_loss
             agg_id_loss += id_loss
             agg_loss += loss
 
-        writer.add_scalar('PTI/MSE Loss', agg_mse_loss / len(target_indices), step)
-        writer.add_scalar('PTI/Perceptual Loss', agg_perc_loss / len(target_indices), step)
-        writer.add_scalar('PTI/ID Loss', agg_id_loss / len(target_indices), step)
-        writer.add_scalar('PTI/Combined Loss', agg_loss / len(target_indices), step)
+        telemetry.scalar('PTI/MSE Loss', agg_mse_loss / len(target_indices), step)
+        telemetry.scalar('PTI/Perceptual Loss', agg_perc_loss / len(target_indices), step)
+        telemetry.scalar('PTI/ID Loss', agg_id_loss / len(target_indices), step)
+        telemetry.scalar('PTI/Combined Loss', agg_loss / len(target_indices), step)
 
-        description = f'PTI Inversion: {step + 1:>4d}/{num_steps}'
-        description += f" mse: {agg_mse_loss / len(target_indices):<4.2f}"
-        description += f" perc: {agg_perc_loss / len(target_indices):<4.2f}"
-        pbar.set_description(description)
+        pbar.set_description(telemetry.describe(f'PTI Inversion: {step + 1:>4d}/{num_steps}', mse='PTI/MSE Loss',
+                                                perc='PTI/Perceptual Loss'))
 
-        optimizer.step()
+        amp.step(optimizer)
         optimizer.zero_grad(set_to_none=True)
 
         if step == num_steps - 1 or step % 25 == 0:
+            out_params.append(G)
+        if telemetry.preview_due(step, num_steps):
             for i in target_indices:
-                out_params.append(copy.deepcopy(G).eval().requires_grad_(False).cpu())
-                with torch.no_grad():
-                    synth_image = G.synthesis(w_pivot, c=images[i].c_item.c, noise_mode='const')['image']
+                with torch.no_grad(), amp.autocast():
+                    synth_image = synthesis(w_pivot, c=images[i].c_item.c, noise_mode='const')['image']
                     synth_image = (synth_image + 1) * (255 / 2)
                     synth_image = synth_image.clamp(0, 255).to(torch.uint8)[0]
-                target_image = ((images[i].target_tensor[0] + 1) * (255 / 2)).to(torch.uint8)
+                target_image = ((target_batch(images, [i])[0] + 1) * (255 / 2)).to(torch.uint8)
                 synth_image_comb = torch.concat([target_image, synth_image], dim=-1)
-                writer.add_image(f"PTI/Inversion {i}", synth_image_comb, global_step=step)
+                telemetry.image(f"PTI/Inversion {i}", synth_image_comb, step)
 
                 if i == 0:
-                    synth_image = synth_image.permute(1, 2, 0).cpu().numpy()
-                    PIL.Image.fromarray(synth_image, 'RGB').save(f'{outdir}/PIT_{step}.png')
+                    telemetry.save_image(f'{outdir}/PIT_{step}.png', synth_image)
+        telemetry.step(step)
 
+    telemetry.finish()
     return out_params
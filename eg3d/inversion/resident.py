@@ -0,0 +1,31 @@
+import copy
+from typing import Callable, Hashable
+
+import dnnlib
+import legacy
+
+_objects = {}
+
+
+def resident(key: Hashable, build: Callable):
+    # Object built once per process and shared by every later job asking for the same key.
+    # Only stateless models belong here: networks that jobs copy before optimizing, loss and metric models.
+    if key not in _objects:
+        _objects[key] = build()
+    return _objects[key]
+
+
+def shared_network_data(network_pkl: str) -> dict:
+    # Network pickle loaded once per process and shared by every job, so it must only be read.
+    def build():
+        with dnnlib.util.open_url(network_pkl) as fp:
+            return legacy.load_network_pkl(fp)
+    return resident(("network", network_pkl), build)
+
+
+def load_network_data(network_pkl: str) -> dict:
+    # Each caller gets its own dict and its own G_ema, which jobs move between devices and reconfigure
+    # (rendering_kwargs, requires_grad). The other entries are shared and must only be read.
+    network_data = dict(shared_network_data(network_pkl))
+    network_data["G_ema"] = copy.deepcopy(network_data["G_ema"])
+    return network_data
@@ -0,0 +1,139 @@
+import copy
+import hashlib
+import json
+import os
+import uuid
+from typing import Dict
+
+import numpy as np
+import torch
+
+import dnnlib
+from inversion.resident import resident, shared_network_data
+from inversion.utils import network_hash
+from torch_utils import misc
+
+RESULT_FILE = "pti_result.bin"
+_MAGIC = b"PTIRES01"
+_ALIGN = 64
+
+
+def _float_tensors(G):
+    return [(name, tensor) for name, tensor in misc.named_params_and_buffers(G) if tensor.is_floating_point()]
+
+
+def _base_hash(network_pkl: str) -> str:
+    # Hashing every weight of G takes a while, so the hash of a pickle file is computed once and cached on disk,
+    # keyed by its path, size and modification time.
+    def compute():
+        if dnnlib.util.is_url(network_pkl, allow_file_urls=True):
+            key = network_pkl
+        else:
+            stat = os.stat(network_pkl)
+            key = f"{os.path.abspath(network_pkl)}:{stat.st_size}:{stat.st_mtime_ns}"
+        cache_file = dnnlib.make_cache_dir_path("network-hash", hashlib.md5(key.encode("utf-8")).hexdigest() + ".txt")
+        if os.path.isfile(cache_file):
+            with open(cache_file) as f:
+                return f.read().strip()
+        value = network_hash(shared_network_data(network_pkl)["G_ema"])
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        temp_file = cache_file + "." + uuid.uuid4().hex
+        with open(temp_file, "w") as f:
+            f.write(value)
+        os.replace(temp_file, cache_file)  # atomic
+        return value
+    return resident(("network_hash", network_pkl), compute)
+
+
+def _network_location(network_pkl: str) -> str:
+    # Local pickles are stored by absolute path, so results load from any working directory.
+    return network_pkl if dnnlib.util.is_url(network_pkl, allow_file_urls=True) else os.path.abspath(network_pkl)
+
+
+def _resolve_network(network_pkl: str, path: str) -> str:
+    # Older result files stored the path as given on the command line; it is tried relative to the run dir as well.
+    if dnnlib.util.is_url(network_pkl, allow_file_urls=True) or os.path.isabs(network_pkl) or \
+            os.path.exists(network_pkl):
+        return network_pkl
+    return os.path.join(os.path.dirname(os.path.abspath(path)), network_pkl)
+
+
+def save_result(path: str, G_final, network_pkl: str, latents: Dict[str, np.ndarray], half: bool = False):
+    # Stores a fine-tuned generator as its weight delta against the base pickle, together with the final latents.
+    # Layout: magic, header length, JSON header, then every array at an aligned offset so the file can be memory-mapped.
+    G_base = shared_network_data(network_pkl)["G_ema"]
+    base_tensors = dict(misc.named_params_and_buffers(G_base))
+    arrays = []
+    for name, tensor in _float_tensors(G_final):
+        delta = tensor.detach().cpu().float() - base_tensors[name].detach().cpu().float()
+        arrays.append(("delta/" + name, delta.numpy().astype(np.float16 if half else np.float32)))
+    for name, value in latents.items():
+        arrays.append(("latent/" + name, np.ascontiguousarray(value, dtype=np.float32)))
+
+    entries = []
+    offset = 0
+    for name, array in arrays:
+        entries.append({"name": name, "shape": list(array.shape), "dtype": array.dtype.str, "offset": offset})
+        offset += -(-array.nbytes // _ALIGN) * _ALIGN
+    header = json.dumps({
+        "network_pkl": _network_location(network_pkl),
+        "network_hash": _base_hash(network_pkl),
+        "entries": entries
+    }).encode("utf-8")
+    data_start = -(-(len(_MAGIC) + 8 + len(header)) // _ALIGN) * _ALIGN
+
+    temp_file = path + "." + uuid.uuid4().hex
+    with open(temp_file, "wb") as f:
+        f.write(_MAGIC)
+        f.write(len(header).to_bytes(8, "little"))
+        f.write(header)
+        for entry, (_, array) in zip(entries, arrays):
+            f.seek(data_start + entry["offset"])
+            f.write(array.tobytes())
+    os.replace(temp_file, path)  # atomic
+
+
+def _read_header(path: str):
+    with open(path, "rb") as f:
+        if f.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError(f"{path} is not a PTI result file")
+        header_length = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_length).decode("utf-8"))
+    data_start = -(-(len(_MAGIC) + 8 + header_length) // _ALIGN) * _ALIGN
+    return header, data_start
+
+
+def _entry(path: str, entry: dict, data_start: int) -> np.ndarray:
+    if int(np.prod(entry["shape"])) == 0:
+        return np.zeros(entry["shape"], dtype=np.dtype(entry["dtype"]))
+    return np.memmap(path, dtype=np.dtype(entry["dtype"]), mode="r", offset=data_start + entry["offset"],
+                     shape=tuple(entry["shape"]))
+
+
+def load_latents(path: str) -> Dict[str, np.ndarray]:
+    # Final latents of a result file, with the same keys as the projected_w .npz checkpoints.
+    header, data_start = _read_header(path)
+    return {entry["name"][len("latent/"):]: np.array(_entry(path, entry, data_start))
+            for entry in header["entries"] if entry["name"].startswith("latent/")}
+
+
+def load_result(path: str):
+    # Fine-tuned generator (on the CPU) and final latents of a result file.
+    # The base pickle stays loaded for the process, so only the memory-mapped deltas are read per result.
+    header, data_start = _read_header(path)
+    network_pkl = _resolve_network(header["network_pkl"], path)
+    if _base_hash(network_pkl) != header["network_hash"]:
+        raise ValueError(f"{path} was fine-tuned from a different version of {network_pkl}")
+
+    G = copy.deepcopy(shared_network_data(network_pkl)["G_ema"]).cpu().eval().requires_grad_(False)
+    tensors = dict(_float_tensors(G))
+    latents = {}
+    with torch.no_grad():
+        for entry in header["entries"]:
+            array = _entry(path, entry, data_start)
+            kind, name = entry["name"].split("/", 1)
+            if kind == "delta":
+                tensors[name].add_(torch.from_numpy(np.asarray(array, dtype=np.float32)).to(tensors[name].dtype))
+            else:
+                latents[name] = np.array(array)
+    return G, latents
@@ -0,0 +1,70 @@
+import copy
+import os
+from typing import Optional
+
+import numpy as np
+import torch
+
+from torch_utils import misc
+
+
+class SnapshotStore:
+    """Stores generator snapshots as flat parameter deltas against the pivot generator.
+
+    Generators are rebuilt one at a time when a snapshot is requested.
+    """
+
+    def __init__(self, G_pivot, half: bool = False, mmap_path: Optional[str] = None):
+        self._template = copy.deepcopy(G_pivot).eval().requires_grad_(False).cpu()
+        self._names = [name for name, tensor in misc.named_params_and_buffers(self._template) if tensor.is_floating_point()]
+        self._base = self._flatten(self._template)
+        self._dtype = np.float16 if half else np.float32
+        self._mmap_path = mmap_path
+        self._deltas = []  # arrays in memory, or byte offsets into the memory-mapped file
+        self._last_exact = None  # fp32 delta of the latest snapshot, so the final generator is never rounded
+        if mmap_path is not None:
+            open(mmap_path, 'wb').close()
+
+    def _flatten(self, G):
+        tensors = dict(misc.named_params_and_buffers(G))
+        return torch.cat([tensors[name].detach().reshape(-1).float() for name in self._names]).cpu()
+
+    def append(self, G):
+        delta = self._flatten(G) - self._base
+        self._last_exact = delta
+        delta = delta.numpy().astype(self._dtype)
+        if self._mmap_path is None:
+            self._deltas.append(delta)
+        else:
+            offset = os.path.getsize(self._mmap_path)
+            with open(self._mmap_path, 'ab') as f:
+                f.write(delta.tobytes())
+            self._deltas.append(offset)
+
+    def _delta(self, index):
+        if index == len(self) - 1:
+            return self._last_exact
+        entry = self._deltas[index]
+        if self._mmap_path is not None:
+            entry = np.memmap(self._mmap_path, dtype=self._dtype, mode='r', offset=entry, shape=(self._base.numel(),))
+        return torch.from_numpy(np.asarray(entry, dtype=np.float32))
+
+    def __len__(self):
+        return len(self._deltas)
+
+    def __getitem__(self, index):
+        index = range(len(self))[index]
+        params = self._base + self._delta(index)
+        G = copy.deepcopy(self._template)
+        tensors = dict(misc.named_params_and_buffers(G))
+        offset = 0
+        with torch.no_grad():
+            for name in self._names:
+                tensor = tensors[name]
+                tensor.copy_(params[offset:offset + tensor.numel()].view_as(tensor))
+                offset += tensor.numel()
+        return G
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
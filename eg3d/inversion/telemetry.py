@@ -0,0 +1,172 @@
+import queue
+import threading
+import traceback
+from collections import defaultdict
+from typing import Callable, Dict, List
+
+import numpy as np
+import PIL.Image
+import torch
+
+
+class Telemetry:
+    """Logging for optimization loops that never waits for the device or for disk.
+
+    Scalars stay on the device and are read back in one copy per flush; images, plots and checkpoints are copied to the
+    host asynchronously and written by a background thread.
+    """
+
+    def __init__(self, writer, scalar_every: int = 1, flush_every: int = 25, preview_every: int = 25,
+                 max_pending: int = 16, max_pooled: int = 4):
+        self.writer = writer
+        self.scalar_every = scalar_every
+        self.flush_every = flush_every
+        self.preview_every = preview_every
+        self.latest: Dict[str, float] = {}  # last written value of every scalar, for progress bars
+        self.num_dropped = 0
+        self._scalars = []
+        self._owned = False
+        # Pinned host buffers by (shape, dtype), reused once the writer thread is done with them.
+        self._pool: Dict[tuple, List[torch.Tensor]] = defaultdict(list)
+        self._pool_lock = threading.Lock()
+        self._max_pooled = max_pooled
+        # Bounded, so a writer that cannot keep up costs dropped previews instead of host memory.
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def wrap(cls, writer) -> "Telemetry":
+        # Optimization loops accept a SummaryWriter or a Telemetry; a telemetry created here belongs to the loop.
+        if isinstance(writer, Telemetry):
+            return writer
+        telemetry = cls(writer)
+        telemetry._owned = True
+        return telemetry
+
+    def scalar(self, tag: str, value, step: int):
+        if step % self.scalar_every != 0:
+            return
+        if isinstance(value, torch.Tensor):
+            value = value.detach().float().reshape(())
+        self._scalars.append((tag, value, step))
+
+    def step(self, step: int):
+        # Called once at the end of every optimization step.
+        if (step + 1) % self.flush_every == 0:
+            self.flush()
+
+    def flush(self):
+        if len(self._scalars) == 0:
+            return
+        tags, values, steps = zip(*self._scalars)
+        self._scalars = []
+        tensors = [value for value in values if isinstance(value, torch.Tensor)]
+        stacked = torch.stack([t.to(tensors[0].device) for t in tensors]) if len(tensors) > 0 else None
+
+        def write(stacked):
+            read = iter(stacked.tolist() if stacked is not None else [])
+            for tag, value, step in zip(tags, values, steps):
+                value = next(read) if isinstance(value, torch.Tensor) else float(value)
+                self.writer.add_scalar(tag, value, step)
+                self.latest[tag] = value
+        self._submit(write, stacked)
+
+    def describe(self, prefix: str, **tags: str) -> str:
+        # Progress bar text from the latest written scalars; it lags behind by up to flush_every steps.
+        description = prefix
+        for name, tag in tags.items():
+            if tag in self.latest:
+                description += f" {name}: {self.latest[tag]:<4.2f}"
+        return description
+
+    def preview_due(self, step: int, num_steps: int) -> bool:
+        return step % self.preview_every == 0 or step == num_steps - 1
+
+    def image(self, tag: str, image: torch.Tensor, step: int):
+        # image: [C, H, W] uint8
+        self._submit(lambda image: self.writer.add_image(tag, image, global_step=step), image, droppable=True)
+
+    def save_image(self, path: str, image: torch.Tensor):
+        # image: [C, H, W] uint8
+        self._submit(lambda image: PIL.Image.fromarray(image.transpose(1, 2, 0), 'RGB').save(path), image,
+                     droppable=True)
+
+    def save_npz(self, path: str, **arrays):
+        self._submit(lambda *values: np.savez(path, **dict(zip(arrays.keys(), values))), *arrays.values())
+
+    def call(self, fn: Callable, *args, droppable: bool = True):
+        # Runs fn on the writer thread with the tensors among args as numpy arrays, e.g. to render a plot.
+        self._submit(fn, *args, droppable=droppable)
+
+    def _submit(self, fn: Callable, *args, droppable: bool = False):
+        args = [self._to_host(arg) for arg in args]
+        event = None
+        if any(isinstance(arg, torch.Tensor) for arg in args) and torch.cuda.is_available():
+            event = torch.cuda.Event()
+            event.record()
+        job = (fn, args, event)
+        if droppable:
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                self.num_dropped += 1
+                self._release(args)
+        else:
+            self._queue.put(job)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            fn, args, event = job
+            try:
+                if event is not None:
+                    event.synchronize()
+                fn(*[arg.numpy() if isinstance(arg, torch.Tensor) else arg for arg in args])
+            except Exception:
+                traceback.print_exc()
+            self._release(args)
+
+    def _to_host(self, value):
+        # Snapshot of a tensor on the host. Device tensors are copied into a pooled pinned buffer without waiting; the
+        # copy is ordered before any later in-place update of the tensor, and the writer thread waits for it. Host
+        # tensors are cloned.
+        if not isinstance(value, torch.Tensor):
+            return value
+        value = value.detach()
+        if value.device.type != 'cuda':
+            return value.clone()
+        with self._pool_lock:
+            buffers = self._pool[(tuple(value.shape), value.dtype)]
+            host = buffers.pop() if len(buffers) > 0 else None
+        if host is None:
+            host = torch.empty(value.shape, dtype=value.dtype, pin_memory=True)
+        host.copy_(value, non_blocking=True)
+        return host
+
+    def _release(self, args):
+        # Returns the pinned buffers of a finished or dropped job to the pool; fn must not keep its arrays. The pending
+        # copy into a dropped job's buffer is ordered on the stream before the buffer's next copy.
+        with self._pool_lock:
+            for arg in args:
+                if isinstance(arg, torch.Tensor) and arg.is_pinned():
+                    buffers = self._pool[(tuple(arg.shape), arg.dtype)]
+                    if len(buffers) < self._max_pooled:
+                        buffers.append(arg)
+
+    def finish(self):
+        # End of an optimization loop: pending scalars are written, and a telemetry owned by the loop is closed.
+        self.flush()
+        if self._owned:
+            self.close()
+
+    def close(self):
+        # Waits until everything submitted so far is written.
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+        if self.num_dropped > 0:
+            print(f"Telemetry: dropped {self.num_dropped} previews because the writer could not keep up")
+
@@ -1,23 +1,98 @@
+import hashlib
+import os
+import uuid
 from typing import List
 from tqdm import tqdm
 import torch.nn.functional as F
 import numpy as np
 import torch
 
+import dnnlib
 from camera_utils import LookAtPoseSampler
-from inversion.load_data import ImageItem, CamItem
+from torch_utils import misc
+from training.triplane import TriPlaneGenerator
+from inversion.load_data import ImageItem
+from inversion.custom_vgg import NvidiaVGG16
+from inversion.loss import IDLoss
+from inversion.resident import resident
+from inversion.feature_store import dataset_store
+from inversion.poses import PoseTable
 
 
-def create_vgg_features(images: List[ImageItem], vgg, downsampling=True, verbose=True):
+def reload_modules(G):
+    # Rebuild the generator from the current source so code changes take effect; pickles carry their own code.
+    G_new = TriPlaneGenerator(*G.init_args, **G.init_kwargs)
+    misc.copy_params_and_buffers(G, G_new, require_all=True)
+    G_new.neural_rendering_resolution = G.neural_rendering_resolution
+    G_new.rendering_kwargs = G.rendering_kwargs
+    return G_new
+
+
+def cache_cameras(G, size: int = 64):
+    # The target camera tensors are rendered at every step, so their rays are kept on the device (RaySampler camera
+    # cache). Cameras that are optimized bypass the cache.
+    G.ray_sampler.camera_cache_size = size
+    return G
+
+
+def loss_models(device):
+    # Perceptual and identity loss models; they hold no state, so one instance per device serves every job.
+    vgg = resident(("NvidiaVGG16", str(device)), lambda: NvidiaVGG16(device=device))
+    id_loss_model = resident(("IDLoss", str(device)), lambda: IDLoss(device=device).requires_grad_(False))
+    return vgg, id_loss_model
+
+
+def create_vgg_features(images: List[ImageItem], vgg, downsampling=True, verbose=True, use_store=True):
+    tag = f"{type(vgg).__name__}_{'downsampled' if downsampling else 'full'}"
     images = tqdm(images, desc="Creating Features") if verbose else images
     for img_item in images:
-        img = img_item.target_tensor
-        if img.shape[2] > 256 and downsampling:
-            img = F.interpolate(img, size=(256, 256), mode='area')
-        img_item.feature = vgg(img).detach().cpu()
+        def compute():
+            img = img_item.target_tensor
+            if img.shape[2] > 256 and downsampling:
+                img = F.interpolate(img, size=(256, 256), mode='area')
+            return vgg(img)
+
+        if use_store:
+            img_item.feature = dataset_store(img_item.file_name).get_or_compute(tag, img_item.content_hash, compute)
+        else:
+            img_item.feature = compute().detach().cpu()
+
+
+def create_id_features(images: List[ImageItem], id_loss_model, verbose=True, use_store=True):
+    images = tqdm(images, desc="Creating ID Features") if verbose else images
+    for img_item in images:
+        def compute():
+            with torch.no_grad():
+                return id_loss_model.extract_feats(img_item.target_tensor)
+
+        if use_store:
+            feature = dataset_store(img_item.file_name).get_or_compute("IDLoss", img_item.content_hash, compute)
+        else:
+            feature = compute()
+        img_item.id_feature = feature.to(img_item.device)
 
 
-def create_w_stats(G, w_avg_samples: int, device):
+def network_hash(module) -> str:
+    md5 = hashlib.md5()
+    for name, tensor in misc.named_params_and_buffers(module):
+        md5.update(name.encode('utf-8'))
+        md5.update(tensor.detach().cpu().numpy().tobytes())
+    return md5.hexdigest()
+
+
+def create_w_stats(G, w_avg_samples: int, device, cache=True):
+    # Try to lookup from cache. The stats only depend on the mapping network and the sampling setup.
+    cache_file = None
+    if cache:
+        args = dict(mapping=network_hash(G.backbone.mapping), w_avg_samples=w_avg_samples, seed=123,
+                    c_scale=G.rendering_kwargs.get('c_scale', 0),
+                    c_gen_conditioning_zero=G.rendering_kwargs['c_gen_conditioning_zero'])
+        md5 = hashlib.md5(repr(sorted(args.items())).encode('utf-8'))
+        cache_file = dnnlib.make_cache_dir_path('w-stats', md5.hexdigest() + '.npz')
+        if os.path.isfile(cache_file):
+            stats = np.load(cache_file)
+            return stats['w_avg'], float(stats['w_std'])
+
     print(f'Computing W midpoint and stddev using {w_avg_samples} samples...')
     z_samples = np.random.RandomState(123).randn(w_avg_samples, G.z_dim)
     camera_lookat_point = torch.tensor([0, 0, 0.0], device=device)
@@ -28,28 +103,35 @@ def create_w_stats(G, w_avg_samples: int, device):
     w_samples = w_samples[:, :1, :].cpu().numpy().astype(np.float32)  # [N, 1, C]
     w_avg = np.mean(w_samples, axis=0, keepdims=True)  # [1, 1, C]
     w_std = (np.sum((w_samples - w_avg) ** 2) / w_avg_samples) ** 0.5
-    return w_avg, w_std
-
 
-def interpolate_w_by_cam(ws: List[torch.tensor], cs: List[torch.tensor], c: torch.tensor, device="cuda", verbose=False):
-    angle = torch.tensor([CamItem(c).xz_angle()])
-    cs = torch.tensor([CamItem(cs[i]).xz_angle() for i in range(len(cs))])
-
-    if angle >= torch.max(cs):
-        return ws[-1]
-
-    if angle <= torch.min(cs):
-        return ws[0]
+    # Save to cache.
+    if cache_file is not None:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        temp_file = cache_file + '.' + uuid.uuid4().hex + '.npz'
+        np.savez(temp_file, w_avg=w_avg, w_std=w_std)
+        os.replace(temp_file, cache_file)  # atomic
+    return w_avg, w_std
 
-    cs_diff = torch.abs(cs - angle)
-    closest_index, second_closest_index = torch.argsort(cs_diff)[:2]
-    index_left = torch.minimum(closest_index, second_closest_index)
-    index_right = torch.maximum(closest_index, second_closest_index)
 
-    total_dist = torch.abs(cs[index_left] - cs[index_right])
-    dist_1 = torch.abs(cs[index_left] - angle)
-    mag = torch.clip(dist_1 / total_dist, 0, 1).to(device)
+def interpolate_w_by_cam(ws: List[torch.tensor], cs, c: torch.tensor, device="cuda", verbose=False):
+    # cs is a PoseTable of the anchor cameras, or a list of their camera tensors.
+    table = cs if isinstance(cs, PoseTable) else PoseTable.from_cams(cs)
+    index_left, index_right, mag = table.interpolation_weights(PoseTable(c).yaw)
+    index_left, index_right = int(index_left[0]), int(index_right[0])
+    mag = mag[0].to(device)
     w_int = ws[index_left] * (1 - mag) + ws[index_right] * mag
     if verbose:
         print(f"w{index_left} * {(1 - mag)} + w{index_right} * {mag}")
     return w_int
+
+
+def interpolate_ws_by_cams(ws, cs, c: torch.Tensor, kernel="linear", sigma=0.1) -> torch.Tensor:
+    # Batched interpolate_w_by_cam: blends the K anchor latents ws for each of the M cameras c ([M, 25]).
+    # ws is a [K, ..., num_ws, w_dim] tensor or a list of anchor latents, cs a PoseTable or a list of anchor cameras.
+    # Returns [M, num_ws, w_dim].
+    if isinstance(ws, (list, tuple)):
+        ws = torch.stack(list(ws))
+    ws = ws.reshape(len(ws), -1, ws.shape[-1])
+    table = cs if isinstance(cs, PoseTable) else PoseTable.from_cams(cs)
+    weights = table.blend_weights(PoseTable(c), kernel=kernel, sigma=sigma)
+    return torch.einsum('mk,kld->mld', weights.to(ws), ws)
@@ -1,17 +1,20 @@
 import copy
 from typing import List
 import numpy as np
-import PIL.Image
 import torch
 from tqdm import tqdm
 from torch.utils.tensorboard import SummaryWriter
 
 
-from inversion.utils import create_vgg_features, create_w_stats
+from inversion.utils import loss_models, create_vgg_features, create_id_features, create_w_stats, \
+    reload_modules, cache_cameras
 from inversion.loss import perc, mse, noise_reg, IDLoss
-from inversion.plots import compare_cam_plot
+from inversion.plots import cam_change_plot
+from inversion.compiled import CompiledSynthesis
+from inversion.precision import Precision
+from inversion.telemetry import Telemetry
 from inversion.custom_vgg import CustomVGG, NvidiaVGG16
-from inversion.load_data import ImageItem
+from inversion.load_data import ImageItem, target_batch
 
 
 def project(
@@ -32,25 +35,40 @@ def project(
         optimize_cam=False,
         target_indices,
         downsampling=True,
-        writer: SummaryWriter,
-        w_plus: bool = True
+        writer: SummaryWriter,  # or Telemetry
+        w_plus: bool = True,
+        batch_views: bool = False,
+        precision: str = "fp32",
+        compiled: bool = False
 ):
-    assert images[0].target_tensor[0].shape == (G.img_channels, G.img_resolution, G.img_resolution)
+    # Only the frames used for optimization are decoded and get features.
+    used_images = [images[i] for i in target_indices]
+    assert used_images[0].target_tensor[0].shape == (G.img_channels, G.img_resolution, G.img_resolution)
 
-    G = copy.deepcopy(G).eval().requires_grad_(False).to(device)
+    if batch_views:
+        # The pickled code cannot broadcast one latent over several cameras.
+        G = reload_modules(G).eval().requires_grad_(False).to(device)
+    else:
+        G = copy.deepcopy(G).eval().requires_grad_(False).to(device)
+    cache_cameras(G)
     w_avg, w_std = create_w_stats(G, w_avg_samples, device)
+    amp = Precision(precision, device)
+    synthesis = CompiledSynthesis(G, enabled=compiled)
 
     # Setup noise inputs.
     noise_bufs = {name: buf for (name, buf) in G.backbone.synthesis.named_buffers() if 'noise_const' in name}
 
-    vgg = NvidiaVGG16(device)
-    create_vgg_features(images, vgg, downsampling=downsampling)
-    id_loss_model = IDLoss()
+    vgg, id_loss_model = loss_models(device)
+    create_vgg_features(used_images, vgg, downsampling=downsampling)
+    create_id_features(used_images, id_loss_model)
 
     w_avg = torch.tensor(w_avg, dtype=torch.float32, device=device).repeat(1, G.backbone.mapping.num_ws, 1)
     w_opt = w_avg.detach().clone()
     w_opt.requires_grad = True
-    w_out = torch.zeros([num_steps] + list(w_opt.shape[1:]), dtype=torch.float32, device="cpu")
+    # Pinned, so the per-step copies of w_opt do not wait for the device.
+    w_out = torch.zeros([num_steps] + list(w_opt.shape[1:]), dtype=torch.float32, device="cpu",
+                        pin_memory=w_opt.is_cuda)
+    telemetry = Telemetry.wrap(writer)
 
     trainable_vars = [w_opt]
     if optimize_noise:
@@ -61,7 +79,8 @@ def project(
     # optimize camera parameters of input data
     cam_parameters = []
     for img in images:
-        img.c_item.c.requires_grad = True
+        # Fixed cameras do not require grad, so their rays can be cached.
+        img.c_item.c.requires_grad = optimize_cam
         cam_parameters.append(img.c_item.c)
     cam_optimizer = torch.optim.Adam(cam_parameters, lr=0.0001)
 
@@ -71,6 +90,9 @@ def project(
             buf[:] = torch.randn_like(buf)
             buf.requires_grad = True
 
+    # Fixed cameras are concatenated once, so the camera cache finds the same tensor at every step.
+    cams = torch.cat([images[i].c_item.c for i in target_indices]).detach()
+
     pbar = tqdm(range(num_steps))
     for step in pbar:
         # Learning rate schedule.
@@ -92,63 +114,101 @@ def project(
         agg_id_loss = 0
         agg_loss = 0
 
-        for i in target_indices:
-            # Synth images from opt_w.
+        if batch_views:
+            # Run the backbone once and render all target views in a single batch.
+            num_views = len(target_indices)
             w_noise = torch.randn_like(w_opt) * w_noise_scale
             ws = w_opt + w_noise
-            synth_image = G.synthesis(ws, c=images[i].c_item.c, noise_mode='const')['image']
+            if optimize_cam:
+                cams = torch.cat([images[i].c_item.c for i in target_indices])
+            target_images = target_batch(images, target_indices)
+            target_features = torch.cat([images[i].feature for i in target_indices])
+            target_id_features = torch.cat([images[i].id_feature for i in target_indices])
 
-            perc_loss = perc(images[i].feature, synth_image, vgg=vgg, downsampling=downsampling)
-            mse_loss = mse(images[i].target_tensor, synth_image)
+            # All losses are per-view means; scaling by num_views gives the gradient of the per-view loop.
+            with amp.autocast():
+                synth_images = synthesis(ws, c=cams, noise_mode='const')['image']
+                perc_loss = perc(target_features, synth_images, vgg=vgg, downsampling=downsampling) / num_views
+                mse_loss = mse(target_images, synth_images)
+                id_loss = id_loss_model(synth_image=synth_images, target_feats=target_id_features)
             w_norm_loss = mse(w_opt, w_avg)
-            id_loss = id_loss_model(synth_image=synth_image, target_image=images[i].target_tensor)
 
-            # Noise regularization.
             reg_loss = 0
             if optimize_noise:
                 reg_loss = noise_reg(noise_bufs)
 
             if optimize_cam_step:
                 loss = mse_loss
-                loss.backward()
-                cam_optimizer.step()
+                amp.backward(loss * num_views)
+                amp.step(cam_optimizer)
                 cam_optimizer.zero_grad(set_to_none=True)
             else:
                 loss = 0.1 * mse_loss + perc_loss + 1.0 * w_norm_loss + reg_loss * regularize_noise_weight + id_loss
-                loss.backward()
+                amp.backward(loss * num_views)
+
+            agg_mse_loss = mse_loss * num_views
+            agg_perc_loss = perc_loss * num_views
+            agg_w_norm_loss = w_norm_loss * num_views
+            agg_reg_loss = reg_loss * num_views
+            agg_id_loss = id_loss * num_views
+            agg_loss = loss * num_views
+        else:
+            for i in target_indices:
+                # Synth images from opt_w.
+                w_noise = torch.randn_like(w_opt) * w_noise_scale
+                ws = w_opt + w_noise
+                with amp.autocast():
+                    synth_image = synthesis(ws, c=images[i].c_item.c, noise_mode='const')['image']
+                    perc_loss = perc(images[i].feature, synth_image, vgg=vgg, downsampling=downsampling)
+                    mse_loss = mse(target_batch(images, [i]), synth_image)
+                    id_loss = id_loss_model(synth_image=synth_image, target_feats=images[i].id_feature)
+                w_norm_loss = mse(w_opt, w_avg)
 
-            agg_mse_loss += mse_loss
-            agg_perc_loss += perc_loss
-            agg_w_norm_loss += w_norm_loss
-            agg_reg_loss += reg_loss
-            agg_id_loss = id_loss
-            agg_loss += loss
+                # Noise regularization.
+                reg_loss = 0
+                if optimize_noise:
+                    reg_loss = noise_reg(noise_bufs)
+
+                if optimize_cam_step:
+                    loss = mse_loss
+                    amp.backward(loss)
+                    amp.step(cam_optimizer)
+                    cam_optimizer.zero_grad(set_to_none=True)
+                else:
+                    loss = 0.1 * mse_loss + perc_loss + 1.0 * w_norm_loss + reg_loss * regularize_noise_weight + id_loss
+                    amp.backward(loss)
+
+                agg_mse_loss += mse_loss
+                agg_perc_loss += perc_loss
+                agg_w_norm_loss += w_norm_loss
+                agg_reg_loss += reg_loss
+                agg_id_loss = id_loss
+                agg_loss += loss
 
         if optimize_cam_step:
-            pbar.set_description(f'W Inversion Camera Optimisation: {step + 1:>4d}/{num_steps} mse: {agg_mse_loss / len(target_indices):<4.2f}')
-            writer.add_scalar('CAM/MSE Loss', agg_mse_loss/ len(target_indices), step)
-            current_cams = torch.cat([images[i].c_item.c for i in target_indices])
+            pbar.set_description(telemetry.describe(f'W Inversion Camera Optimisation: {step + 1:>4d}/{num_steps}',
+                                                    mse='CAM/MSE Loss'))
+            telemetry.scalar('CAM/MSE Loss', agg_mse_loss / len(target_indices), step)
+            current_cams = torch.cat([images[i].c_item.c for i in target_indices]).detach()
             original_cams = torch.cat([images[i].original_c_item.c for i in target_indices])
-            writer.add_scalar('CAM/Absolute Camera Change', torch.sum(torch.abs(current_cams - original_cams)).detach().cpu().numpy(), step)
-            compare_cam_plot([images[i] for i in target_indices], save_path=outdir + f"/{step}_cam_plot.png")
+            telemetry.scalar('CAM/Absolute Camera Change', torch.sum(torch.abs(current_cams - original_cams)), step)
+            if telemetry.preview_due(step, num_steps):
+                telemetry.call(cam_change_plot, current_cams, original_cams, outdir + f"/{step}_cam_plot.png")
         else:
-            description = f'W Inversion: {step + 1:>4d}/{num_steps}'
-            description += f" mse: {agg_mse_loss / len(target_indices):<4.2f}"
-            description += f" perc: {agg_perc_loss / len(target_indices):<4.2f}"
-            description += f" w_norm: {agg_w_norm_loss / len(target_indices):<4.2f}"
-            pbar.set_description(description)
-
-            writer.add_scalar('W/MSE Loss', agg_mse_loss / len(target_indices), step)
-            writer.add_scalar('W/Perceptual Loss', agg_perc_loss / len(target_indices), step)
-            writer.add_scalar('W/Dist to Avg Loss', agg_w_norm_loss / len(target_indices), step)
-            writer.add_scalar('W/ID Loss', agg_id_loss / len(target_indices), step)
-            writer.add_scalar('W/Combined Loss', agg_loss / len(target_indices), step)
-
-            optimizer.step()
+            pbar.set_description(telemetry.describe(f'W Inversion: {step + 1:>4d}/{num_steps}', mse='W/MSE Loss',
+                                                    perc='W/Perceptual Loss', w_norm='W/Dist to Avg Loss'))
+
+            telemetry.scalar('W/MSE Loss', agg_mse_loss / len(target_indices), step)
+            telemetry.scalar('W/Perceptual Loss', agg_perc_loss / len(target_indices), step)
+            telemetry.scalar('W/Dist to Avg Loss', agg_w_norm_loss / len(target_indices), step)
+            telemetry.scalar('W/ID Loss', agg_id_loss / len(target_indices), step)
+            telemetry.scalar('W/Combined Loss', agg_loss / len(target_indices), step)
+
+            amp.step(optimizer)
             optimizer.zero_grad(set_to_none=True)
 
         # Save projected W for each optimization step.
-        w_out[step] = w_opt.detach().cpu()[0]
+        w_out[step].copy_(w_opt.detach()[0], non_blocking=True)
 
         # Normalize noise.
         if optimize_noise:
@@ -157,22 +217,157 @@ def project(
                     buf -= buf.mean()
                     buf *= buf.square().mean().rsqrt()
 
-        if step % 25 == 0 or step == num_steps - 1:
+        if telemetry.preview_due(step, num_steps):
             for i in target_indices:
-                with torch.no_grad():
-                    synth_image = G.synthesis(w_opt, c=images[i].c_item.c, noise_mode='const')['image']
+                with torch.no_grad(), amp.autocast():
+                    synth_image = synthesis(w_opt, c=images[i].c_item.c, noise_mode='const')['image']
                     synth_image = (synth_image + 1) * (255 / 2)
                     synth_image = synth_image.clamp(0, 255).to(torch.uint8)[0]
-                target_image = ((images[i].target_tensor[0] + 1) * (255 / 2)).to(torch.uint8)
+                target_image = ((target_batch(images, [i])[0] + 1) * (255 / 2)).to(torch.uint8)
                 synth_image_comb = torch.concat([target_image, synth_image], dim=-1)
-                writer.add_image(f"W/Inversion {i}", synth_image_comb, global_step=step)
+                telemetry.image(f"W/Inversion {i}", synth_image_comb, step)
 
                 if i == 0:
-                    synth_image = synth_image.permute(1, 2, 0).cpu().numpy()
-                    PIL.Image.fromarray(synth_image, 'RGB').save(f'{outdir}/{step}.png')
-            np.savez(f'{outdir}/{step}_projected_w.npz', w=w_opt.detach().cpu().numpy())
+                    telemetry.save_image(f'{outdir}/{step}.png', synth_image)
+        if step % 25 == 0 or step == num_steps - 1:
+            telemetry.save_npz(f'{outdir}/{step}_projected_w.npz', w=w_opt)
+        telemetry.step(step)
 
+    telemetry.finish()
+    if w_opt.is_cuda:
+        torch.cuda.synchronize()  # last copies into w_out
     if w_out.shape[1] == 1:
         w_out = w_out.repeat([1, G.mapping.num_ws, 1])
 
     return w_out
+
+
+def project_subjects(
+        G,
+        subjects: List[List[ImageItem]],
+        *,
+        target_indices: List[List[int]],
+        num_steps=1000,
+        w_avg_samples=10000,
+        initial_learning_rate=0.1,
+        initial_noise_factor=0.05,
+        lr_rampdown_length=0.25,
+        lr_rampup_length=0.05,
+        noise_ramp_length=0.75,
+        device: torch.device,
+        outdirs: List[str],
+        downsampling=True,
+        writers: List[SummaryWriter],  # or Telemetry
+        precision: str = "fp32",
+        compiled: bool = False
+):
+    # W inversion of several subjects at once. The latents of all subjects are stacked along the batch dimension,
+    # and the target views of all subjects are rendered by one G.synthesis call per step. With the same number of
+    # views per subject, the backbone runs once per subject and its planes are shared by the subject's views.
+    # Losses are summed per subject, so each subject optimizes the same objective as project(batch_views=True)
+    # (Adam is element-wise). Camera and noise optimization are not supported.
+    # Returns the projected W of every step and subject, [num_steps, num_subjects, num_ws, w_dim].
+    num_subjects = len(subjects)
+    used_images = [images[i] for images, indices in zip(subjects, target_indices) for i in indices]
+    assert used_images[0].target_tensor[0].shape == (G.img_channels, G.img_resolution, G.img_resolution)
+
+    # The pickled code cannot share the planes of a latent between several cameras.
+    G = cache_cameras(reload_modules(G).eval().requires_grad_(False).to(device))
+    w_avg, w_std = create_w_stats(G, w_avg_samples, device)
+    amp = Precision(precision, device)
+    synthesis = CompiledSynthesis(G, enabled=compiled)
+
+    vgg, id_loss_model = loss_models(device)
+    create_vgg_features(used_images, vgg, downsampling=downsampling)
+    create_id_features(used_images, id_loss_model)
+
+    # Subject of every target view, in the order of used_images.
+    view_subject = torch.tensor([s for s, indices in enumerate(target_indices) for _ in indices], device=device)
+    num_views = torch.bincount(view_subject, minlength=num_subjects).float()
+    # Latent index of every view: one per subject if all subjects have the same number of views, else one per view.
+    shared_planes = len(set(len(indices) for indices in target_indices)) == 1
+    view_latent = slice(None) if shared_planes else view_subject
+    cams = torch.cat([img.c_item.c for img in used_images]).detach()
+    target_images = torch.cat([target_batch(images, indices) for images, indices in zip(subjects, target_indices)])
+    target_features = torch.cat([img.feature for img in used_images])
+    target_id_features = torch.cat([img.id_feature for img in used_images])
+
+    w_avg = torch.tensor(w_avg, dtype=torch.float32, device=device).repeat(1, G.backbone.mapping.num_ws, 1)
+    w_opt = w_avg.detach().clone().repeat(num_subjects, 1, 1)
+    w_opt.requires_grad = True
+    w_out = torch.zeros([num_steps] + list(w_opt.shape), dtype=torch.float32, device="cpu",
+                        pin_memory=w_opt.is_cuda)
+    optimizer = torch.optim.Adam([w_opt], betas=(0.9, 0.999), lr=initial_learning_rate)
+    telemetries = [Telemetry.wrap(writer) for writer in writers]
+
+    def per_subject(view_loss):
+        # Mean of per-view losses for every subject.
+        return torch.zeros(num_subjects, device=device).index_add_(0, view_subject, view_loss.detach().float()) / num_views
+
+    pbar = tqdm(range(num_steps))
+    for step in pbar:
+        # Learning rate schedule.
+        t = step / num_steps
+        w_noise_scale = w_std * initial_noise_factor * max(0.0, 1.0 - t / noise_ramp_length) ** 2
+        lr_ramp = min(1.0, (1.0 - t) / lr_rampdown_length)
+        lr_ramp = 0.5 - 0.5 * np.cos(lr_ramp * np.pi)
+        lr_ramp = lr_ramp * min(1.0, t / lr_rampup_length)
+        lr = initial_learning_rate * lr_ramp
+        for param_group in optimizer.param_groups:
+            param_group['lr'] = lr
+
+        w_noise = torch.randn_like(w_opt) * w_noise_scale
+        ws = (w_opt + w_noise)[view_latent]
+
+        # Per-view losses; their sum is the sum of the per-subject objectives.
+        with amp.autocast():
+            synth_images = synthesis(ws, c=cams, noise_mode='const')['image']
+            mse_loss = mse(target_images, synth_images, reduce=False)
+            perc_loss = perc(target_features, synth_images, vgg=vgg, downsampling=downsampling, reduce=False)
+            id_loss = id_loss_model(synth_image=synth_images, target_feats=target_id_features, reduce=False)
+        w_norm_loss = (w_opt - w_avg).square().mean(dim=[1, 2])[view_subject]
+        loss = 0.1 * mse_loss + perc_loss + 1.0 * w_norm_loss + id_loss
+        amp.backward(loss.sum())
+        amp.step(optimizer)
+        optimizer.zero_grad(set_to_none=True)
+
+        subject_losses = {
+            'W/MSE Loss': per_subject(mse_loss),
+            'W/Perceptual Loss': per_subject(perc_loss),
+            'W/Dist to Avg Loss': per_subject(w_norm_loss),
+            'W/ID Loss': per_subject(id_loss),
+            'W/Combined Loss': per_subject(loss)
+        }
+        pbar.set_description(telemetries[0].describe(f'W Inversion ({num_subjects} subjects): {step + 1:>4d}/{num_steps}',
+                                                     mse='W/MSE Loss', perc='W/Perceptual Loss'))
+        for name, values in subject_losses.items():
+            for telemetry, value in zip(telemetries, values):
+                telemetry.scalar(name, value, step)
+
+        # Save projected W for each optimization step.
+        w_out[step].copy_(w_opt.detach(), non_blocking=True)
+
+        if telemetries[0].preview_due(step, num_steps):
+            with torch.no_grad(), amp.autocast():
+                synth_images = synthesis(w_opt[view_latent], c=cams, noise_mode='const')['image']
+                synth_images = ((synth_images + 1) * (255 / 2)).clamp(0, 255).to(torch.uint8)
+            target_uint8 = ((target_images + 1) * (255 / 2)).to(torch.uint8)
+            view = 0
+            for s, indices in enumerate(target_indices):
+                for i in indices:
+                    synth_image_comb = torch.concat([target_uint8[view], synth_images[view]], dim=-1)
+                    telemetries[s].image(f"W/Inversion {i}", synth_image_comb, step)
+                    if i == 0:
+                        telemetries[s].save_image(f'{outdirs[s]}/{step}.png', synth_images[view])
+                    view += 1
+        if step % 25 == 0 or step == num_steps - 1:
+            for s in range(num_subjects):
+                telemetries[s].save_npz(f'{outdirs[s]}/{step}_projected_w.npz', w=w_opt[s:s + 1])
+        for telemetry in telemetries:
+            telemetry.step(step)
+
+    for telemetry in telemetries:
+        telemetry.finish()
+    if w_opt.is_cuda:
+        torch.cuda.synchronize()  # last copies into w_out
+    return w_out
@@ -2,24 +2,33 @@ import numpy as np
 import torch
 from PIL import Image
 from models.mtcnn.mtcnn_pytorch.src.get_nets import PNet, RNet, ONet
-from models.mtcnn.mtcnn_pytorch.src.box_utils import nms, calibrate_box, get_image_boxes, convert_to_square
-from models.mtcnn.mtcnn_pytorch.src.first_stage import run_first_stage
+from models.mtcnn.mtcnn_pytorch.src.box_utils import nms, batched_nms, calibrate_box, get_image_boxes, \
+    get_image_boxes_batch, convert_to_square
+from models.mtcnn.mtcnn_pytorch.src.first_stage import run_first_stage, run_first_stage_batch
 from models.mtcnn.mtcnn_pytorch.src.align_trans import get_reference_facial_points, warp_and_crop_face
 
 device = 'cuda:0'
 
 
 class MTCNN():
-    def __init__(self):
+    def __init__(self, device=device):
         print(device)
-        self.pnet = PNet().to(device)
-        self.rnet = RNet().to(device)
-        self.onet = ONet().to(device)
+        self.device = torch.device(device)
+        self.pnet = PNet().to(self.device)
+        self.rnet = RNet().to(self.device)
+        self.onet = ONet().to(self.device)
         self.pnet.eval()
         self.rnet.eval()
         self.onet.eval()
         self.refrence = get_reference_facial_points(default_square=True)
 
+    def to(self, device):
+        self.device = torch.device(device)
+        self.pnet.to(self.device)
+        self.rnet.to(self.device)
+        self.onet.to(self.device)
+        return self
+
     def align(self, img):
         _, landmarks = self.detect_faces(img)
         if len(landmarks) == 0:
@@ -28,6 +37,30 @@ class MTCNN():
         warped_face, tfm = warp_and_crop_face(np.array(img), facial5points, self.refrence, crop_size=(112, 112))
         return Image.fromarray(warped_face), tfm
 
+    def align_batch(self, images):
+        """
+        Arguments:
+            images: a uint8 tensor of shape [b, 3, h, w].
+
+        Returns:
+            a list of aligned faces (PIL images, None if no face is found)
+            and a list of their transforms.
+        """
+        results = self.detect_faces_batch(images)
+        arrays = images.permute(0, 2, 3, 1).cpu().numpy()
+        faces = []
+        tfms = []
+        for array, (_, landmarks) in zip(arrays, results):
+            if len(landmarks) == 0:
+                faces.append(None)
+                tfms.append(None)
+                continue
+            facial5points = [[landmarks[0][j], landmarks[0][j + 5]] for j in range(5)]
+            warped_face, tfm = warp_and_crop_face(array, facial5points, self.refrence, crop_size=(112, 112))
+            faces.append(Image.fromarray(warped_face))
+            tfms.append(tfm)
+        return faces, tfms
+
     def align_multi(self, img, limit=None, min_face_size=30.0):
         boxes, landmarks = self.detect_faces(img, min_face_size)
         if limit:
@@ -107,7 +140,7 @@ class MTCNN():
             # STAGE 2
 
             img_boxes = get_image_boxes(bounding_boxes, image, size=24)
-            img_boxes = torch.FloatTensor(img_boxes).to(device)
+            img_boxes = torch.FloatTensor(img_boxes).to(self.device)
 
             output = self.rnet(img_boxes)
             offsets = output[0].cpu().data.numpy()  # shape [n_boxes, 4]
@@ -129,7 +162,7 @@ class MTCNN():
             img_boxes = get_image_boxes(bounding_boxes, image, size=48)
             if len(img_boxes) == 0:
                 return [], []
-            img_boxes = torch.FloatTensor(img_boxes).to(device)
+            img_boxes = torch.FloatTensor(img_boxes).to(self.device)
             output = self.onet(img_boxes)
             landmarks = output[0].cpu().data.numpy()  # shape [n_boxes, 10]
             offsets = output[1].cpu().data.numpy()  # shape [n_boxes, 4]
@@ -154,3 +187,116 @@ class MTCNN():
             landmarks = landmarks[keep]
 
         return bounding_boxes, landmarks
+
+    def detect_faces_batch(self, images, min_face_size=20.0,
+                           thresholds=[0.15, 0.25, 0.35],
+                           nms_thresholds=[0.7, 0.7, 0.7]):
+        """
+        Same as detect_faces, for a batch of images. The pyramid is built with
+        tensor interpolation, every net runs once per stage (P-Net once per scale)
+        on all images, and NMS is done for all images at once.
+
+        Arguments:
+            images: a uint8 tensor of shape [b, 3, h, w].
+            min_face_size: a float number.
+            thresholds: a list of length 3.
+            nms_thresholds: a list of length 3.
+
+        Returns:
+            a list with one tuple per image of two float numpy arrays
+            of shapes [n_boxes, 4] and [n_boxes, 10],
+            bounding boxes and facial landmarks.
+        """
+        # the nets follow the images to their device
+        if images.device != self.device:
+            self.to(images.device)
+        images = images.float()
+        num_images = len(images)
+        empty = [([], []) for _ in range(num_images)]
+
+        # BUILD AN IMAGE PYRAMID
+        height, width = images.shape[2:]
+        min_length = min(height, width)
+
+        min_detection_size = 12
+        factor = 0.707  # sqrt(0.5)
+
+        scales = []
+        m = min_detection_size / min_face_size
+        min_length *= m
+
+        factor_count = 0
+        while min_length > min_detection_size:
+            scales.append(m * factor ** factor_count)
+            min_length *= factor
+            factor_count += 1
+
+        # STAGE 1
+
+        with torch.no_grad():
+            outputs = [run_first_stage_batch(images, self.pnet, scale=s, threshold=thresholds[0]) for s in scales]
+            bounding_boxes = np.vstack([boxes for boxes, _ in outputs])
+            groups = np.concatenate([groups for _, groups in outputs])
+
+            keep = batched_nms(bounding_boxes[:, 0:5], groups, nms_thresholds[0])
+            bounding_boxes = bounding_boxes[keep]
+            groups = groups[keep]
+
+            bounding_boxes = calibrate_box(bounding_boxes[:, 0:5], bounding_boxes[:, 5:])
+            bounding_boxes = convert_to_square(bounding_boxes)
+            bounding_boxes[:, 0:4] = np.round(bounding_boxes[:, 0:4])
+
+            # STAGE 2
+
+            img_boxes = get_image_boxes_batch(bounding_boxes, groups, images, size=24)
+            if len(img_boxes) == 0:
+                return empty
+
+            output = self.rnet(img_boxes)
+            offsets = output[0].cpu().data.numpy()  # shape [n_boxes, 4]
+            probs = output[1].cpu().data.numpy()  # shape [n_boxes, 2]
+
+            keep = np.where(probs[:, 1] > thresholds[1])[0]
+            bounding_boxes = bounding_boxes[keep]
+            bounding_boxes[:, 4] = probs[keep, 1].reshape((-1,))
+            offsets = offsets[keep]
+            groups = groups[keep]
+
+            keep = batched_nms(bounding_boxes, groups, nms_thresholds[1])
+            bounding_boxes = bounding_boxes[keep]
+            groups = groups[keep]
+            bounding_boxes = calibrate_box(bounding_boxes, offsets[keep])
+            bounding_boxes = convert_to_square(bounding_boxes)
+            bounding_boxes[:, 0:4] = np.round(bounding_boxes[:, 0:4])
+
+            # STAGE 3
+
+            img_boxes = get_image_boxes_batch(bounding_boxes, groups, images, size=48)
+            if len(img_boxes) == 0:
+                return empty
+            output = self.onet(img_boxes)
+            landmarks = output[0].cpu().data.numpy()  # shape [n_boxes, 10]
+            offsets = output[1].cpu().data.numpy()  # shape [n_boxes, 4]
+            probs = output[2].cpu().data.numpy()  # shape [n_boxes, 2]
+
+            keep = np.where(probs[:, 1] > thresholds[2])[0]
+            bounding_boxes = bounding_boxes[keep]
+            bounding_boxes[:, 4] = probs[keep, 1].reshape((-1,))
+            offsets = offsets[keep]
+            landmarks = landmarks[keep]
+            groups = groups[keep]
+
+            # compute landmark points
+            width = bounding_boxes[:, 2] - bounding_boxes[:, 0] + 1.0
+            height = bounding_boxes[:, 3] - bounding_boxes[:, 1] + 1.0
+            xmin, ymin = bounding_boxes[:, 0], bounding_boxes[:, 1]
+            landmarks[:, 0:5] = np.expand_dims(xmin, 1) + np.expand_dims(width, 1) * landmarks[:, 0:5]
+            landmarks[:, 5:10] = np.expand_dims(ymin, 1) + np.expand_dims(height, 1) * landmarks[:, 5:10]
+
+            bounding_boxes = calibrate_box(bounding_boxes, offsets)
+            keep = batched_nms(bounding_boxes, groups, nms_thresholds[2], mode='min')
+            bounding_boxes = bounding_boxes[keep]
+            landmarks = landmarks[keep]
+            groups = groups[keep]
+
+        return [(bounding_boxes[groups == i], landmarks[groups == i]) for i in range(num_images)]
@@ -1,4 +1,6 @@
 import numpy as np
+import torch
+import torch.nn.functional as F
 from PIL import Image
 
 
@@ -68,6 +70,37 @@ def nms(boxes, overlap_threshold=0.5, mode='union'):
     return pick
 
 
+def batched_nms(boxes, groups, overlap_threshold=0.5, mode='union'):
+    """Non-maximum suppression for the boxes of several images at once.
+
+    Boxes only suppress boxes of the same group: the boxes of every group
+    are shifted by an offset larger than all boxes, so that boxes of
+    different groups never overlap, and nms runs once on all of them.
+
+    Arguments:
+        boxes: a float numpy array of shape [n, 5],
+            where each row is (xmin, ymin, xmax, ymax, score).
+        groups: an int numpy array of shape [n],
+            index of the image each box belongs to.
+        overlap_threshold: a float number.
+        mode: 'union' or 'min'.
+
+    Returns:
+        an int numpy array with indices of the selected boxes,
+            ordered by group and by decreasing score within a group.
+    """
+
+    if len(boxes) == 0:
+        return np.zeros((0,), 'int64')
+
+    offsets = groups * (boxes[:, 0:4].max() - boxes[:, 0:4].min() + 2.0)
+    shifted = boxes[:, 0:5].astype('float64')
+    shifted[:, 0:4] += offsets[:, None]
+
+    pick = np.array(nms(shifted, overlap_threshold, mode), 'int64')
+    return pick[np.argsort(groups[pick], kind='stable')]
+
+
 def convert_to_square(bboxes):
     """Convert bounding boxes to a square form.
 
@@ -159,6 +192,169 @@ def get_image_boxes(bounding_boxes, img, size=24):
     return img_boxes
 
 
+# at most this many cutout pixels are gathered at once by get_image_boxes_batch
+MAX_CUTOUT_PIXELS = 1 << 22
+
+
+def get_image_boxes_batch(bounding_boxes, groups, images, size=24):
+    """Cut out boxes from a batch of images, like get_image_boxes does.
+
+    The cutouts are gathered and resized in batches of boxes of similar size,
+    see resize_like_pil.
+
+    Arguments:
+        bounding_boxes: a float numpy array of shape [n, 5].
+        groups: an int numpy array of shape [n],
+            index of the image each box belongs to.
+        images: a float tensor of shape [b, 3, h, w],
+            with integer values in [0, 255].
+        size: an integer, size of cutouts.
+
+    Returns:
+        a float tensor of shape [n, 3, size, size] on the device of images.
+    """
+
+    height, width = images.shape[2:]
+    num_boxes = len(bounding_boxes)
+    img_boxes = images.new_zeros((num_boxes, 3, size, size))
+    if num_boxes == 0:
+        return img_boxes
+
+    [dy, edy, dx, edx, y, ey, x, ex, w, h] = correct_bboxes(bounding_boxes, width, height)
+    # top left corner of every cutout in the image, parts outside the image are zeros
+    x0, y0 = (x - dx).astype('int64'), (y - dy).astype('int64')
+    w, h = w.astype('int64'), h.astype('int64')
+    groups = np.asarray(groups, 'int64')
+
+    # boxes are batched by size, cutouts of a batch differ in size by less than a factor of two
+    buckets = np.floor(np.log2(np.maximum(np.maximum(w, h), 1))).astype('int64')
+    for bucket in np.unique(buckets):
+        boxes = np.where(buckets == bucket)[0]
+        chunk = max(1, MAX_CUTOUT_PIXELS >> (2 * int(bucket) + 2))
+        for start in range(0, len(boxes), chunk):
+            i = boxes[start:start + chunk]
+            img_boxes[torch.from_numpy(i).to(images.device)] = \
+                _cut_and_resize(images, groups[i], x0[i], y0[i], w[i], h[i], size)
+
+    return (img_boxes - 127.5) * 0.0078125
+
+
+def _cut_and_resize(images, groups, x0, y0, w, h, size):
+    """Cutouts of the given sizes at the given corners, resized to size
+    the way PIL does it, see resize_like_pil.
+
+    Returns:
+        a float tensor of shape [n, 3, size, size].
+    """
+    height, width = images.shape[2:]
+    device = images.device
+    rows = torch.from_numpy(y0[:, None] + np.arange(h.max())).to(device)
+    cols = torch.from_numpy(x0[:, None] + np.arange(w.max())).to(device)
+    inside = ((rows >= 0) & (rows < height))[:, :, None] & ((cols >= 0) & (cols < width))[:, None, :]
+    cutouts = images[torch.from_numpy(groups).to(device)[:, None, None], :,
+                     rows.clamp(0, height - 1)[:, :, None], cols.clamp(0, width - 1)[:, None, :]]
+    cutouts = (cutouts * inside[..., None]).permute(0, 3, 1, 2).double()
+
+    # the coefficients of every box cover its own width and height, the padding gets zero weights
+    cutouts = _resample(cutouts, _pil_bilinear_coefficients(w, size, w.max()), dim=3)
+    cutouts = _resample(cutouts, _pil_bilinear_coefficients(h, size, h.max()), dim=2)
+    return cutouts.to(images.dtype)
+
+
+def resize_like_pil(images, size):
+    """Bilinear resize of images exactly the way PIL's Image.BILINEAR resize
+    does it for 8-bit images: a horizontal pass and then a vertical pass,
+    both antialiased when downscaling, each with PIL's fixed-point filter
+    coefficients and rounding (see _pil_bilinear_coefficients).
+
+    Arguments:
+        images: a float tensor of shape [b, c, h, w],
+            with integer values in [0, 255].
+        size: a tuple (height, width).
+
+    Returns:
+        a float tensor of shape [b, c, height, width],
+            with integer values in [0, 255].
+    """
+    height, width = size
+    resized = images.double()
+    if images.shape[3] != width:
+        resized = _resample(resized, _pil_bilinear_coefficients([images.shape[3]], width), dim=3)
+    if images.shape[2] != height:
+        resized = _resample(resized, _pil_bilinear_coefficients([images.shape[2]], height), dim=2)
+    return resized.to(images.dtype)
+
+
+# fixed-point precision of PIL's 8-bit resampling (PRECISION_BITS in libImaging/Resample.c)
+PRECISION_BITS = 32 - 8 - 2
+
+
+def _pil_bilinear_coefficients(in_sizes, out_size, max_size=None):
+    """The integer filter coefficients PIL uses to resize 8-bit images
+    bilinearly (precompute_coeffs and normalize_coeffs_8bpc in
+    libImaging/Resample.c), with the same double arithmetic.
+
+    Arguments:
+        in_sizes: an int array of shape [n], input lengths.
+        out_size: an integer, output length.
+        max_size: an integer, length of the coefficient rows,
+            at least max(in_sizes).
+
+    Returns:
+        a float numpy array of shape [n, out_size, max_size],
+            coefficient of every input pixel for every output pixel.
+    """
+    in_sizes = np.asarray(in_sizes, 'int64')[:, None]
+    max_size = int(in_sizes.max()) if max_size is None else int(max_size)
+
+    scale = in_sizes / out_size
+    filterscale = np.maximum(scale, 1.0)
+    support = filterscale * 1.0  # the bilinear filter has a support of one
+    ss = 1.0 / filterscale
+    ksize = int(np.ceil(support.max())) * 2 + 1
+
+    center = (np.arange(out_size) + 0.5) * scale
+    xmin = np.maximum(np.trunc(center - support + 0.5), 0).astype('int64')
+    xmax = np.minimum(np.trunc(center + support + 0.5).astype('int64'), in_sizes) - xmin
+
+    # the weights are summed up in the same order as PIL does
+    k = np.zeros(center.shape + (ksize,))
+    ww = np.zeros(center.shape)
+    for x in range(ksize):
+        t = np.abs((x + xmin - center + 0.5) * ss)
+        k[..., x] = np.where((x < xmax) & (t < 1.0), 1.0 - t, 0.0)
+        ww += k[..., x]
+    k = np.where(ww[..., None] != 0.0, k / np.where(ww != 0.0, ww, 1.0)[..., None], k)
+    kk = np.trunc(0.5 + k * (1 << PRECISION_BITS))
+
+    coefficients = np.zeros(center.shape + (max_size + ksize,))
+    np.put_along_axis(coefficients, xmin[..., None] + np.arange(ksize), kk, axis=2)
+    return coefficients[..., :max_size]
+
+
+def _resample(images, coefficients, dim):
+    """One pass of PIL's 8-bit resampling along dim (2: vertical, 3: horizontal).
+
+    Products and sums of the integer pixel values and coefficients stay far
+    below 2 ** 53, so they are exact in float64 and so is the rounding.
+
+    Arguments:
+        images: a float64 tensor of shape [b, c, h, w],
+            with integer values in [0, 255].
+        coefficients: a float numpy array of shape [1 or b, out_size, in_size].
+        dim: an integer, 2 or 3.
+
+    Returns:
+        a float64 tensor with integer values in [0, 255].
+    """
+    coefficients = torch.from_numpy(coefficients).to(images.device)[:, None]
+    if dim == 3:
+        images = torch.matmul(images, coefficients.transpose(2, 3))
+    else:
+        images = torch.matmul(coefficients, images)
+    return torch.floor((images + (1 << (PRECISION_BITS - 1))) / (1 << PRECISION_BITS)).clamp(0, 255)
+
+
 def correct_bboxes(bboxes, width, height):
     """Crop boxes that are too big and get coordinates
     with respect to cutouts.
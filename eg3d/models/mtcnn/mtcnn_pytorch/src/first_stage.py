@@ -3,10 +3,8 @@ from torch.autograd import Variable
 import math
 from PIL import Image
 import numpy as np
-from .box_utils import nms, _preprocess
+from .box_utils import nms, batched_nms, resize_like_pil, _preprocess
 
-# device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-device = 'cuda:0'
 
 
 def run_first_stage(image, net, scale, threshold):
@@ -32,7 +30,7 @@ def run_first_stage(image, net, scale, threshold):
     img = image.resize((sw, sh), Image.BILINEAR)
     img = np.asarray(img, 'float32')
 
-    img = torch.FloatTensor(_preprocess(img)).to(device)
+    img = torch.FloatTensor(_preprocess(img)).to(next(net.parameters()).device)
     with torch.no_grad():
         output = net(img)
         probs = output[1].cpu().data.numpy()[0, 1, :, :]
@@ -48,6 +46,77 @@ def run_first_stage(image, net, scale, threshold):
     return boxes[keep]
 
 
+def run_first_stage_batch(images, net, scale, threshold):
+    """Run P-Net on a batch of images, generate bounding boxes, and do NMS.
+
+    Arguments:
+        images: a float tensor of shape [b, 3, h, w],
+            with integer values in [0, 255].
+        net: an instance of pytorch's nn.Module, P-Net.
+        scale: a float number,
+            scale width and height of the images by this number.
+        threshold: a float number,
+            threshold on the probability of a face when generating
+            bounding boxes from predictions of the net.
+
+    Returns:
+        a float numpy array of shape [n_boxes, 9],
+            bounding boxes with scores and offsets (4 + 1 + 4),
+        and an int numpy array of shape [n_boxes],
+            index of the image each box belongs to.
+    """
+
+    # scale the images like PIL does, see resize_like_pil
+    height, width = images.shape[2:]
+    sw, sh = math.ceil(width * scale), math.ceil(height * scale)
+    img = (resize_like_pil(images, (sh, sw)) - 127.5) * 0.0078125
+
+    with torch.no_grad():
+        output = net(img)
+        probs = output[1].cpu().data.numpy()[:, 1, :, :]
+        offsets = output[0].cpu().data.numpy()
+
+    boxes, groups = _generate_bboxes_batch(probs, offsets, scale, threshold)
+    keep = batched_nms(boxes[:, 0:5], groups, overlap_threshold=0.5)
+    return boxes[keep], groups[keep]
+
+
+def _generate_bboxes_batch(probs, offsets, scale, threshold):
+    """Same as _generate_bboxes, for the outputs of a batch of images.
+
+    Arguments:
+        probs: a float numpy array of shape [b, n, m].
+        offsets: a float numpy array of shape [b, 4, n, m].
+        scale: a float number.
+        threshold: a float number.
+
+    Returns:
+        a float numpy array of shape [n_boxes, 9]
+        and an int numpy array of shape [n_boxes].
+    """
+
+    stride = 2
+    cell_size = 12
+
+    groups, rows, cols = np.where(probs > threshold)
+
+    if groups.size == 0:
+        return np.zeros((0, 9)), np.zeros((0,), 'int64')
+
+    offsets = np.array([offsets[groups, i, rows, cols] for i in range(4)])
+    score = probs[groups, rows, cols]
+
+    bounding_boxes = np.vstack([
+        np.round((stride * cols + 1.0) / scale),
+        np.round((stride * rows + 1.0) / scale),
+        np.round((stride * cols + 1.0 + cell_size) / scale),
+        np.round((stride * rows + 1.0 + cell_size) / scale),
+        score, offsets
+    ])
+
+    return bounding_boxes.T, groups
+
+
 def _generate_bboxes(probs, offsets, scale, threshold):
     """Generate bounding boxes at places
     where there is probably a face.
@@ -12,12 +12,15 @@ import torch
 import pickle
 from torch.utils.tensorboard import SummaryWriter
 
-import dnnlib
-import legacy
 from inversion.w_inversion import project
 from inversion.pti_inversion import project_pti
-from inversion.load_data import ImageItem, load
+from inversion.load_data import ImageItem, load, prefetch
+from inversion.resident import load_network_data
+from inversion.results import save_result, RESULT_FILE
 from inversion.image_selection import select_evenly
+from inversion.precision import PRECISIONS
+from inversion.telemetry import Telemetry
+from utils.registry import registry_for, run_artifacts
 
 
 
@@ -35,6 +38,25 @@ from inversion.image_selection import select_evenly
 @click.option('--num-targets', help='Number of targets to use for inversion', default=10, show_default=True)
 @click.option('--downsampling', help='Downsample images from 512 to 256', type=bool, required=True)
 @click.option('--optimize-cam', type=bool, required=True)
+@click.option('--snapshot-fp16', help='Store PTI progress snapshots as fp16 parameter deltas', type=bool,
+              default=True, show_default=True)
+@click.option('--snapshot-mmap', help='Keep PTI progress snapshots in a memory-mapped file in the run dir', type=bool,
+              default=False, show_default=True)
+@click.option('--save-pkl', help='Also pickle the fine-tuned generator with the full network data', type=bool,
+              default=True, show_default=True)
+@click.option('--result-fp16', help='Store the fine-tuned weight delta in fp16', type=bool, default=False,
+              show_default=True)
+@click.option('--batch-views', help='Render all target views in one batched pass per W step', type=bool, default=False,
+              show_default=True)
+@click.option('--scalar-every', help='Steps between logged scalars', type=int, default=1, show_default=True)
+@click.option('--flush-every', help='Steps between reads of the logged scalars from the device', type=int, default=25,
+              show_default=True)
+@click.option('--preview-every', help='Steps between preview images of the optimization', type=int, default=25,
+              show_default=True)
+@click.option('--precision', help='Autocast precision of the optimization', type=click.Choice(PRECISIONS),
+              default='fp32', show_default=True)
+@click.option('--compile', 'compile_synthesis', help='Compile G.synthesis with torch.compile (eager fallback)',
+              type=bool, default=False, show_default=True)
 def run_projection(
         network_pkl: str,
         target_fname: str,
@@ -46,7 +68,17 @@ def run_projection(
         fps: int,
         num_targets: int,
         downsampling: bool,
-        optimize_cam: bool
+        optimize_cam: bool,
+        batch_views: bool,
+        snapshot_fp16: bool,
+        snapshot_mmap: bool,
+        save_pkl: bool,
+        result_fp16: bool,
+        scalar_every: int,
+        flush_every: int,
+        preview_every: int,
+        precision: str,
+        compile_synthesis: bool
 ):
     cur_time = time.strftime("%Y%m%d-%H%M", time.localtime())
     desc = ("/" + cur_time)
@@ -56,7 +88,8 @@ def run_projection(
     desc += f"_data_{data_index}"
     os.makedirs(outdir, exist_ok=True)
     outdir += desc
-    writer = SummaryWriter(outdir)
+    writer = Telemetry(SummaryWriter(outdir), scalar_every=scalar_every, flush_every=flush_every,
+                       preview_every=preview_every)
 
     np.random.seed(seed)
     torch.manual_seed(seed)
@@ -64,16 +97,16 @@ def run_projection(
     # Load networks.
     print('Loading networks from "%s"...' % network_pkl)
     device = torch.device('cuda')
-    with dnnlib.util.open_url(network_pkl) as fp:
-        network_data = legacy.load_network_pkl(fp)
-        G = network_data['G_ema'].requires_grad_(False).to(device)  # type: ignore
+    network_data = load_network_data(network_pkl)
+    G = network_data['G_ema'].requires_grad_(False).to(device)  # type: ignore
 
     G.rendering_kwargs["ray_start"] = 2.35
 
-    images: List[ImageItem] = load(target_fname, img_resolution=G.img_resolution, device=device)
+    images: List[ImageItem] = load(target_fname, img_resolution=G.img_resolution, device=device, lazy=True)
 
     start_time = perf_counter()
     target_indices = select_evenly(images, num_targets)
+    prefetch(images, target_indices)
 
     projected_w_steps = project(
         G,
@@ -85,25 +118,33 @@ def run_projection(
         writer=writer,
         downsampling=downsampling,
         optimize_cam=optimize_cam,
-        w_plus=True
+        w_plus=True,
+        batch_views=batch_views,
+        precision=precision,
+        compiled=compile_synthesis
     )
     time_project_w = perf_counter() - start_time
 
-    start_time = perf_counter()
-    G_steps = project_pti(
+    finish_run(
         G,
+        network_data,
         images=images,
-        w_pivot=projected_w_steps[-1:],
-        num_steps=num_steps_pti,
-        device=device,
-        outdir=outdir,
         target_indices=target_indices,
+        projected_w_steps=projected_w_steps,
+        outdir=outdir,
         writer=writer,
-        downsampling=downsampling
-    )
-    time_pti = perf_counter() - start_time
-    with open(outdir + "/config.json", "w") as file:
-        json.dump({
+        device=device,
+        num_steps_pti=num_steps_pti,
+        downsampling=downsampling,
+        snapshot_fp16=snapshot_fp16,
+        snapshot_mmap=snapshot_mmap,
+        save_video=save_video,
+        fps=fps,
+        save_pkl=save_pkl,
+        result_fp16=result_fp16,
+        precision=precision,
+        compiled=compile_synthesis,
+        config={
             "net": network_pkl,
             "target_fname": target_fname,
             "seed": seed,
@@ -112,10 +153,57 @@ def run_projection(
             "num_targets": num_targets,
             "downsampling": downsampling,
             "optimize_cam": optimize_cam,
+            "batch_views": batch_views,
+            "precision": precision,
             "time": cur_time,
-            "time_project_w": time_project_w,
-            "time_pti": time_pti
-        }, file)
+            "time_project_w": time_project_w
+        }
+    )
+
+
+def finish_run(
+        G,
+        network_data: dict,
+        *,
+        images: List[ImageItem],
+        target_indices: List[int],
+        projected_w_steps: torch.Tensor,
+        outdir: str,
+        writer: Telemetry,
+        device: torch.device,
+        num_steps_pti: int,
+        downsampling: bool,
+        snapshot_fp16: bool,
+        snapshot_mmap: bool,
+        save_video: bool,
+        fps: int,
+        config: dict,
+        save_pkl: bool = True,
+        result_fp16: bool = False,
+        precision: str = "fp32",
+        compiled: bool = False,
+        program: str = "multi_inversion.py"
+):
+    # Pivot tuning on the projected W, then the outputs of the run: config, target, projection and generator.
+    start_time = perf_counter()
+    G_steps = project_pti(
+        G,
+        images=images,
+        w_pivot=projected_w_steps[-1:],
+        num_steps=num_steps_pti,
+        device=device,
+        outdir=outdir,
+        target_indices=target_indices,
+        writer=writer,
+        downsampling=downsampling,
+        snapshot_half=snapshot_fp16,
+        snapshot_path=f'{outdir}/pti_snapshots.bin' if snapshot_mmap else None,
+        precision=precision,
+        compiled=compiled
+    )
+    time_pti = perf_counter() - start_time
+    with open(outdir + "/config.json", "w") as file:
+        json.dump({**config, "time_pti": time_pti}, file)
 
     # Save final projected frame and W vector.
     images[0].target_pil.save(f'{outdir}/target.png')
@@ -128,13 +216,17 @@ def run_projection(
     PIL.Image.fromarray(synth_image, 'RGB').save(f'{outdir}/proj.png')
     np.savez(f'{outdir}/projected_w.npz', w=projected_w.unsqueeze(0).cpu().numpy())
 
-    with open(f'{outdir}/fintuned_generator.pkl', 'wb') as f:
-        network_data["G_ema"] = G_final.eval().requires_grad_(False).cpu()
-        pickle.dump(network_data, f)
+    save_result(f'{outdir}/{RESULT_FILE}', G_final, config["net"], {"w": projected_w.unsqueeze(0).cpu().numpy()},
+                half=result_fp16)
+    if save_pkl:
+        with open(f'{outdir}/fintuned_generator.pkl', 'wb') as f:
+            network_data["G_ema"] = G_final.eval().requires_grad_(False).cpu()
+            pickle.dump(network_data, f)
 
     # Render debug output: optional video and projected image and W vector.
     if save_video:
         target_indices = select_evenly(images, 5)
+        target_uint8 = [images[target_index].t_uint8 for target_index in target_indices]
         video = imageio.get_writer(f'{outdir}/proj.mp4', mode='I', fps=fps, codec='libx264', bitrate='16M')
         print(f'Saving optimization progress video "{outdir}/proj.mp4"')
         for projected_w in projected_w_steps[::]:
@@ -144,7 +236,7 @@ def run_projection(
                 synth_image = G.synthesis(projected_w.unsqueeze(0).to(device), c=cam_i, noise_mode='const')['image']
                 synth_image = (synth_image + 1) * (255 / 2)
                 synth_image = synth_image.permute(0, 2, 3, 1).clamp(0, 255).to(torch.uint8)[0].cpu().numpy()
-                views.append(np.concatenate([images[target_index].t_uint8, synth_image], axis=0))
+                views.append(np.concatenate([target_uint8[i], synth_image], axis=0))
             video.append_data(np.concatenate(views, axis=1))
         for G_new in G_steps:
             G_new.to(device)
@@ -154,11 +246,14 @@ def run_projection(
                 synth_image = G_new.synthesis(projected_w_steps[-1].unsqueeze(0).to(device), c=cam_i, noise_mode='const')['image']
                 synth_image = (synth_image + 1) * (255 / 2)
                 synth_image = synth_image.permute(0, 2, 3, 1).clamp(0, 255).to(torch.uint8)[0].cpu().numpy()
-                views.append(np.concatenate([images[target_index].t_uint8, synth_image], axis=0))
+                views.append(np.concatenate([target_uint8[i], synth_image], axis=0))
             G_new.cpu()
             video.append_data(np.concatenate(views, axis=1))
         video.close()
 
+    writer.close()  # all previews and checkpoints are written
+    registry_for(outdir).add_run(outdir, {**config, "time_pti": time_pti}, run_artifacts(outdir), program=program)
+
 # ----------------------------------------------------------------------------
 
 if __name__ == "__main__":
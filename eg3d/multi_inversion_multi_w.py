@@ -13,12 +13,15 @@ import torch
 import pickle
 from torch.utils.tensorboard import SummaryWriter
 
-import dnnlib
-import legacy
 from inversion.multi_w_inversion import project
 from inversion.multi_pti_inversion import project_pti
-from inversion.load_data import ImageItem, load
+from inversion.load_data import ImageItem, load, prefetch
+from inversion.resident import load_network_data
+from inversion.results import save_result, RESULT_FILE
 from inversion.image_selection import select_evenly_interpolate, select_evenly
+from inversion.precision import PRECISIONS
+from inversion.telemetry import Telemetry
+from utils.registry import registry_for, run_artifacts
 
 
 @click.command()
@@ -37,7 +40,24 @@ from inversion.image_selection import select_evenly_interpolate, select_evenly
 @click.option('--continue-w', help='numpy .npz file to load the latent vector', required=True, metavar='FILE')
 @click.option('--use-interpolation', type=bool, required=True)
 @click.option('--depth-reg', type=bool, required=True)
+@click.option('--snapshot-fp16', help='Store PTI progress snapshots as fp16 parameter deltas', type=bool,
+              default=True, show_default=True)
+@click.option('--snapshot-mmap', help='Keep PTI progress snapshots in a memory-mapped file in the run dir', type=bool,
+              default=False, show_default=True)
 @click.option('--w-norm-reg', type=bool, required=False, default=True)
+@click.option('--save-pkl', help='Also pickle the fine-tuned generator with the full network data', type=bool,
+              default=True, show_default=True)
+@click.option('--result-fp16', help='Store the fine-tuned weight delta in fp16', type=bool, default=False,
+              show_default=True)
+@click.option('--scalar-every', help='Steps between logged scalars', type=int, default=1, show_default=True)
+@click.option('--flush-every', help='Steps between reads of the logged scalars from the device', type=int, default=25,
+              show_default=True)
+@click.option('--preview-every', help='Steps between preview images of the optimization', type=int, default=25,
+              show_default=True)
+@click.option('--precision', help='Autocast precision of the optimization', type=click.Choice(PRECISIONS),
+              default='fp32', show_default=True)
+@click.option('--compile', 'compile_synthesis', help='Compile G.synthesis with torch.compile (eager fallback)',
+              type=bool, default=False, show_default=True)
 def run_projection(
         network_pkl: str,
         target_fname: str,
@@ -52,7 +72,16 @@ def run_projection(
         continue_w: str,
         use_interpolation: bool,
         depth_reg: bool,
-        w_norm_reg: bool
+        w_norm_reg: bool,
+        snapshot_fp16: bool,
+        snapshot_mmap: bool,
+        save_pkl: bool,
+        result_fp16: bool,
+        scalar_every: int,
+        flush_every: int,
+        preview_every: int,
+        precision: str,
+        compile_synthesis: bool
 ):
     cur_time = time.strftime("%Y%m%d-%H%M", time.localtime())
     desc = ("/" + cur_time)
@@ -67,7 +96,8 @@ def run_projection(
 
     os.makedirs(outdir, exist_ok=True)
     outdir += desc
-    writer = SummaryWriter(outdir)
+    writer = Telemetry(SummaryWriter(outdir), scalar_every=scalar_every, flush_every=flush_every,
+                       preview_every=preview_every)
 
     np.random.seed(seed)
     torch.manual_seed(seed)
@@ -75,16 +105,16 @@ def run_projection(
     # Load networks.
     print('Loading networks from "%s"...' % network_pkl)
     device = torch.device('cuda')
-    with dnnlib.util.open_url(network_pkl) as fp:
-        network_data = legacy.load_network_pkl(fp)
-        G = network_data['G_ema'].requires_grad_(False).to("cpu")  # type: ignore
+    network_data = load_network_data(network_pkl)
+    G = network_data['G_ema'].requires_grad_(False).to("cpu")  # type: ignore
 
     G.rendering_kwargs["ray_start"] = 2.35
 
-    images: List[ImageItem] = load(target_fname, img_resolution=G.img_resolution, device=device)
+    images: List[ImageItem] = load(target_fname, img_resolution=G.img_resolution, device=device, lazy=True)
 
     start_time = perf_counter()
     target_indices, interpolated_indices = select_evenly_interpolate(images, num_targets)
+    prefetch(images, list(target_indices) + list(interpolated_indices))
 
     projected_w_steps = project(
         G,
@@ -99,7 +129,9 @@ def run_projection(
         continue_checkpoint=continue_w,
         use_interpolation=use_interpolation,
         use_depth_reg=depth_reg,
-        use_w_norm_reg=w_norm_reg
+        use_w_norm_reg=w_norm_reg,
+        precision=precision,
+        compiled=compile_synthesis
     )
     time_opt_w = (perf_counter() - start_time)
     start_time = perf_counter()
@@ -116,26 +148,33 @@ def run_projection(
         writer=writer,
         downsampling=downsampling,
         use_interpolation=use_interpolation,
-        use_depth_reg=depth_reg
+        use_depth_reg=depth_reg,
+        snapshot_half=snapshot_fp16,
+        snapshot_path=f'{outdir}/pti_snapshots.bin' if snapshot_mmap else None,
+        precision=precision,
+        compiled=compile_synthesis
     )
     time_opt_pti = (perf_counter() - start_time)
 
+    config = {
+        "net": network_pkl,
+        "target_fname": target_fname,
+        "seed": seed,
+        "num_steps": num_steps,
+        "num_steps_pti": num_steps_pti,
+        "num_targets": num_targets,
+        "downsampling": downsampling,
+        "time": cur_time,
+        "time_w": time_opt_w,
+        "time_pti": time_opt_pti,
+        "use_interpolation": use_interpolation,
+        "continue_w": continue_w,
+        "depth_reg": depth_reg,
+        "w_norm_reg": w_norm_reg,
+        "precision": precision
+    }
     with open(outdir + "/config.json", "w") as file:
-        json.dump({
-            "net": network_pkl,
-            "target_fname": target_fname,
-            "seed": seed,
-            "num_steps": num_steps,
-            "num_steps_pti": num_steps_pti,
-            "num_targets": num_targets,
-            "downsampling": downsampling,
-            "time": cur_time,
-            "time_w": time_opt_w,
-            "time_pti": time_opt_pti,
-            "use_interpolation": use_interpolation,
-            "continue_w": continue_w,
-            "depth_reg": depth_reg
-        }, file)
+        json.dump(config, file)
 
     # Save final projected frame and W vector.
     images[0].target_pil.save(f'{outdir}/target.png')
@@ -149,15 +188,23 @@ def run_projection(
     PIL.Image.fromarray(synth_image, 'RGB').save(f'{outdir}/proj.png')
     np.savez(f'{outdir}/projected_w.npz', w=projected_w.unsqueeze(0).cpu().numpy())
 
-    with open(f'{outdir}/fintuned_generator.pkl', 'wb') as f:
-        network_data["G_ema"] = G_final.eval().requires_grad_(False).cpu()
-        pickle.dump(network_data, f)
+    # Same latent layout as the last {step}_projected_w_mult.npz checkpoint.
+    latents = {
+        "ws": projected_w_steps[-1][:, None].cpu().numpy(),
+        "cs": np.array([images[i].c_item.c.detach().cpu().numpy() for i in target_indices])
+    }
+    save_result(f'{outdir}/{RESULT_FILE}', G_final, network_pkl, latents, half=result_fp16)
+    if save_pkl:
+        with open(f'{outdir}/fintuned_generator.pkl', 'wb') as f:
+            network_data["G_ema"] = G_final.eval().requires_grad_(False).cpu()
+            pickle.dump(network_data, f)
 
     # Render debug output: optional video and projected image and W vector.
     G = G.to(device).eval().requires_grad_(False)
     # Render debug output: optional video and projected image and W vector.
     if save_video:
         target_indices = select_evenly(images, 5)
+        target_uint8 = [images[target_index].t_uint8 for target_index in target_indices]
         video = imageio.get_writer(f'{outdir}/proj.mp4', mode='I', fps=fps, codec='libx264', bitrate='16M')
         print(f'Saving optimization progress video "{outdir}/proj.mp4"')
         for projected_w in projected_w_steps:
@@ -167,7 +214,7 @@ def run_projection(
                 synth_image = G.synthesis(projected_w[i].unsqueeze(0).to(device), c=cam_i, noise_mode='const')['image']
                 synth_image = (synth_image + 1) * (255 / 2)
                 synth_image = synth_image.permute(0, 2, 3, 1).clamp(0, 255).to(torch.uint8)[0].cpu().numpy()
-                views.append(np.concatenate([images[target_index].t_uint8, synth_image], axis=0))
+                views.append(np.concatenate([target_uint8[i], synth_image], axis=0))
             video.append_data(np.concatenate(views, axis=1))
         for G_new in G_steps:
             G_new.to(device)
@@ -177,11 +224,14 @@ def run_projection(
                 synth_image = G_new.synthesis(projected_w_steps[-1][i].unsqueeze(0).to(device), c=cam_i, noise_mode='const')['image']
                 synth_image = (synth_image + 1) * (255 / 2)
                 synth_image = synth_image.permute(0, 2, 3, 1).clamp(0, 255).to(torch.uint8)[0].cpu().numpy()
-                views.append(np.concatenate([images[target_index].t_uint8, synth_image], axis=0))
+                views.append(np.concatenate([target_uint8[i], synth_image], axis=0))
             G_new.cpu()
             video.append_data(np.concatenate(views, axis=1))
         video.close()
 
+    writer.close()  # all previews and checkpoints are written
+    registry_for(outdir).add_run(outdir, config, run_artifacts(outdir), program="multi_inversion_multi_w.py")
+
 
 # ----------------------------------------------------------------------------
 
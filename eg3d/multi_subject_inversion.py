@@ -0,0 +1,163 @@
+""" Projecting several subjects into latent space at once. """
+import os
+import time
+from time import perf_counter
+from typing import List
+import click
+import numpy as np
+import torch
+from torch.utils.tensorboard import SummaryWriter
+
+from inversion.w_inversion import project_subjects
+from inversion.load_data import ImageItem, load, prefetch
+from inversion.resident import load_network_data
+from inversion.image_selection import select_evenly
+from inversion.precision import PRECISIONS
+from inversion.telemetry import Telemetry
+from multi_inversion import finish_run
+
+
+@click.command()
+@click.option('--network', 'network_pkl', help='Network pickle filename', required=True)
+@click.option('--target', 'target_fnames', help='Target folder of a subject; repeat for every subject', required=True,
+              multiple=True, metavar='DIR')
+@click.option('--num-steps', help='Number of optimization steps', type=int, default=500, show_default=True)
+@click.option('--num-steps-pti', help='Number of optimization steps for pivot tuning', type=int, default=350,
+              show_default=True)
+@click.option('--seed', help='Random seed', type=int, default=303, show_default=True)
+@click.option('--save-video', help='Save an mp4 video of optimization progress', type=bool, default=False,
+              show_default=True)
+@click.option('--outdir', help='Where to save the output images', required=True, metavar='DIR')
+@click.option('--fps', help='Frames per second of final video', default=30, show_default=True)
+@click.option('--num-targets', help='Number of targets to use for inversion', default=10, show_default=True)
+@click.option('--downsampling', help='Downsample images from 512 to 256', type=bool, required=True)
+@click.option('--snapshot-fp16', help='Store PTI progress snapshots as fp16 parameter deltas', type=bool,
+              default=True, show_default=True)
+@click.option('--snapshot-mmap', help='Keep PTI progress snapshots in a memory-mapped file in the run dir', type=bool,
+              default=False, show_default=True)
+@click.option('--save-pkl', help='Also pickle the fine-tuned generator with the full network data', type=bool,
+              default=True, show_default=True)
+@click.option('--result-fp16', help='Store the fine-tuned weight delta in fp16', type=bool, default=False,
+              show_default=True)
+@click.option('--scalar-every', help='Steps between logged scalars', type=int, default=1, show_default=True)
+@click.option('--flush-every', help='Steps between reads of the logged scalars from the device', type=int, default=25,
+              show_default=True)
+@click.option('--preview-every', help='Steps between preview images of the optimization', type=int, default=25,
+              show_default=True)
+@click.option('--precision', help='Autocast precision of the optimization', type=click.Choice(PRECISIONS),
+              default='fp32', show_default=True)
+@click.option('--compile', 'compile_synthesis', help='Compile G.synthesis with torch.compile (eager fallback)',
+              type=bool, default=False, show_default=True)
+def run_projection(
+        network_pkl: str,
+        target_fnames: List[str],
+        outdir: str,
+        save_video: bool,
+        seed: int,
+        num_steps: int,
+        num_steps_pti: int,
+        fps: int,
+        num_targets: int,
+        downsampling: bool,
+        snapshot_fp16: bool,
+        snapshot_mmap: bool,
+        save_pkl: bool,
+        result_fp16: bool,
+        scalar_every: int,
+        flush_every: int,
+        preview_every: int,
+        precision: str,
+        compile_synthesis: bool
+):
+    # The W phase of all subjects runs as one batched optimization; pivot tuning then runs subject by subject.
+    # Every subject gets its own run dir with the same outputs as multi_inversion.py.
+    cur_time = time.strftime("%Y%m%d-%H%M", time.localtime())
+    os.makedirs(outdir, exist_ok=True)
+    outdirs = []
+    for target_fname in target_fnames:
+        desc = ("/" + cur_time)
+        desc += f"_multiview_{num_targets}"
+        desc += f"_iter_{num_steps}_{num_steps_pti}"
+        data_index = target_fname.split("/")[-1]
+        desc += f"_data_{data_index}"
+        outdirs.append(outdir + desc)
+    writers = [Telemetry(SummaryWriter(subject_outdir), scalar_every=scalar_every, flush_every=flush_every,
+                         preview_every=preview_every) for subject_outdir in outdirs]
+
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+    # Load networks.
+    print('Loading networks from "%s"...' % network_pkl)
+    device = torch.device('cuda')
+    network_data = load_network_data(network_pkl)
+    G = network_data['G_ema'].requires_grad_(False).to(device)  # type: ignore
+
+    G.rendering_kwargs["ray_start"] = 2.35
+
+    subjects: List[List[ImageItem]] = []
+    target_indices = []
+    for target_fname in target_fnames:
+        images = load(target_fname, img_resolution=G.img_resolution, device=device, lazy=True)
+        subjects.append(images)
+        target_indices.append(select_evenly(images, num_targets))
+        prefetch(images, target_indices[-1])
+
+    start_time = perf_counter()
+    projected_w_steps = project_subjects(
+        G,
+        subjects=subjects,
+        target_indices=target_indices,
+        num_steps=num_steps,
+        device=device,
+        outdirs=outdirs,
+        writers=writers,
+        downsampling=downsampling,
+        precision=precision,
+        compiled=compile_synthesis
+    )
+    time_project_w = perf_counter() - start_time
+
+    for s, target_fname in enumerate(target_fnames):
+        finish_run(
+            G,
+            dict(network_data),
+            images=subjects[s],
+            target_indices=target_indices[s],
+            projected_w_steps=projected_w_steps[:, s],
+            outdir=outdirs[s],
+            writer=writers[s],
+            device=device,
+            num_steps_pti=num_steps_pti,
+            downsampling=downsampling,
+            snapshot_fp16=snapshot_fp16,
+            snapshot_mmap=snapshot_mmap,
+            save_video=save_video,
+            fps=fps,
+            save_pkl=save_pkl,
+            result_fp16=result_fp16,
+            precision=precision,
+            compiled=compile_synthesis,
+            program="multi_subject_inversion.py",
+            config={
+                "net": network_pkl,
+                "target_fname": target_fname,
+                "seed": seed,
+                "num_steps": num_steps,
+                "num_steps_pti": num_steps_pti,
+                "num_targets": num_targets,
+                "downsampling": downsampling,
+                "optimize_cam": False,
+                "batch_views": True,
+                "precision": precision,
+                "num_subjects": len(target_fnames),
+                "time": cur_time,
+                # the W phase is shared, so every subject is charged an equal part
+                "time_project_w": time_project_w / len(target_fnames)
+            }
+        )
+
+# ----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    run_projection()
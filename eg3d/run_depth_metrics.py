@@ -3,57 +3,65 @@ import numpy as np
 import torch
 from tqdm import tqdm
 
-import dnnlib
-import legacy
 from inversion.image_selection import select_evenly
 from inversion.load_data import load
 from inversion.metrics import DepthMetric
-from inversion.utils import interpolate_w_by_cam
-from utils.run_dir import get_pkl_and_w
+from inversion.poses import PoseTable
+from inversion.utils import interpolate_ws_by_cams, reload_modules
+from utils.registry import registry_for
+from utils.run_dir import load_run
 
 
 @click.command()
 @click.option('--data-path', required=True, metavar='DIR')
 @click.option('--rundir', required=True, metavar='DIR')
 @click.option('--depth-samples', required=True, type=int)
+@click.option('--batch-size', help='Number of views rendered at once', type=int, default=8, show_default=True)
 def run(
         data_path: str,
         rundir: str,
-        depth_samples: int
+        depth_samples: int,
+        batch_size: int
 ):
-    network_pkl, w_path = get_pkl_and_w(rundir)
+    G_pti, checkpoint = load_run(rundir)
     np.random.seed(42)
     torch.manual_seed(42)
     device = "cuda" if torch.cuda.is_available() else "cpu"
 
     # load data and latent
-    checkpoint = np.load(w_path)
     if "ws" not in checkpoint.keys():
         print("Checkpoint has no multiple ws")
         return
     ws = [torch.tensor(w_).to("cuda") for w_ in checkpoint['ws']]
-    cs = [torch.tensor(c_).to("cuda") for c_ in checkpoint['cs']]
+    cs = PoseTable.from_cams([torch.tensor(c_).to("cuda") for c_ in checkpoint['cs']])
 
     images = load(data_path, 512, device=device)
     depth_target_indices = select_evenly(images, depth_samples)
 
-    with dnnlib.util.open_url(network_pkl) as fp:
-        network_data = legacy.load_network_pkl(fp)
-        G = network_data['G_ema'].requires_grad_(False).to(device)
+    G = reload_modules(G_pti).eval().requires_grad_(False).to(device)
     G.rendering_kwargs["ray_start"] = 2.35
 
     depth_metric = DepthMetric(depth_samples)
 
-    for i in tqdm(depth_target_indices):
-        img = images[i]
-        for j in range(depth_samples):
-            current_cam = images[j].c_item.c
-            w = torch.tensor(interpolate_w_by_cam(ws, cs, img.c_item.c)).to(device)
-            depth_image = G.synthesis(w, c=current_cam, noise_mode='const')['image_depth'][0]
-            depth_metric.update(j, depth_image)
+    # One interpolated latent per depth target, computed in a single batch.
+    target_cams = torch.cat([images[i].c_item.c for i in depth_target_indices])
+    target_ws = interpolate_ws_by_cams(ws, cs, target_cams)
+
+    view_cams = torch.cat([images[j].c_item.c for j in range(depth_samples)])
+
+    for count in tqdm(range(len(depth_target_indices))):
+        w = target_ws[count:count + 1]
+        for start in range(0, depth_samples, batch_size):
+            # All views of one latent share the triplanes of the first batch.
+            cams = view_cams[start:start + batch_size]
+            with torch.no_grad():
+                depth_images = G.synthesis(w, c=cams, noise_mode='const', outputs=('image_depth',),
+                                           cache_backbone=start == 0, use_cached_backbone=start > 0)['image_depth']
+            depth_metric.update_batch(list(range(start, start + len(cams))), depth_images)
 
     depth_mean_std = depth_metric.calc_mean_stddev(path=rundir + "/" + "depth.png")
     print(f"depth_mean_std PTI: {depth_mean_std}")
+    registry_for(rundir).add_metrics(rundir, depth_samples, {"PTI_net": {"depth_std": depth_mean_std}})
 
 
 if __name__ == "__main__":
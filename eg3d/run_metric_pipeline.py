@@ -1,4 +1,5 @@
-import subprocess
+from utils.jobs import run_job
+from utils.registry import registry_for
 
 
 class MetricHandler:
@@ -8,7 +9,9 @@ class MetricHandler:
             original_network="networks/var3-128.pkl",
             dataset="../dataset_preprocessing/ffhq/1",
             num_samples=180,
-            run_w_plus=False
+            run_w_plus=False,
+            resident=False,
+            skip_done=False
     ):
         print("------------------------------------------------------------------")
         print("------------------------------------------------------------------")
@@ -19,10 +22,16 @@ class MetricHandler:
         self.args.append(f"--num-samples={num_samples}")
         self.args.append(f"--rundir={rundir}")
         self.args.append(f"--run-w-plus={run_w_plus}")
+        self.rundir = rundir
+        self.num_samples = num_samples
         self.python = "python"
 
         self.path_to_program = "run_metrics.py"
-        subprocess.run([self.python, self.path_to_program, *self.args], shell=False)
+        self.command = "run_metric"
+        run_job(self, resident, skip_done)
+
+    def is_done(self):
+        return registry_for(self.rundir).has_metrics(self.rundir, self.num_samples)
 
 
 if __name__ == "__main__":
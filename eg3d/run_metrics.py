@@ -1,15 +1,17 @@
+import json
 import click
 import numpy as np
 import torch
 from tqdm import tqdm
 
-import dnnlib
-import legacy
 from inversion.image_selection import select_evenly
-from inversion.load_data import load
+from inversion.load_data import load, target_batch
 from inversion.metrics import Metrics
-from inversion.utils import interpolate_w_by_cam
-from utils.run_dir import get_pkl_and_w
+from inversion.poses import PoseTable
+from inversion.resident import resident, load_network_data
+from inversion.utils import interpolate_ws_by_cams
+from utils.registry import registry_for
+from utils.run_dir import load_run
 
 
 @click.command()
@@ -18,37 +20,40 @@ from utils.run_dir import get_pkl_and_w
 @click.option('--rundir', required=True, metavar='DIR')
 @click.option('--original-network', required=True, metavar='FILE')
 @click.option('--run-w-plus', type=bool, required=True)
+@click.option('--batch-size', help='Number of frames rendered and evaluated at once', type=int, default=8, show_default=True)
 def run_metric(
         data_path: str,
         num_samples: int,
         rundir: str,
         original_network: str,
-        run_w_plus: bool
+        run_w_plus: bool,
+        batch_size: int = 8
 ):
-    network_pkl, w_path = get_pkl_and_w(rundir)
+    G_pti, checkpoint = load_run(rundir)
     np.random.seed(42)
     torch.manual_seed(42)
     device = "cuda" if torch.cuda.is_available() else "cpu"
-    metric_helper = Metrics()
+    metric_helper = resident("Metrics", Metrics)
 
-    # load data and latent
-    checkpoint = np.load(w_path)
+    # load data
     images = load(data_path, 512, device=device)
     result = {}
 
     if run_w_plus:
-        networks = [("original_net", original_network), ("PTI_net", network_pkl)]
+        networks = [("original_net", original_network), ("PTI_net", rundir)]
     else:
-        networks = [("PTI_net", network_pkl)]
+        networks = [("PTI_net", rundir)]
 
     for desc, network in networks:
         # Load networks.
         result[desc] = {}
         print('Loading networks from "%s"...' % network)
         device = torch.device('cuda')
-        with dnnlib.util.open_url(network) as fp:
-            network_data = legacy.load_network_pkl(fp)
-            G = network_data['G_ema'].requires_grad_(False).to(device)
+        if desc == "original_net":
+            # The base network is shared by all runs, so it stays loaded across metric jobs.
+            G = load_network_data(network)['G_ema'].requires_grad_(False).to(device)
+        else:
+            G = G_pti.requires_grad_(False).to(device)
         G.rendering_kwargs["ray_start"] = 2.35
 
         # setup
@@ -62,21 +67,27 @@ def run_metric(
 
         if "ws" in checkpoint.keys():
             ws = [torch.tensor(w_).to("cuda") for w_ in checkpoint['ws']]
-            cs = [torch.tensor(c_).to("cuda") for c_ in checkpoint['cs']]
+            cs = PoseTable.from_cams([torch.tensor(c_).to("cuda") for c_ in checkpoint['cs']])
+            target_cams = torch.cat([images[i].c_item.c for i in target_indices])
+            target_ws = interpolate_ws_by_cams(ws, cs, target_cams)
 
-        for i in tqdm(target_indices):
-            img = images[i]
+        for start in tqdm(range(0, len(target_indices), batch_size)):
+            batch_indices = target_indices[start:start + batch_size]
+            cams = torch.cat([images[i].c_item.c for i in batch_indices])
             if "ws" in checkpoint.keys():
-                w = torch.tensor(interpolate_w_by_cam(ws, cs, img.c_item.c)).to("cuda")
+                w = target_ws[start:start + len(batch_indices)]
             else:
-                w = torch.tensor(checkpoint["w"]).to("cuda")
-            synth_image = G.synthesis(w, c=img.c_item.c, noise_mode='const')['image'][0]
-
-            angles.append(img.c_item.xz_angle().cpu().numpy())
-            mse.append(metric_helper.mse(synth_image, img.target_tensor[0]))
-            ms_ssim.append(metric_helper.ms_ssim(synth_image, img.target_tensor[0]))
-            lpips.append(metric_helper.lpips(synth_image, img.target_tensor[0]).cpu().numpy())
-            id_sim.append(metric_helper.id_similarity(synth_image, img.target_tensor[0]))
+                w = torch.tensor(checkpoint["w"]).to("cuda").expand(len(batch_indices), -1, -1)
+            with torch.no_grad():
+                synth_images = G.synthesis(w, c=cams, noise_mode='const')['image']
+            values = metric_helper.evaluate_batch(synth_images, target_batch(images, batch_indices),
+                                                  metric_helper.target_features(images, batch_indices))
+
+            angles.extend(PoseTable(cams).yaw.cpu().numpy())
+            mse.extend(values["mse"])
+            ms_ssim.extend(values["ms_ssim"])
+            lpips.extend(values["lpips"])
+            id_sim.extend(values["id_sim"])
 
         ms_ssim = np.array(ms_ssim)
         mse = np.array(mse)
@@ -104,6 +115,10 @@ def run_metric(
         print(f"{np.mean(mse)}\t{np.mean(lpips)}\t{np.mean(ms_ssim)}\t{np.mean(id_sim)}")
         print(f"{desc}-------")
 
+    summary = {desc: {key: float(value) for key, value in values.items()} for desc, values in result.items()}
+    with open(f"{rundir}/metrics_{num_samples}.json", "w") as file:
+        json.dump(summary, file)
+    registry_for(rundir).add_metrics(rundir, num_samples, summary)
     return result
 
 
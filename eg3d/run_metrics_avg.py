@@ -1,33 +1,39 @@
-import os
-from typing import List
-
 from run_metrics import run_metric
+from utils.registry import open_registry
 
 
 def run_multiple(
         run_dir: str,
-        run_desc: str,
-        data_path: str,
+        config: dict,
         num_samples: int,
-        original_network: str
+        original_network: str,
+        group_by: tuple = ()
 ):
-    run_list: List[str] = os.listdir(run_dir)
-    matching_runs = [run_dir + "/" + run for run in run_list if run_desc in run]
-    results = []
-    for run in matching_runs:
-        results.append(run_metric(
-            data_path=data_path + "/" + run[-1],
-            num_samples=num_samples,
-            rundir=run,
-            original_network=original_network
-        ))
-    print()
+    # Evaluates every registered run in run_dir whose config matches and that has no metrics for num_samples yet,
+    # then prints the metrics averaged over the matching runs.
+    registry = open_registry(run_dir)
+    for run in registry.find_runs(config):
+        if registry.has_metrics(run["rundir"], num_samples):
+            continue
+        run_metric.main(args=[
+            f"--data-path={run['config']['target_fname']}",
+            f"--num-samples={num_samples}",
+            f"--rundir={run['rundir']}",
+            f"--original-network={original_network}",
+            "--run-w-plus=False"
+        ], standalone_mode=False)
+
+    results = registry.aggregate(num_samples, config, group_by=group_by)
+    for row in results:
+        group = "\t".join(str(row[key]) for key in group_by)
+        print(f"{row['network']}\t{row['metric']}\t{group}\t{row['mean']}\t{row['std']}\t{row['count']}")
+    return results
 
 
 if __name__ == "__main__":
     run_multiple(
         run_dir="out",
-        run_desc="multi_w_targets_5_iter_500_500_inter_depth_reg_data",
-        num_samples=100, original_network="networks/var3-128.pkl",
-        data_path="dataset_preprocessing/ffhq"
+        config={"num_targets": 5, "num_steps": 500, "num_steps_pti": 500, "use_interpolation": True,
+                "depth_reg": True},
+        num_samples=100, original_network="networks/var3-128.pkl"
     )
@@ -1,6 +1,8 @@
-import subprocess
 import os
 
+from utils.jobs import run_job
+from utils.run_dir import find_run
+
 os.environ["CUDA_VISIBLE_DEVICES"] = "0"
 
 
@@ -18,7 +20,11 @@ class MultiWHandler:
             use_interpolation=False,
             depth_reg=False,
             w_norm_reg=True,
-            save_video=False
+            save_video=False,
+            scalar_every=1,
+            flush_every=25,
+            resident=False,
+            skip_done=False
     ):
         self.args = []
         self.args.append(f"--network={network}")
@@ -33,9 +39,28 @@ class MultiWHandler:
         self.args.append(f"--depth-reg={depth_reg}")
         self.args.append(f"--w-norm-reg={w_norm_reg}")
         self.args.append(f"--save-video={save_video}")
+        self.args.append(f"--scalar-every={scalar_every}")
+        self.args.append(f"--flush-every={flush_every}")
+        self.out_dir = out_dir
+        self.config = {
+            "net": network,
+            "target_fname": dataset,
+            "num_steps": num_steps,
+            "num_steps_pti": num_steps_pti,
+            "num_targets": num_targets,
+            "downsampling": downsampling,
+            "continue_w": continue_w,
+            "use_interpolation": use_interpolation,
+            "depth_reg": depth_reg,
+            "w_norm_reg": w_norm_reg
+        }
         self.python = "python"
         self.path_to_program = "multi_inversion_multi_w.py"
-        subprocess.run([self.python, self.path_to_program, *self.args], shell=False)
+        self.command = "run_projection"
+        run_job(self, resident, skip_done)
+
+    def is_done(self):
+        return find_run(self.out_dir, self.config) is not None
 
 
 class SingleWHandler:
@@ -49,7 +74,11 @@ class SingleWHandler:
             num_targets=7,
             downsampling=True,
             optimize_cam=False,
-            save_video=False
+            save_video=False,
+            scalar_every=1,
+            flush_every=25,
+            resident=False,
+            skip_done=False
     ):
         self.args = []
         self.args.append(f"--network={network}")
@@ -61,12 +90,28 @@ class SingleWHandler:
         self.args.append(f"--downsampling={downsampling}")
         self.args.append(f"--optimize-cam={optimize_cam}")
         self.args.append(f"--save-video={save_video}")
+        self.args.append(f"--scalar-every={scalar_every}")
+        self.args.append(f"--flush-every={flush_every}")
+        self.out_dir = out_dir
+        self.config = {
+            "net": network,
+            "target_fname": dataset,
+            "num_steps": num_steps,
+            "num_steps_pti": num_steps_pti,
+            "num_targets": num_targets,
+            "downsampling": downsampling,
+            "optimize_cam": optimize_cam
+        }
 
         # self.python = "/home/barthel/miniconda3/envs/eg3d_3/bin/python"
         self.python = "python"
 
         self.path_to_program = "multi_inversion.py"
-        subprocess.run([self.python, self.path_to_program, *self.args], shell=False)
+        self.command = "run_projection"
+        run_job(self, resident, skip_done)
+
+    def is_done(self):
+        return find_run(self.out_dir, self.config) is not None
 
 
 if __name__ == "__main__":
@@ -0,0 +1,46 @@
+""" Runs a queue of pipeline jobs back to back in one process, keeping networks and loss models resident. """
+import json
+
+import click
+
+from run_pipeline import MultiWHandler, SingleWHandler
+from run_metric_pipeline import MetricHandler
+
+handlers = {
+    "multi_w": MultiWHandler,
+    "single_w": SingleWHandler,
+    "metrics": MetricHandler
+}
+# Pipelines that log through inversion.telemetry and accept its intervals.
+telemetry_modes = {"multi_w", "single_w"}
+
+
+@click.command()
+@click.option('--queue', 'queue_file', help='JSON lines file with one job spec per line', required=True, metavar='FILE')
+@click.option('--skip-done', help='Skip jobs whose outputs already exist', type=bool, default=True, show_default=True)
+@click.option('--scalar-every', help='Steps between logged scalars, unless a job sets its own', type=int, default=1,
+              show_default=True)
+@click.option('--flush-every', help='Steps between reads of the logged scalars, unless a job sets its own', type=int,
+              default=25, show_default=True)
+def run_queue(queue_file: str, skip_done: bool, scalar_every: int, flush_every: int):
+    # A job spec names its pipeline under "mode"; all other entries are arguments of the handler, e.g.
+    # {"mode": "metrics", "rundir": "out/20231018-1531_multiview_9", "dataset": "../dataset_preprocessing/ffhq/1", "num_samples": 180}
+    # The file is read again after every job, so jobs appended while the queue runs are picked up too.
+    num_started = 0
+    while True:
+        with open(queue_file) as file:
+            jobs = [json.loads(line) for line in file if line.strip()]
+        if num_started >= len(jobs):
+            break
+        job = dict(jobs[num_started])
+        num_started += 1
+        print(f"Job {num_started}/{len(jobs)}: {job}")
+        mode = job.pop("mode")
+        defaults = {"skip_done": skip_done}
+        if mode in telemetry_modes:
+            defaults.update(scalar_every=scalar_every, flush_every=flush_every)
+        handlers[mode](**{**defaults, **job}, resident=True)
+
+
+if __name__ == "__main__":
+    run_queue()
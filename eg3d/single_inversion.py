@@ -15,7 +15,7 @@ import pickle
 import dnnlib
 import legacy
 
-from camera_utils import LookAtPoseSampler
+from inversion.utils import create_w_stats
 
 
 def project(
@@ -44,16 +44,7 @@ def project(
     G = copy.deepcopy(G).eval().requires_grad_(False).to(device)  # type: ignore
 
     # Compute w stats.
-    logprint(f'Computing W midpoint and stddev using {w_avg_samples} samples...')
-    z_samples = np.random.RandomState(123).randn(w_avg_samples, G.z_dim)
-    camera_lookat_point = torch.tensor([0, 0, 0.0], device=device)
-    cam2world_pose = LookAtPoseSampler.sample(3.14 / 2, 3.14 / 2, camera_lookat_point, radius=2.7, device=device)
-    intrinsics = torch.tensor([[4.2647, 0, 0.5], [0, 4.2647, 0.5], [0, 0, 1]], device=device)
-    c_samples = torch.cat([cam2world_pose.reshape(-1, 16), intrinsics.reshape(-1, 9)], 1)
-    w_samples = G.mapping(torch.from_numpy(z_samples).to(device), c_samples.repeat(w_avg_samples, 1))  # [N, L, C]
-    w_samples = w_samples[:, :1, :].cpu().numpy().astype(np.float32)  # [N, 1, C]
-    w_avg = np.mean(w_samples, axis=0, keepdims=True)  # [1, 1, C]
-    w_std = (np.sum((w_samples - w_avg) ** 2) / w_avg_samples) ** 0.5
+    w_avg, w_std = create_w_stats(G, w_avg_samples, device)
 
     # Setup noise inputs.
     noise_bufs = {name: buf for (name, buf) in G.backbone.synthesis.named_buffers() if 'noise_const' in name}
@@ -0,0 +1,29 @@
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from camera_utils import FOV_to_intrinsics, LookAtPoseSampler  # noqa: E402
+from training.triplane import TriPlaneGenerator  # noqa: E402
+
+
+def tiny_generator():
+    rendering_kwargs = {
+        'image_resolution': 128, 'disparity_space_sampling': False, 'clamp_mode': 'softplus',
+        'superresolution_module': 'training.superresolution.SuperresolutionHybrid2X', 'c_gen_conditioning_zero': False,
+        'c_scale': 1.0, 'sr_antialias': True, 'depth_resolution': 4, 'depth_resolution_importance': 4,
+        'ray_start': 2.25, 'ray_end': 3.3, 'box_warp': 1,
+    }
+    return TriPlaneGenerator(z_dim=8, c_dim=25, w_dim=8, img_resolution=128, img_channels=3,
+                             mapping_kwargs={'num_layers': 1}, rendering_kwargs=rendering_kwargs,
+                             channel_base=256, channel_max=16).eval().requires_grad_(False)
+
+
+def cameras(n):
+    # n cameras on an arc around the head.
+    poses = [LookAtPoseSampler.sample(3.14 / 2 + 0.2 * i, 3.14 / 2, torch.tensor([0, 0, 0.2]), radius=2.7)
+             for i in range(n)]
+    intrinsics = FOV_to_intrinsics(18.837).reshape(-1, 9)
+    return torch.cat([torch.cat([pose.reshape(-1, 16), intrinsics], 1) for pose in poses])
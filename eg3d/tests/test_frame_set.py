@@ -0,0 +1,33 @@
+""" FrameSet only holds rows for the loaded frames and reads them back in frame order. """
+import numpy as np
+import PIL.Image
+
+from inversion.load_data import FrameSet, load_frame
+
+
+def frame_files(tmp_path, n, size=16):
+    file_names = []
+    for i in range(n):
+        file_name = str(tmp_path / f"{i:03d}.png")
+        PIL.Image.fromarray(np.full([size, size, 3], 10 * i, dtype=np.uint8)).save(file_name)
+        file_names.append(file_name)
+    return file_names
+
+
+def test_lazy_load_allocates_loaded_rows_only(tmp_path):
+    file_names = frame_files(tmp_path, 20)
+    frame_set = FrameSet(file_names, img_resolution=8)
+    frame_set.load([7, 3])
+    assert len(frame_set.frames) == 2
+    frame_set.load([3, 11])
+    assert frame_set.num_rows == 3 and len(frame_set.frames) == 4
+    for i in (11, 7, 3):
+        assert np.array_equal(frame_set.numpy(i), load_frame(file_names[i], 8))
+    assert not frame_set.is_loaded(0)
+
+
+def test_target_batch_is_normalized(tmp_path):
+    frame_set = FrameSet(frame_files(tmp_path, 3), img_resolution=8)
+    batch = frame_set.target_batch([2, 0])
+    assert batch.shape == (2, 3, 8, 8)
+    assert np.allclose(batch[:, 0, 0, 0].numpy(), [20 / 255 * 2 - 1, -1])
@@ -0,0 +1,76 @@
+""" The batched MTCNN path against the single-image PIL path it replaces. """
+import os
+
+import numpy as np
+import PIL.Image
+import pytest
+import torch
+
+from models.mtcnn.mtcnn import MTCNN
+from models.mtcnn.mtcnn_pytorch.src.box_utils import batched_nms, nms, resize_like_pil, get_image_boxes, \
+    get_image_boxes_batch
+from models.mtcnn.mtcnn_pytorch.src.get_nets import PNET_PATH
+
+# A screenshot of the visualizer, showing a rendered face.
+IMAGE_PATH = os.path.join(os.path.dirname(__file__), '..', '..', 'docs', 'visualizer.png')
+
+
+def real_image():
+    if not os.path.isfile(IMAGE_PATH):
+        pytest.skip('test image not found')
+    return PIL.Image.open(IMAGE_PATH).convert('RGB')
+
+
+def as_tensor(image):
+    return torch.from_numpy(np.array(image)).permute(2, 0, 1).unsqueeze(0)
+
+
+def test_resize_like_pil():
+    image = real_image()
+    rng = np.random.RandomState(0)
+    for size in [(120, 200), (43, 71), (24, 24), (900, 1500), (1, 1)] + [tuple(rng.randint(1, 600, 2)) for _ in range(20)]:
+        reference = np.array(image.resize(size[::-1], PIL.Image.BILINEAR), 'float32')
+        resized = resize_like_pil(as_tensor(image).float(), size)[0].permute(1, 2, 0).numpy()
+        assert np.array_equal(resized, reference)
+
+
+def test_get_image_boxes_batch_matches_get_image_boxes():
+    image = real_image()
+    width, height = image.size
+    rng = np.random.RandomState(0)
+    # boxes overlap the image, some cross its borders
+    corners = rng.uniform(-50, 0.9 * min(width, height), (200, 2))
+    boxes = np.round(np.hstack([corners, corners + rng.uniform(60, 400, (200, 1)), rng.uniform(0, 1, (200, 1))]))
+    images = torch.cat([torch.zeros_like(as_tensor(image)), as_tensor(image)]).float()
+    for size in [24, 48]:
+        reference = get_image_boxes(boxes.copy(), image, size=size)
+        img_boxes = get_image_boxes_batch(boxes.copy(), np.ones(len(boxes), 'int64'), images, size=size)
+        assert np.array_equal(img_boxes.numpy(), reference)
+
+
+def test_batched_nms_matches_nms():
+    rng = np.random.RandomState(0)
+    corners = rng.uniform(0, 100, (60, 2))
+    boxes = np.hstack([corners, corners + rng.uniform(5, 40, (60, 2)), rng.uniform(0, 1, (60, 1))])
+    groups = rng.randint(0, 3, 60)
+    for mode in ['union', 'min']:
+        keep = batched_nms(boxes, groups, 0.5, mode)
+        expected = np.concatenate([np.where(groups == g)[0][nms(boxes[groups == g], 0.5, mode)] for g in range(3)])
+        assert np.array_equal(keep, expected)
+
+
+def test_detect_faces_batch_matches_detect_faces():
+    image = real_image()
+    if not os.path.isfile(PNET_PATH):
+        pytest.skip('MTCNN weights not found')
+    mtcnn = MTCNN(device='cpu')
+    boxes, landmarks = mtcnn.detect_faces(image)
+    flipped_boxes, flipped_landmarks = mtcnn.detect_faces(image.transpose(PIL.Image.FLIP_LEFT_RIGHT))
+    images = torch.cat([as_tensor(image), as_tensor(image).flip(3)])
+    results = mtcnn.detect_faces_batch(images)
+    # The net inputs are the same as PIL's; only the float arithmetic of the nets differs between batch sizes.
+    for (batch_boxes, batch_landmarks), (ref_boxes, ref_landmarks) in zip(
+            results, [(boxes, landmarks), (flipped_boxes, flipped_landmarks)]):
+        assert len(batch_boxes) == len(ref_boxes) > 0
+        assert np.allclose(batch_boxes, np.asarray(ref_boxes), atol=1e-3)
+        assert np.allclose(batch_landmarks, np.asarray(ref_landmarks), atol=1e-3)
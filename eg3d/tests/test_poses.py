@@ -0,0 +1,27 @@
+""" PoseTable queries agree with brute-force searches over the cameras. """
+import torch
+
+from conftest import cameras
+from inversion.load_data import CamItem
+from inversion.poses import PoseTable
+
+
+def test_yaw_matches_xz_angle():
+    cs = cameras(5)
+    table = PoseTable(cs)
+    for i in range(len(cs)):
+        x, _, z = CamItem(cs[i:i + 1]).xyz()
+        assert torch.allclose(table.yaw[i], torch.arctan2(z, x))
+
+
+def test_directions_invert_yaw_and_pitch():
+    table = PoseTable(cameras(5))
+    assert torch.allclose(PoseTable.directions(table.yaw, table.pitch), table.direction, atol=1e-6)
+
+
+def test_nearest_on_view_sphere():
+    table = PoseTable(cameras(7))
+    yaw, pitch = torch.rand(20) * 3.14, torch.rand(20) - 0.5
+    angle = torch.arccos((PoseTable.directions(yaw, pitch) @ table.direction.T).clamp(-1, 1))
+    assert torch.equal(table.nearest(yaw, pitch), angle.argmin(dim=1))
+    assert torch.equal(table.nearest(table.yaw, table.pitch), torch.arange(7))
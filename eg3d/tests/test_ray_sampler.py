@@ -0,0 +1,45 @@
+""" The camera cache of RaySampler returns the rays of the current camera values. """
+import torch
+
+from conftest import cameras
+from training.volumetric_rendering.ray_sampler import RaySampler
+
+
+def sample(sampler, c, resolution=8):
+    cam2world_matrix, intrinsics = c[:, :16].view(-1, 4, 4), c[:, 16:25].view(-1, 3, 3)
+    rays = sampler(cam2world_matrix, intrinsics, resolution)
+    limits = sampler.ray_limits(cam2world_matrix, intrinsics, resolution, *rays, box_side_length=1)
+    return rays + limits
+
+
+def test_cached_rays_match_uncached():
+    c = cameras(3)
+    reference = sample(RaySampler(), c)
+    sampler = RaySampler()
+    sampler.camera_cache_size = 2
+    for _ in range(2):
+        for value, expected in zip(sample(sampler, c), reference):
+            assert torch.allclose(value, expected)
+    assert len(sampler._cameras) == 1
+
+
+def test_in_place_update_invalidates_cache():
+    c = cameras(2)
+    sampler = RaySampler()
+    sampler.camera_cache_size = 2
+    sample(sampler, c)
+    c.copy_(cameras(3)[1:])
+    for value, expected in zip(sample(sampler, c), sample(RaySampler(), c)):
+        assert torch.allclose(value, expected)
+
+
+def test_cache_evicts_least_recently_used():
+    sampler = RaySampler()
+    sampler.camera_cache_size = 2
+    cs = [cameras(1) for _ in range(3)]
+    sample(sampler, cs[0])
+    sample(sampler, cs[1])
+    sample(sampler, cs[0])
+    sample(sampler, cs[2])
+    kept = [entry['cameras'][0] for entry in sampler._cameras.values()]
+    assert len(kept) == 2 and kept[0].data_ptr() == cs[0].data_ptr()
@@ -0,0 +1,21 @@
+""" The index-gathered plane sampler matches the reference sample_from_planes. """
+import torch
+
+from training.volumetric_rendering.renderer import generate_planes, plane_projections, sample_from_planes, \
+    sample_from_planes_indexed
+
+
+def test_indexed_sampling_matches_reference():
+    torch.manual_seed(0)
+    plane_axes = generate_planes()
+    planes = torch.randn(2, 3, 4, 16, 16, requires_grad=True)
+    coordinates = torch.rand(2, 50, 3) * 2 - 1
+    reference = sample_from_planes(plane_axes, planes, coordinates, box_warp=2)
+    indexed = sample_from_planes_indexed(plane_projections(plane_axes), planes, coordinates, box_warp=2)
+    assert torch.allclose(indexed, reference, atol=1e-6)
+
+    mean = sample_from_planes_indexed(plane_projections(plane_axes), planes, coordinates, box_warp=2, aggregate='mean')
+    assert torch.allclose(mean, reference.mean(1), atol=1e-6)
+    grad, = torch.autograd.grad(mean.square().sum(), planes)
+    reference_grad, = torch.autograd.grad(reference.mean(1).square().sum(), planes)
+    assert torch.allclose(grad, reference_grad, atol=1e-5)
@@ -0,0 +1,22 @@
+""" Latents rendered from several cameras match rendering every camera with its own copy of the latent. """
+import torch
+
+from conftest import cameras, tiny_generator
+
+
+def test_shared_planes_match_per_view_rendering():
+    G = tiny_generator()
+    torch.manual_seed(0)
+    num_latents, num_views = 2, 3
+    c = cameras(num_views).repeat(num_latents, 1)
+    ws = G.mapping(torch.randn(num_latents, G.z_dim), c[::num_views])
+    outputs = ('image_raw', 'image_depth')
+    # Seeded before each render, since the renderer perturbs its depth samples.
+    torch.manual_seed(1)
+    shared = G.synthesis(ws, c, neural_rendering_resolution=8, outputs=outputs, noise_mode='const')
+    torch.manual_seed(1)
+    per_view = G.synthesis(ws.repeat_interleave(num_views, dim=0), c, neural_rendering_resolution=8, outputs=outputs,
+                           noise_mode='const')
+    for key in outputs:
+        assert shared[key].shape == per_view[key].shape
+        assert torch.allclose(shared[key], per_view[key], atol=1e-5)
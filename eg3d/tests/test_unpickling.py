@@ -0,0 +1,44 @@
+""" Generators pickled before the ray and plane caches existed still render after unpickling. """
+import copy
+import pickle
+
+import torch
+
+from conftest import cameras, tiny_generator
+from training.volumetric_rendering.ray_sampler import RaySampler
+
+
+NEW_ATTRIBUTES = ('_bundles', '_cameras', 'camera_cache_size')
+
+
+def old_pickle(G, monkeypatch):
+    # Pickles G the way it was pickled before the caches existed: without their attributes.
+    monkeypatch.setattr(RaySampler, '__getstate__',
+                        lambda self: {k: v for k, v in self.__dict__.items() if k not in NEW_ATTRIBUTES})
+    G.renderer.__dict__.pop('plane_projections')
+    return pickle.dumps(G)
+
+
+def render(G, c=None):
+    c = cameras(1) if c is None else c
+    # Seeded, since the renderer perturbs its depth samples.
+    torch.manual_seed(0)
+    ws = G.mapping(torch.zeros(1, G.z_dim), c)
+    return G.synthesis(ws, c, neural_rendering_resolution=8, outputs=('image_depth',))['image_depth']
+
+
+def test_unpickled_generator_renders(monkeypatch):
+    G = tiny_generator()
+    reference = render(G)
+    G_old = pickle.loads(old_pickle(G, monkeypatch))
+    assert torch.allclose(render(G_old), reference)
+
+
+def test_deepcopied_generator_renders(monkeypatch):
+    G = tiny_generator()
+    reference = render(G)
+    G_old = copy.deepcopy(pickle.loads(old_pickle(G, monkeypatch)))
+    G_old.ray_sampler.camera_cache_size = 4
+    c = cameras(1)
+    assert torch.allclose(render(G_old, c), reference)
+    assert torch.allclose(render(G_old, c), reference)  # from the camera cache
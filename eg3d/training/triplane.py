@@ -50,7 +50,9 @@ class TriPlaneGenerator(torch.nn.Module):
                 c = torch.zeros_like(c)
         return self.backbone.mapping(z, c * self.rendering_kwargs.get('c_scale', 0), truncation_psi=truncation_psi, truncation_cutoff=truncation_cutoff, update_emas=update_emas)
 
-    def synthesis(self, ws, c, neural_rendering_resolution=None, update_emas=False, cache_backbone=False, use_cached_backbone=False, **synthesis_kwargs):
+    def synthesis(self, ws, c, neural_rendering_resolution=None, update_emas=False, cache_backbone=False, use_cached_backbone=False, outputs=('image', 'image_raw', 'image_depth'), **synthesis_kwargs):
+        # 'outputs' selects the returned images. Without 'image' the superresolution is skipped,
+        # and with only 'image_depth' the colors are not composited either.
         cam2world_matrix = c[:, :16].view(-1, 4, 4)
         intrinsics = c[:, 16:25].view(-1, 3, 3)
 
@@ -61,6 +63,9 @@ class TriPlaneGenerator(torch.nn.Module):
 
         # Create a batch of rays for volume rendering
         ray_origins, ray_directions = self.ray_sampler(cam2world_matrix, intrinsics, neural_rendering_resolution)
+        ray_limits = None
+        if self.rendering_kwargs['ray_start'] == self.rendering_kwargs['ray_end'] == 'auto':
+            ray_limits = self.ray_sampler.ray_limits(cam2world_matrix, intrinsics, neural_rendering_resolution, ray_origins, ray_directions, self.rendering_kwargs['box_warp'])
 
         # Create triplanes by running StyleGAN backbone
         N, M, _ = ray_origins.shape
@@ -74,19 +79,42 @@ class TriPlaneGenerator(torch.nn.Module):
         # Reshape output into three 32-channel planes
         planes = planes.view(len(planes), 3, 32, planes.shape[-2], planes.shape[-1])
 
+        # Each latent may be rendered from several cameras, grouped by latent: latent b renders cameras b*V..(b+1)*V-1.
+        # Its planes are shared by folding the rays of its V cameras into one batch entry, so they are not copied.
+        B = len(planes)
+        assert N % B == 0, 'the cameras must be an equal number per latent'
+        V = N // B
+        if V > 1:
+            ray_origins, ray_directions = ray_origins.reshape(B, V*M, 3), ray_directions.reshape(B, V*M, 3)
+            if ray_limits is not None:
+                ray_limits = tuple(limit.reshape(B, V*M, -1) for limit in ray_limits)
+            ws = ws.repeat_interleave(V, dim=0) if B > 1 else ws.expand(N, -1, -1)
+
         # Perform volume rendering
-        feature_samples, depth_samples, weights_samples = self.renderer(planes, self.decoder, ray_origins, ray_directions, self.rendering_kwargs) # channels last
+        composite_colors = 'image' in outputs or 'image_raw' in outputs
+        feature_samples, depth_samples, weights_samples = self.renderer(planes, self.decoder, ray_origins, ray_directions, self.rendering_kwargs, composite_colors=composite_colors, ray_limits=ray_limits) # channels last
+        if V > 1:
+            depth_samples = depth_samples.reshape(N, M, -1)
+            feature_samples = feature_samples.reshape(N, M, -1) if feature_samples is not None else None
 
-        # Reshape into 'raw' neural-rendered image
         H = W = self.neural_rendering_resolution
+        result = {}
+        if 'image_depth' in outputs:
+            result['image_depth'] = depth_samples.permute(0, 2, 1).reshape(N, 1, H, W)
+        if not composite_colors:
+            return result
+
+        # Reshape into 'raw' neural-rendered image
         feature_image = feature_samples.permute(0, 2, 1).reshape(N, feature_samples.shape[-1], H, W).contiguous()
-        depth_image = depth_samples.permute(0, 2, 1).reshape(N, 1, H, W)
+        rgb_image = feature_image[:, :3]
+        if 'image_raw' in outputs:
+            result['image_raw'] = rgb_image
 
         # Run superresolution to get final image
-        rgb_image = feature_image[:, :3]
-        sr_image = self.superresolution(rgb_image, feature_image, ws, noise_mode=self.rendering_kwargs['superresolution_noise_mode'], **{k:synthesis_kwargs[k] for k in synthesis_kwargs.keys() if k != 'noise_mode'})
+        if 'image' in outputs:
+            result['image'] = self.superresolution(rgb_image, feature_image, ws, noise_mode=self.rendering_kwargs['superresolution_noise_mode'], **{k:synthesis_kwargs[k] for k in synthesis_kwargs.keys() if k != 'noise_mode'})
 
-        return {'image': sr_image, 'image_raw': rgb_image, 'image_depth': depth_image}
+        return result
     
     def sample(self, coordinates, directions, z, c, truncation_psi=1, truncation_cutoff=None, update_emas=False, **synthesis_kwargs):
         # Compute RGB features, density for arbitrary 3D coordinates. Mostly used for extracting shapes. 
@@ -110,6 +138,9 @@ class TriPlaneGenerator(torch.nn.Module):
 from training.networks_stylegan2 import FullyConnectedLayer
 
 class OSGDecoder(torch.nn.Module):
+    # The renderer may hand over the features already averaged over the planes, (N, M, C).
+    plane_aggregation = 'mean'
+
     def __init__(self, n_features, options):
         super().__init__()
         self.hidden_dim = 64
@@ -122,11 +153,12 @@ class OSGDecoder(torch.nn.Module):
         
     def forward(self, sampled_features, ray_directions):
         # Aggregate features
-        sampled_features = sampled_features.mean(1)
+        if sampled_features.ndim == 4:
+            sampled_features = sampled_features.mean(1)
         x = sampled_features
 
         N, M, C = x.shape
-        x = x.view(N*M, C)
+        x = x.reshape(N*M, C)
 
         x = self.net(x)
         x = x.view(N, M, -1)
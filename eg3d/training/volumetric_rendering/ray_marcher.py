@@ -24,7 +24,6 @@ class MipRayMarcher2(nn.Module):
 
     def run_forward(self, colors, densities, depths, rendering_options):
         deltas = depths[:, :, 1:] - depths[:, :, :-1]
-        colors_mid = (colors[:, :, :-1] + colors[:, :, 1:]) / 2
         densities_mid = (densities[:, :, :-1] + densities[:, :, 1:]) / 2
         depths_mid = (depths[:, :, :-1] + depths[:, :, 1:]) / 2
 
@@ -41,7 +40,6 @@ class MipRayMarcher2(nn.Module):
         alpha_shifted = torch.cat([torch.ones_like(alpha[:, :, :1]), 1-alpha + 1e-10], -2)
         weights = alpha * torch.cumprod(alpha_shifted, -2)[:, :, :-1]
 
-        composite_rgb = torch.sum(weights * colors_mid, -2)
         weight_total = weights.sum(2)
         composite_depth = torch.sum(weights * depths_mid, -2) / weight_total
 
@@ -49,6 +47,13 @@ class MipRayMarcher2(nn.Module):
         composite_depth = torch.nan_to_num(composite_depth, float('inf'))
         composite_depth = torch.clamp(composite_depth, torch.min(depths), torch.max(depths))
 
+        # colors=None skips color compositing when only depth is needed
+        if colors is None:
+            return None, composite_depth, weights
+
+        colors_mid = (colors[:, :, :-1] + colors[:, :, 1:]) / 2
+        composite_rgb = torch.sum(weights * colors_mid, -2)
+
         if rendering_options.get('white_back', False):
             composite_rgb = composite_rgb + 1 - weight_total
 
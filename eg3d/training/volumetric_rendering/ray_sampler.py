@@ -13,13 +13,51 @@ The ray sampler is a module that takes in camera matrices and resolution and bat
 Expects cam2world matrices that use the OpenCV camera coordinate system conventions.
 """
 
+import collections
+
 import torch
 
+from training.volumetric_rendering import math_utils
+
+def _is_compiling():
+    is_compiling = getattr(getattr(torch, 'compiler', None), 'is_compiling', None) or \
+        getattr(getattr(torch, '_dynamo', None), 'is_compiling', None)
+    return is_compiling is not None and is_compiling()
+
+
+def _tensor_key(tensor):
+    # Identifies the values of a tensor without reading them back from the device: its memory and layout, and its
+    # version counter, which every in-place update (e.g. an optimizer step on the cameras) increments. Cache entries
+    # keep the tensor alive, so its memory cannot be reused by another tensor while the key is in use.
+    return (tensor.device, tensor.dtype, tensor.data_ptr(), tuple(tensor.shape), tensor.stride(), tensor._version)
+
+
 class RaySampler(torch.nn.Module):
+    # Rays (and ray limits) of the most recently used camera tensors are kept when camera_cache_size > 0, which suits
+    # loops that render the same fixed camera tensors over and over.
+    camera_cache_size = 0
+    bundle_cache_size = 8
+
     def __init__(self):
         super().__init__()
         self.ray_origins_h, self.ray_directions, self.depths, self.image_coords, self.rendering_options = None, None, None, None, None
+        # Camera-space rays per resolution and intrinsics tensor; with them a call only applies the pose transform.
+        self._bundles = collections.OrderedDict()
+        self._cameras = collections.OrderedDict()
 
+    def __getstate__(self):
+        # Caches are not pickled.
+        state = dict(self.__dict__)
+        state['_bundles'] = collections.OrderedDict()
+        state['_cameras'] = collections.OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        # Samplers pickled before the caches existed are unpickled (and deep-copied) without them.
+        super().__setstate__(state)
+        if not isinstance(self.__dict__.get('_bundles'), collections.OrderedDict):
+            self._bundles = collections.OrderedDict()
+        self.__dict__.setdefault('_cameras', collections.OrderedDict())
 
     def forward(self, cam2world_matrix, intrinsics, resolution):
         """
@@ -32,32 +70,86 @@ class RaySampler(torch.nn.Module):
         ray_origins: (N, M, 3)
         ray_dirs: (N, M, 2)
         """
-        N, M = cam2world_matrix.shape[0], resolution**2
+        # Caches are bypassed for camera parameters that are being optimized, so their gradients still flow, and while
+        # torch.compile traces, where the rays become part of the graph.
+        grad = torch.is_grad_enabled()
+        if self._use_camera_cache(cam2world_matrix, intrinsics):
+            entry = self._camera_entry(cam2world_matrix, intrinsics, resolution)
+            return entry['origins'], entry['directions']
+        use_bundles = not (grad and intrinsics.requires_grad or _is_compiling() or intrinsics.is_inference())
+        return self.sample_rays(cam2world_matrix, intrinsics, resolution, use_bundles=use_bundles)
+
+    def _use_camera_cache(self, cam2world_matrix, intrinsics):
+        if self.camera_cache_size == 0 or _is_compiling() or cam2world_matrix.is_inference() or intrinsics.is_inference():
+            return False
+        return not (torch.is_grad_enabled() and (cam2world_matrix.requires_grad or intrinsics.requires_grad))
+
+    def sample_rays(self, cam2world_matrix, intrinsics, resolution, use_bundles=True):
         cam_locs_world = cam2world_matrix[:, :3, 3]
+        cam_rel_points = self._bundle(intrinsics, resolution) if use_bundles else self.lift(intrinsics, resolution)
+
+        world_rel_points = torch.bmm(cam2world_matrix, cam_rel_points.permute(0, 2, 1)).permute(0, 2, 1)[:, :, :3]
+
+        ray_dirs = world_rel_points - cam_locs_world[:, None, :]
+        ray_dirs = torch.nn.functional.normalize(ray_dirs, dim=2)
+
+        ray_origins = cam_locs_world.unsqueeze(1).repeat(1, ray_dirs.shape[1], 1)
+
+        return ray_origins, ray_dirs
+
+    def lift(self, intrinsics, resolution):
+        """
+        Homogeneous camera-space points at depth one through the pixel centers, (N, M, 4).
+        """
+        N, M = intrinsics.shape[0], resolution**2
         fx = intrinsics[:, 0, 0]
         fy = intrinsics[:, 1, 1]
         cx = intrinsics[:, 0, 2]
         cy = intrinsics[:, 1, 2]
         sk = intrinsics[:, 0, 1]
 
-        uv = torch.stack(torch.meshgrid(torch.arange(resolution, dtype=torch.float32, device=cam2world_matrix.device), torch.arange(resolution, dtype=torch.float32, device=cam2world_matrix.device), indexing='ij')) * (1./resolution) + (0.5/resolution)
+        uv = torch.stack(torch.meshgrid(torch.arange(resolution, dtype=torch.float32, device=intrinsics.device), torch.arange(resolution, dtype=torch.float32, device=intrinsics.device), indexing='ij')) * (1./resolution) + (0.5/resolution)
         uv = uv.flip(0).reshape(2, -1).transpose(1, 0)
-        uv = uv.unsqueeze(0).repeat(cam2world_matrix.shape[0], 1, 1)
+        uv = uv.unsqueeze(0).repeat(N, 1, 1)
 
         x_cam = uv[:, :, 0].view(N, -1)
         y_cam = uv[:, :, 1].view(N, -1)
-        z_cam = torch.ones((N, M), device=cam2world_matrix.device)
+        z_cam = torch.ones((N, M), device=intrinsics.device)
 
         x_lift = (x_cam - cx.unsqueeze(-1) + cy.unsqueeze(-1)*sk.unsqueeze(-1)/fy.unsqueeze(-1) - sk.unsqueeze(-1)*y_cam/fy.unsqueeze(-1)) / fx.unsqueeze(-1) * z_cam
         y_lift = (y_cam - cy.unsqueeze(-1)) / fy.unsqueeze(-1) * z_cam
 
-        cam_rel_points = torch.stack((x_lift, y_lift, z_cam, torch.ones_like(z_cam)), dim=-1)
+        return torch.stack((x_lift, y_lift, z_cam, torch.ones_like(z_cam)), dim=-1)
 
-        world_rel_points = torch.bmm(cam2world_matrix, cam_rel_points.permute(0, 2, 1)).permute(0, 2, 1)[:, :, :3]
+    def _bundle(self, intrinsics, resolution):
+        key = (resolution, _tensor_key(intrinsics))
+        if key in self._bundles:
+            self._bundles.move_to_end(key)
+        else:
+            self._bundles[key] = {'intrinsics': intrinsics, 'points': self.lift(intrinsics.detach(), resolution)}
+            while len(self._bundles) > self.bundle_cache_size:
+                self._bundles.popitem(last=False)
+        return self._bundles[key]['points']
 
-        ray_dirs = world_rel_points - cam_locs_world[:, None, :]
-        ray_dirs = torch.nn.functional.normalize(ray_dirs, dim=2)
+    def _camera_entry(self, cam2world_matrix, intrinsics, resolution):
+        key = (resolution, _tensor_key(cam2world_matrix), _tensor_key(intrinsics))
+        if key in self._cameras:
+            self._cameras.move_to_end(key)
+        else:
+            origins, directions = self.sample_rays(cam2world_matrix.detach(), intrinsics.detach(), resolution)
+            self._cameras[key] = {'cameras': (cam2world_matrix, intrinsics), 'origins': origins, 'directions': directions}
+            while len(self._cameras) > self.camera_cache_size:
+                self._cameras.popitem(last=False)
+        return self._cameras[key]
 
-        ray_origins = cam_locs_world.unsqueeze(1).repeat(1, ray_dirs.shape[1], 1)
-
-        return ray_origins, ray_dirs
\ No newline at end of file
+    def ray_limits(self, cam2world_matrix, intrinsics, resolution, ray_origins, ray_directions, box_side_length):
+        """
+        Entry and exit distances of the rays into the rendering box, see math_utils.get_ray_limits_box.
+        They do not depend on gradients, so they are cached per camera whenever the camera cache is on.
+        """
+        if not self._use_camera_cache(cam2world_matrix, intrinsics):
+            return math_utils.get_ray_limits_box(ray_origins, ray_directions, box_side_length=box_side_length)
+        entry = self._camera_entry(cam2world_matrix, intrinsics, resolution)
+        if ('limits', box_side_length) not in entry:
+            entry[('limits', box_side_length)] = math_utils.get_ray_limits_box(entry['origins'], entry['directions'], box_side_length=box_side_length)
+        return entry[('limits', box_side_length)]
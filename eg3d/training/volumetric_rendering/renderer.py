@@ -16,6 +16,7 @@ ray, and computes pixel colors using the volume rendering equation.
 import math
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
 
 from training.volumetric_rendering.ray_marcher import MipRayMarcher2
 from training.volumetric_rendering import math_utils
@@ -64,6 +65,45 @@ def sample_from_planes(plane_axes, plane_features, coordinates, mode='bilinear',
     output_features = torch.nn.functional.grid_sample(plane_features, projected_coordinates.float(), mode=mode, padding_mode=padding_mode, align_corners=False).permute(0, 3, 2, 1).reshape(N, n_planes, M, C)
     return output_features
 
+def plane_projections(planes):
+    """
+    The projections of project_onto_planes as coordinate indices, for plane
+    axes that are permutations of the coordinate axes.
+
+    Takes plane axes of shape n_planes, 3, 3
+    Returns indices of shape n_planes, 2, or None for other plane axes
+    """
+    inv_planes = torch.linalg.inv(planes)
+    is_permutation = ((inv_planes == 0) | (inv_planes == 1)).all() and (inv_planes.sum(1) == 1).all()
+    if not is_permutation:
+        return None
+    return inv_planes.argmax(1)[:, :2]
+
+def sample_from_planes_indexed(projections, plane_features, coordinates, mode='bilinear', padding_mode='zeros', box_warp=None, aggregate=None):
+    """
+    sample_from_planes with the projections gathered by index (see plane_projections)
+    instead of inverted plane axes and a bmm. The planes are still sampled by one
+    grid_sample whose output holds the features of every plane.
+    With aggregate='mean' the planes are averaged in place in that output and
+    (N, M, C) is returned, without the permuted (N, n_planes, M, C) copy.
+    """
+    assert padding_mode == 'zeros'
+    N, n_planes, C, H, W = plane_features.shape
+    _, M, _ = coordinates.shape
+    plane_features = plane_features.view(N*n_planes, C, H, W)
+
+    coordinates = (2/box_warp) * coordinates
+
+    projected_coordinates = coordinates[..., projections.reshape(-1)].view(N, M, n_planes, 2).permute(0, 2, 1, 3).reshape(N*n_planes, 1, M, 2)
+    output_features = torch.nn.functional.grid_sample(plane_features, projected_coordinates.float(), mode=mode, padding_mode=padding_mode, align_corners=False).view(N, n_planes, C, M)
+    if aggregate == 'mean':
+        # grid_sample does not keep its output for the backward pass, so it can be summed into in place.
+        aggregated = output_features[:, 0]
+        for i in range(1, n_planes):
+            aggregated.add_(output_features[:, i])
+        return aggregated.div_(n_planes).permute(0, 2, 1)
+    return output_features.permute(0, 1, 3, 2).contiguous()
+
 def sample_from_3dgrid(grid, coordinates):
     """
     Expects coordinates in shape (batch_size, num_points_per_batch, 3)
@@ -84,20 +124,70 @@ class ImportanceRenderer(torch.nn.Module):
         super().__init__()
         self.ray_marcher = MipRayMarcher2()
         self.plane_axes = generate_planes()
-
-    def forward(self, planes, decoder, ray_origins, ray_directions, rendering_options):
+        self.plane_projections = plane_projections(self.plane_axes)
+
+    def __setstate__(self, state):
+        # Renderers pickled before the plane projections existed are unpickled (and deep-copied) without them.
+        super().__setstate__(state)
+        if 'plane_projections' not in self.__dict__:
+            self.plane_projections = plane_projections(self.plane_axes)
+
+    def forward(self, planes, decoder, ray_origins, ray_directions, rendering_options, composite_colors=True, ray_limits=None):
+        # With composite_colors=False only depth and weights are rendered; the returned colors are None.
+        # ray_limits are precomputed 'auto' limits of the rays, e.g. cached per camera by the RaySampler.
+        # With rendering_options['ray_chunk_memory_mb'] set, the rays are rendered in chunks that fit the budget,
+        # optionally with gradient checkpointing per chunk (rendering_options['ray_chunk_checkpoint']).
         self.plane_axes = self.plane_axes.to(ray_origins.device)
 
         if rendering_options['ray_start'] == rendering_options['ray_end'] == 'auto':
-            ray_start, ray_end = math_utils.get_ray_limits_box(ray_origins, ray_directions, box_side_length=rendering_options['box_warp'])
+            # Limits of all rays, so that invalid rays get the same fallback whether or not the rays are chunked.
+            if ray_limits is None:
+                ray_limits = math_utils.get_ray_limits_box(ray_origins, ray_directions, box_side_length=rendering_options['box_warp'])
+            ray_start, ray_end = ray_limits[0].clone(), ray_limits[1].clone()  # invalid rays are filled in place
             is_ray_valid = ray_end > ray_start
             if torch.any(is_ray_valid).item():
                 ray_start[~is_ray_valid] = ray_start[is_ray_valid].min()
                 ray_end[~is_ray_valid] = ray_start[is_ray_valid].max()
-            depths_coarse = self.sample_stratified(ray_origins, ray_start, ray_end, rendering_options['depth_resolution'], rendering_options['disparity_space_sampling'])
         else:
-            # Create stratified depth samples
-            depths_coarse = self.sample_stratified(ray_origins, rendering_options['ray_start'], rendering_options['ray_end'], rendering_options['depth_resolution'], rendering_options['disparity_space_sampling'])
+            ray_start, ray_end = rendering_options['ray_start'], rendering_options['ray_end']
+
+        num_rays = ray_origins.shape[1]
+        chunk_size = self.ray_chunk_size(planes, rendering_options)
+        if chunk_size is None or chunk_size >= num_rays:
+            return self.render_rays(planes, decoder, ray_origins, ray_directions, ray_start, ray_end, rendering_options, composite_colors)
+
+        checkpoint = rendering_options.get('ray_chunk_checkpoint', False) and self.training and torch.is_grad_enabled()
+        rgb_chunks, depth_chunks, weight_chunks = [], [], []
+        for start in range(0, num_rays, chunk_size):
+            rays = slice(start, start + chunk_size)
+            chunk_args = (planes, decoder, ray_origins[:, rays], ray_directions[:, rays],
+                          ray_start[:, rays] if isinstance(ray_start, torch.Tensor) else ray_start,
+                          ray_end[:, rays] if isinstance(ray_end, torch.Tensor) else ray_end,
+                          rendering_options, composite_colors)
+            if checkpoint:
+                # Only the chunk inputs are kept; the chunk is rendered again (with the same random samples) in backward.
+                rgb, depth, weights = torch.utils.checkpoint.checkpoint(self.render_rays, *chunk_args, use_reentrant=False)
+            else:
+                rgb, depth, weights = self.render_rays(*chunk_args)
+            rgb_chunks.append(rgb)
+            depth_chunks.append(depth)
+            weight_chunks.append(weights)
+        rgb_final = torch.cat(rgb_chunks, dim=1) if composite_colors else None
+        return rgb_final, torch.cat(depth_chunks, dim=1), torch.cat(weight_chunks, dim=1)
+
+    def ray_chunk_size(self, planes, rendering_options):
+        # Number of rays whose samples fit into the memory budget, or None if rays are not chunked.
+        budget_mb = rendering_options.get('ray_chunk_memory_mb', None)
+        if not budget_mb:
+            return None
+        batch_size, n_planes, channels = planes.shape[:3]
+        samples_per_ray = rendering_options['depth_resolution'] + rendering_options['depth_resolution_importance']
+        # Per sample: the features sampled from every plane, their aggregate, the decoder activations and outputs.
+        bytes_per_ray = batch_size * samples_per_ray * (n_planes + 3) * channels * planes.element_size()
+        return max(1, int(budget_mb * 2 ** 20 // bytes_per_ray))
+
+    def render_rays(self, planes, decoder, ray_origins, ray_directions, ray_start, ray_end, rendering_options, composite_colors=True):
+        depths_coarse = self.sample_stratified(ray_origins, ray_start, ray_end, rendering_options['depth_resolution'], rendering_options['disparity_space_sampling'])
 
         batch_size, num_rays, samples_per_ray, _ = depths_coarse.shape
 
@@ -109,7 +199,7 @@ class ImportanceRenderer(torch.nn.Module):
         out = self.run_model(planes, decoder, sample_coordinates, sample_directions, rendering_options)
         colors_coarse = out['rgb']
         densities_coarse = out['sigma']
-        colors_coarse = colors_coarse.reshape(batch_size, num_rays, samples_per_ray, colors_coarse.shape[-1])
+        colors_coarse = colors_coarse.reshape(batch_size, num_rays, samples_per_ray, colors_coarse.shape[-1]) if composite_colors else None
         densities_coarse = densities_coarse.reshape(batch_size, num_rays, samples_per_ray, 1)
 
         # Fine Pass
@@ -125,7 +215,7 @@ class ImportanceRenderer(torch.nn.Module):
             out = self.run_model(planes, decoder, sample_coordinates, sample_directions, rendering_options)
             colors_fine = out['rgb']
             densities_fine = out['sigma']
-            colors_fine = colors_fine.reshape(batch_size, num_rays, N_importance, colors_fine.shape[-1])
+            colors_fine = colors_fine.reshape(batch_size, num_rays, N_importance, colors_fine.shape[-1]) if composite_colors else None
             densities_fine = densities_fine.reshape(batch_size, num_rays, N_importance, 1)
 
             all_depths, all_colors, all_densities = self.unify_samples(depths_coarse, colors_coarse, densities_coarse,
@@ -140,7 +230,14 @@ class ImportanceRenderer(torch.nn.Module):
         return rgb_final, depth_final, weights.sum(2)
 
     def run_model(self, planes, decoder, sample_coordinates, sample_directions, options):
-        sampled_features = sample_from_planes(self.plane_axes, planes, sample_coordinates, padding_mode='zeros', box_warp=options['box_warp'])
+        # sample_from_planes stays available as the numerical reference (rendering_options['reference_plane_sampling']).
+        if self.plane_projections is None or options.get('reference_plane_sampling', False):
+            sampled_features = sample_from_planes(self.plane_axes.to(planes.device), planes, sample_coordinates, padding_mode='zeros', box_warp=options['box_warp'])
+        else:
+            self.plane_projections = self.plane_projections.to(planes.device)
+            # Decoders that average the planes anyway get the average, see OSGDecoder.
+            aggregate = getattr(decoder, 'plane_aggregation', None)
+            sampled_features = sample_from_planes_indexed(self.plane_projections, planes, sample_coordinates, padding_mode='zeros', box_warp=options['box_warp'], aggregate=aggregate)
 
         out = decoder(sampled_features, sample_directions)
         if options.get('density_noise', 0) > 0:
@@ -156,12 +253,14 @@ class ImportanceRenderer(torch.nn.Module):
 
     def unify_samples(self, depths1, colors1, densities1, depths2, colors2, densities2):
         all_depths = torch.cat([depths1, depths2], dim = -2)
-        all_colors = torch.cat([colors1, colors2], dim = -2)
         all_densities = torch.cat([densities1, densities2], dim = -2)
 
         _, indices = torch.sort(all_depths, dim=-2)
         all_depths = torch.gather(all_depths, -2, indices)
-        all_colors = torch.gather(all_colors, -2, indices.expand(-1, -1, -1, all_colors.shape[-1]))
+        all_colors = None
+        if colors1 is not None:
+            all_colors = torch.cat([colors1, colors2], dim = -2)
+            all_colors = torch.gather(all_colors, -2, indices.expand(-1, -1, -1, all_colors.shape[-1]))
         all_densities = torch.gather(all_densities, -2, indices.expand(-1, -1, -1, 1))
 
         return all_depths, all_colors, all_densities
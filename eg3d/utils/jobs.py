@@ -0,0 +1,22 @@
+import importlib
+import subprocess
+import traceback
+
+
+def run_job(handler, resident: bool, skip_done: bool = False):
+    # Runs the program of a pipeline handler with its arguments; with skip_done, not if its outputs already exist.
+    # Resident jobs run in this process, so networks and loss models loaded by earlier jobs are reused
+    # (see inversion.resident); otherwise every job starts a fresh python process.
+    if skip_done and handler.is_done():
+        print(f"Skipping {handler.path_to_program} {' '.join(handler.args)}: outputs exist")
+        return
+    if resident:
+        module = importlib.import_module(handler.path_to_program[:-len(".py")])
+        command = getattr(module, handler.command)
+        try:
+            command.main(args=handler.args, standalone_mode=False)
+        except Exception:
+            # Like a failed subprocess, a failed job does not stop the jobs after it.
+            traceback.print_exc()
+    else:
+        subprocess.run([handler.python, handler.path_to_program, *handler.args], shell=False)
@@ -0,0 +1,209 @@
+import json
+import os
+import re
+import sqlite3
+import time
+from contextlib import closing
+from typing import Dict, List, Optional
+
+from utils.run_dir import RESULT_FILE
+
+REGISTRY_FILE = "runs.sqlite"
+_SUMMARY_PATTERN = re.compile(r'^metrics_(\d+)\.json$')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    rundir TEXT PRIMARY KEY,
+    program TEXT,
+    net TEXT,
+    target_fname TEXT,
+    time_project_w REAL,
+    time_pti REAL,
+    finished REAL,
+    config TEXT NOT NULL,
+    artifacts TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_target ON runs (net, target_fname);
+CREATE TABLE IF NOT EXISTS metrics (
+    rundir TEXT NOT NULL,
+    network TEXT NOT NULL,
+    num_samples INTEGER NOT NULL,
+    metric TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (rundir, network, num_samples, metric)
+);
+"""
+
+
+class RunRegistry:
+    """SQLite index of the finished runs in an output folder and the metric summaries computed for them.
+
+    Runs and metric jobs add themselves when they finish, so lookups never have to scan the run dirs.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        is_new = not os.path.isfile(path)
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+        if is_new:
+            # Runs finished before the registry existed are indexed once from their folders.
+            self.import_dirs(os.path.dirname(path))
+
+    def _connect(self):
+        # Several jobs may finish at the same time, so writers wait for each other instead of failing.
+        return _Connection(sqlite3.connect(self.path, timeout=60))
+
+    def add_run(self, rundir: str, config: dict, artifacts: Dict[str, str], program: Optional[str] = None):
+        # The W phase time is called time_w by multi_inversion_multi_w.py.
+        time_project_w = config.get("time_project_w", config.get("time_w"))
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (_key(rundir), program, config.get("net"), config.get("target_fname"), time_project_w,
+                 config.get("time_pti"), time.time(), json.dumps(config), json.dumps(artifacts))
+            )
+
+    def add_metrics(self, rundir: str, num_samples: int, summary: Dict[str, Dict[str, float]]):
+        # summary maps the evaluated network (original_net, PTI_net) to its metric means.
+        rows = [(_key(rundir), network, num_samples, metric, None if value is None else float(value))
+                for network, values in summary.items() for metric, value in values.items()]
+        with self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?, ?)", rows)
+
+    def find_runs(self, config: Optional[dict] = None, program: Optional[str] = None) -> List[dict]:
+        # Finished runs whose config contains all entries of config, oldest first.
+        where = ["1"]
+        params = []
+        for key, value in (config or {}).items():
+            where.append("json_extract(config, ?) IS ?")
+            params += ["$." + key, _json_scalar(value)]
+        if program is not None:
+            where.append("program = ?")
+            params.append(program)
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT rundir, program, time_project_w, time_pti, config, artifacts FROM runs "
+                f"WHERE {' AND '.join(where)} ORDER BY rundir", params
+            ).fetchall()
+        return [{
+            "rundir": rundir,
+            "program": program,
+            "time_project_w": time_project_w,
+            "time_pti": time_pti,
+            "config": json.loads(config),
+            "artifacts": json.loads(artifacts)
+        } for rundir, program, time_project_w, time_pti, config, artifacts in rows]
+
+    def find_run(self, config: dict) -> Optional[str]:
+        runs = self.find_runs(config)
+        return runs[0]["rundir"] if len(runs) > 0 else None
+
+    def has_metrics(self, rundir: str, num_samples: int) -> bool:
+        with self._connect() as conn:
+            row = conn.execute("SELECT 1 FROM metrics WHERE rundir = ? AND num_samples = ? LIMIT 1",
+                               (_key(rundir), num_samples)).fetchone()
+        return row is not None
+
+    def metrics(self, rundir: str, num_samples: int) -> Dict[str, Dict[str, float]]:
+        with self._connect() as conn:
+            rows = conn.execute("SELECT network, metric, value FROM metrics WHERE rundir = ? AND num_samples = ?",
+                                (_key(rundir), num_samples)).fetchall()
+        summary = {}
+        for network, metric, value in rows:
+            summary.setdefault(network, {})[metric] = value
+        return summary
+
+    def aggregate(self, num_samples: int, config: Optional[dict] = None, group_by: tuple = ()) -> List[dict]:
+        # Mean, standard deviation and run count of every metric over the matching runs (usually one per subject),
+        # separately for every combination of the config entries in group_by.
+        runs = {run["rundir"]: run for run in self.find_runs(config)}
+        if len(runs) == 0:
+            return []
+        group_columns = "".join(", json_extract(runs.config, ?)" for _ in group_by)
+        group_ordinals = "".join(f", {i + 3}" for i in range(len(group_by)))
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT metrics.network, metrics.metric{group_columns}, "
+                f"AVG(metrics.value), AVG(metrics.value * metrics.value), COUNT(metrics.value) "
+                f"FROM metrics JOIN runs ON runs.rundir = metrics.rundir "
+                f"WHERE metrics.num_samples = ? AND metrics.rundir IN ({', '.join('?' * len(runs))}) "
+                f"GROUP BY 1, 2{group_ordinals} ORDER BY 1, 2{group_ordinals}",
+                ["$." + key for key in group_by] + [num_samples, *runs.keys()]
+            ).fetchall()
+        result = []
+        for row in rows:
+            network, metric, group, (mean, mean_sq, count) = row[0], row[1], row[2:-3], row[-3:]
+            std = None if mean is None else max(mean_sq - mean ** 2, 0) ** 0.5
+            result.append({"network": network, "metric": metric, **dict(zip(group_by, group)),
+                           "mean": mean, "std": std, "count": count})
+        return result
+
+    def import_dirs(self, out_dir: str):
+        # Indexes the finished runs in out_dir together with their metric summaries.
+        for run in sorted(os.listdir(out_dir)):
+            rundir = out_dir + "/" + run
+            config_file = rundir + "/config.json"
+            if not os.path.isfile(config_file):
+                continue
+            artifacts = run_artifacts(rundir)
+            if "result" not in artifacts and "generator" not in artifacts:
+                continue
+            with open(config_file) as file:
+                self.add_run(rundir, json.load(file), artifacts)
+            for file_name in os.listdir(rundir):
+                match = _SUMMARY_PATTERN.match(file_name)
+                if match is not None:
+                    with open(rundir + "/" + file_name) as file:
+                        self.add_metrics(rundir, int(match.group(1)), json.load(file))
+
+
+class _Connection:
+    # sqlite3 connections commit as context managers but stay open; this one is also closed afterwards.
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def __enter__(self) -> sqlite3.Connection:
+        return self.conn.__enter__()
+
+    def __exit__(self, *exc):
+        with closing(self.conn):
+            return self.conn.__exit__(*exc)
+
+
+def _key(rundir: str) -> str:
+    return os.path.normpath(rundir)
+
+
+def _json_scalar(value):
+    # Values as json_extract returns them: JSON booleans come back as integers.
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, separators=(",", ":"))
+    return value
+
+
+def run_artifacts(rundir: str) -> Dict[str, str]:
+    # Output files of a run by kind; only files that exist are listed.
+    candidates = {
+        "result": RESULT_FILE,
+        "generator": "fintuned_generator.pkl",
+        "projected_w": "projected_w.npz",
+        "target": "target.png",
+        "projection": "proj.png",
+        "video": "proj.mp4",
+        "snapshots": "pti_snapshots.bin"
+    }
+    return {kind: rundir + "/" + file_name for kind, file_name in candidates.items()
+            if os.path.isfile(rundir + "/" + file_name)}
+
+
+def registry_for(rundir: str) -> RunRegistry:
+    # Every output folder keeps its own registry beside its runs.
+    return open_registry(os.path.dirname(os.path.normpath(rundir)))
+
+
+def open_registry(out_dir: str) -> RunRegistry:
+    os.makedirs(out_dir, exist_ok=True)
+    return RunRegistry(os.path.join(out_dir, REGISTRY_FILE))
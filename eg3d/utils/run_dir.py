@@ -1,20 +1,27 @@
-import glob
+import os
 import re
 
 
+RESULT_FILE = "pti_result.bin"  # see inversion.results
+CHECKPOINT_PATTERN = re.compile(r'^(\d+)_projected_w(_mult)?\.npz$')
+
+
 def get_pkl_and_w(rundir: str, verbose=False):
+    # Generator and latent files of a run. Runs with a compact result file store both in it;
+    # older runs have a pickled generator and the latents of the last {step}_projected_w checkpoint.
+    result_file = rundir + "/" + RESULT_FILE
+    if os.path.isfile(result_file):
+        if verbose:
+            print(f"Loading: {result_file}")
+        return result_file, result_file
+
     network_pkl = rundir + "/fintuned_generator.pkl"
-    w_files = glob.glob(rundir + "/*.npz")
     max_num = -1
     max_file = ""
-    for w_file in w_files:
-        w_file = w_file.split("/")[-1].split("\\")[-1]
-        all_nums = re.findall(r'\d+', w_file)
-        if len(all_nums) == 0:
-            continue
-        current_num = int(all_nums[0])
-        if current_num > max_num:
-            max_num = current_num
+    for w_file in os.listdir(rundir):
+        match = CHECKPOINT_PATTERN.match(w_file)
+        if match is not None and int(match.group(1)) > max_num:
+            max_num = int(match.group(1))
             max_file = w_file
     w_path = rundir + "/" + max_file
     if verbose:
@@ -23,3 +30,35 @@ def get_pkl_and_w(rundir: str, verbose=False):
         print(f"\tGenerator: {network_pkl}")
 
     return network_pkl, w_path
+
+
+def find_run(out_dir: str, config: dict):
+    # Finished run in out_dir whose config contains config; None if there is none.
+    if not os.path.isdir(out_dir):
+        return None
+    from utils.registry import open_registry
+    return open_registry(out_dir).find_run(config)
+
+
+def load_checkpoint(w_path: str) -> dict:
+    # Latents from a compact result file or a .npz checkpoint.
+    import numpy as np
+    if w_path.endswith(RESULT_FILE):
+        from inversion.results import load_latents
+        return load_latents(w_path)
+    checkpoint = np.load(w_path)
+    return {key: checkpoint[key] for key in checkpoint.keys()}
+
+
+def load_run(rundir: str, verbose=False):
+    # Fine-tuned generator (on the CPU) and final latents of a run, from whichever format the run was saved in.
+    network_pkl, w_path = get_pkl_and_w(rundir, verbose=verbose)
+    if network_pkl.endswith(RESULT_FILE):
+        from inversion.results import load_result
+        return load_result(network_pkl)
+
+    import dnnlib
+    import legacy
+    with dnnlib.util.open_url(network_pkl) as fp:
+        G = legacy.load_network_pkl(fp)['G_ema']
+    return G, load_checkpoint(w_path)
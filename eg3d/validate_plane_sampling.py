@@ -0,0 +1,76 @@
+""" Comparing the index-gathered triplane sampler against the reference sample_from_planes. """
+from time import perf_counter
+
+import click
+import numpy as np
+import torch
+
+from camera_utils import LookAtPoseSampler, FOV_to_intrinsics
+from inversion.resident import load_network_data
+from inversion.utils import reload_modules
+
+
+def render(G, ws, c, *, reference, backward, num_steps, seed, device):
+    # Outputs of the first render and seconds of every render, including the backward pass to the latent.
+    G.rendering_kwargs['reference_plane_sampling'] = reference
+    outputs, step_times = None, []
+    for _ in range(num_steps):
+        torch.manual_seed(seed)  # the renderer perturbs its depth samples
+        start_time = perf_counter()
+        result = G.synthesis(ws, c=c, noise_mode='const', outputs=('image_raw', 'image_depth'))
+        if backward:
+            result['image_raw'].square().mean().backward()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        step_times.append(perf_counter() - start_time)
+        if outputs is None:
+            outputs = {key: value.detach().clone() for key, value in result.items()}
+            if backward:
+                outputs['grad'] = ws.grad.detach().clone()
+        ws.grad = None
+    return outputs, np.array(step_times)
+
+
+@click.command()
+@click.option('--network', 'network_pkl', help='Network pickle filename', required=True)
+@click.option('--device', 'device_name', help='Device to render on', default='cpu', show_default=True)
+@click.option('--batch-size', help='Number of views rendered at once', type=int, default=1, show_default=True)
+@click.option('--num-steps', help='Number of timed renders per sampler', type=int, default=5, show_default=True)
+@click.option('--backward', help='Also compare the gradients of the latent', type=bool, default=True,
+              show_default=True)
+@click.option('--seed', help='Random seed', type=int, default=0, show_default=True)
+def validate(
+        network_pkl: str,
+        device_name: str,
+        batch_size: int,
+        num_steps: int,
+        backward: bool,
+        seed: int
+):
+    device = torch.device(device_name)
+    G = reload_modules(load_network_data(network_pkl)['G_ema']).eval().requires_grad_(False).to(device)
+    G.rendering_kwargs["ray_start"] = 2.35
+
+    cam2world_pose = LookAtPoseSampler.sample(np.pi / 2, np.pi / 2, torch.tensor([0, 0, 0.2], device=device),
+                                              radius=2.7, device=device)
+    intrinsics = FOV_to_intrinsics(18.837, device=device)
+    c = torch.cat([cam2world_pose.reshape(-1, 16), intrinsics.reshape(-1, 9)], 1).repeat(batch_size, 1)
+    z = torch.from_numpy(np.random.RandomState(seed).randn(batch_size, G.z_dim)).float().to(device)
+    with torch.no_grad():
+        ws = G.mapping(z, c, truncation_psi=0.7)
+    ws.requires_grad_(backward)
+
+    reference, reference_times = render(G, ws, c, reference=True, backward=backward, num_steps=num_steps, seed=seed,
+                                        device=device)
+    indexed, indexed_times = render(G, ws, c, reference=False, backward=backward, num_steps=num_steps, seed=seed,
+                                    device=device)
+    for key in reference:
+        diff = (indexed[key] - reference[key]).abs()
+        print(f"{key:<12} max abs diff {diff.max().item():.3e}   mean abs diff {diff.mean().item():.3e}")
+    print(f"reference median {np.median(reference_times) * 1000:9.1f} ms")
+    print(f"indexed   median {np.median(indexed_times) * 1000:9.1f} ms")
+    print(f"speedup {np.median(reference_times) / np.median(indexed_times):.2f}x")
+
+
+if __name__ == "__main__":
+    validate()
@@ -0,0 +1,143 @@
+""" Measuring how far mixed-precision inversion drifts from fp32. """
+import json
+import os
+from time import perf_counter
+
+import click
+import numpy as np
+import torch
+from torch.utils.tensorboard import SummaryWriter
+
+from inversion.image_selection import select_evenly
+from inversion.load_data import load, prefetch, target_batch
+from inversion.metrics import Metrics
+from inversion.precision import PRECISIONS
+from inversion.pti_inversion import project_pti
+from inversion.resident import load_network_data, resident
+from inversion.telemetry import Telemetry
+from inversion.w_inversion import project
+from torch_utils import misc
+
+
+def invert(G, images, target_indices, *, precision, seed, num_steps, num_steps_pti, device, outdir, downsampling):
+    # W inversion and PTI of one subject, as in multi_inversion.py with batched views.
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    os.makedirs(outdir, exist_ok=True)
+    writer = Telemetry(SummaryWriter(outdir))
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+    start_time = perf_counter()
+    projected_w_steps = project(G, images=images, num_steps=num_steps, device=device, outdir=outdir,
+                                target_indices=target_indices, writer=writer, downsampling=downsampling,
+                                w_plus=True, batch_views=True, precision=precision)
+    time_project_w = perf_counter() - start_time
+    start_time = perf_counter()
+    G_steps = project_pti(G, images=images, w_pivot=projected_w_steps[-1:], num_steps=num_steps_pti, device=device,
+                          outdir=outdir, target_indices=target_indices, writer=writer, downsampling=downsampling,
+                          precision=precision)
+    time_pti = perf_counter() - start_time
+    writer.close()
+
+    return projected_w_steps[-1], G_steps[-1], {
+        "time_project_w": time_project_w,
+        "time_pti": time_pti,
+        "peak_memory_mb": torch.cuda.max_memory_allocated(device) / 2 ** 20 if device.type == 'cuda' else None
+    }
+
+
+def evaluate(G, w, images, indices, *, device, batch_size):
+    # Metric means of the fine-tuned generator, always rendered in fp32 so only the optimization differs.
+    metric_helper = resident("Metrics", Metrics)
+    G = G.to(device).eval().requires_grad_(False)
+    values = {"mse": [], "ms_ssim": [], "lpips": [], "id_sim": []}
+    for start in range(0, len(indices), batch_size):
+        batch_indices = indices[start:start + batch_size]
+        cams = torch.cat([images[i].c_item.c for i in batch_indices]).detach()
+        with torch.no_grad():
+            ws = w.to(device).unsqueeze(0).repeat(len(batch_indices), 1, 1)
+            synth = G.synthesis(ws, c=cams, noise_mode='const')['image']
+        result = metric_helper.evaluate_batch(synth, target_batch(images, batch_indices),
+                                              metric_helper.target_features(images, batch_indices))
+        for key in values:
+            values[key] += [float(value) for value in result[key] if value is not None]
+    return {key: float(np.mean(value)) if len(value) > 0 else None for key, value in values.items()}
+
+
+def relative_l2(a: torch.Tensor, b: torch.Tensor) -> float:
+    return float((a.float() - b.float()).norm() / b.float().norm().clamp(min=1e-12))
+
+
+@click.command()
+@click.option('--network', 'network_pkl', help='Network pickle filename', required=True)
+@click.option('--target', 'target_fname', help='Target folder of a subject', required=True, metavar='DIR')
+@click.option('--precision', help='Precision compared against fp32', type=click.Choice(PRECISIONS[1:]), default='bf16',
+              show_default=True)
+@click.option('--device', 'device_name', help='Device; bf16 also runs on the CPU',
+              default='cuda' if torch.cuda.is_available() else 'cpu', show_default=True)
+@click.option('--num-steps', help='Number of optimization steps', type=int, default=100, show_default=True)
+@click.option('--num-steps-pti', help='Number of optimization steps for pivot tuning', type=int, default=50,
+              show_default=True)
+@click.option('--num-targets', help='Number of targets to use for inversion', default=3, show_default=True)
+@click.option('--num-samples', help='Number of frames the metrics are computed on', default=20, show_default=True)
+@click.option('--batch-size', help='Number of frames rendered and evaluated at once', default=4, show_default=True)
+@click.option('--downsampling', help='Downsample images from 512 to 256', type=bool, default=True, show_default=True)
+@click.option('--seed', help='Random seed', type=int, default=303, show_default=True)
+@click.option('--outdir', help='Where to save the runs and the report', required=True, metavar='DIR')
+def validate(
+        network_pkl: str,
+        target_fname: str,
+        precision: str,
+        device_name: str,
+        num_steps: int,
+        num_steps_pti: int,
+        num_targets: int,
+        num_samples: int,
+        batch_size: int,
+        downsampling: bool,
+        seed: int,
+        outdir: str
+):
+    # Inverts the same subject with the same seed in fp32 and in the given precision, then reports the drift of the
+    # final latent and generator weights, the metrics of both runs and their timings.
+    device = torch.device(device_name)
+    G = load_network_data(network_pkl)['G_ema'].requires_grad_(False).to(device)
+    G.rendering_kwargs["ray_start"] = 2.35
+
+    images = load(target_fname, img_resolution=G.img_resolution, device=device, lazy=True)
+    target_indices = select_evenly(images, num_targets)
+    metric_indices = select_evenly(images, num_samples)
+    prefetch(images, list(target_indices) + list(metric_indices))
+
+    runs = {}
+    for mode in ("fp32", precision):
+        w, G_final, timings = invert(G, images, target_indices, precision=mode, seed=seed, num_steps=num_steps,
+                                     num_steps_pti=num_steps_pti, device=device, outdir=f"{outdir}/{mode}",
+                                     downsampling=downsampling)
+        metrics = evaluate(G_final, w, images, metric_indices, device=device, batch_size=batch_size)
+        runs[mode] = dict(w=w, G=G_final.cpu(), timings=timings, metrics=metrics)
+
+    reference, mixed = runs["fp32"], runs[precision]
+    reference_params = dict(misc.named_params_and_buffers(reference["G"]))
+    weight_drift = max(relative_l2(tensor, reference_params[name])
+                       for name, tensor in misc.named_params_and_buffers(mixed["G"]) if tensor.is_floating_point())
+    report = {
+        "precision": precision,
+        "device": str(device),
+        "latent_max_abs_diff": float((mixed["w"] - reference["w"]).abs().max()),
+        "latent_relative_l2": relative_l2(mixed["w"], reference["w"]),
+        "generator_max_relative_l2": weight_drift,
+        "metrics": {mode: run["metrics"] for mode, run in runs.items()},
+        "metric_diff": {key: None if reference["metrics"][key] is None or mixed["metrics"][key] is None
+                        else mixed["metrics"][key] - reference["metrics"][key] for key in reference["metrics"]},
+        "timings": {mode: run["timings"] for mode, run in runs.items()}
+    }
+    with open(f"{outdir}/precision_report.json", "w") as file:
+        json.dump(report, file, indent=2)
+    print(json.dumps(report, indent=2))
+    return report
+
+
+if __name__ == "__main__":
+    validate()
@@ -20,6 +20,9 @@ class RenderDepthSampleWidget:
         self.depth_importance_mult = 2
         self.render_types = [.5, 1, 2, 4]
         self.labels       = ['0.5x', '1x', '2x', '4x']
+        self.ray_chunk_budget = 0
+        self.ray_chunk_budgets_mb = [None, 256, 1024, 4096]
+        self.ray_chunk_labels     = ['Off', '256 MB', '1 GB', '4 GB']
 
     @imgui_utils.scoped_by_object_id
     def __call__(self, show=True):
@@ -33,8 +36,13 @@ class RenderDepthSampleWidget:
             imgui.same_line(viz.label_w + viz.font_size * 16 + viz.spacing * 2)
             with imgui_utils.item_width(viz.font_size * 4):
                 _clicked, self.depth_importance_mult = imgui.combo('Depth Sample Importance Multiplier', self.depth_importance_mult, self.labels)
+            imgui.text('Ray Chunks')
+            imgui.same_line(viz.label_w)
+            with imgui_utils.item_width(viz.font_size * 4):
+                _clicked, self.ray_chunk_budget = imgui.combo('Memory Budget', self.ray_chunk_budget, self.ray_chunk_labels)
 
         viz.args.depth_mult = self.render_types[self.depth_mult]
         viz.args.depth_importance_mult = self.render_types[self.depth_importance_mult]
+        viz.args.ray_chunk_memory_mb = self.ray_chunk_budgets_mb[self.ray_chunk_budget]
 
 #----------------------------------------------------------------------------
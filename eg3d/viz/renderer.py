@@ -21,12 +21,12 @@ import torch.nn
 import matplotlib.cm
 import dnnlib
 from inversion.utils import interpolate_w_by_cam
+from inversion.poses import PoseTable
 from torch_utils.ops import upfirdn2d
 import legacy # pylint: disable=import-error
 
 from camera_utils import LookAtPoseSampler
-from inversion.load_data import CamItem
-from utils.run_dir import get_pkl_and_w
+from utils.run_dir import get_pkl_and_w, load_checkpoint, RESULT_FILE
 
 
 
@@ -174,8 +174,12 @@ class Renderer:
         if data is None:
             print(f'Loading "{pkl}"... ', end='', flush=True)
             try:
-                with dnnlib.util.open_url(pkl, verbose=False) as f:
-                    data = legacy.load_network_pkl(f)
+                if pkl.endswith(RESULT_FILE):
+                    from inversion.results import load_result
+                    data = {'G_ema': load_result(pkl)[0]}
+                else:
+                    with dnnlib.util.open_url(pkl, verbose=False) as f:
+                        data = legacy.load_network_pkl(f)
                 print('Done.')
             except:
                 data = CapturedException()
@@ -284,6 +288,7 @@ class Renderer:
 
         depth_mult            = 1,
         depth_importance_mult = 1,
+        ray_chunk_memory_mb   = None,
     ):
         # Dig up network details.
         G = self.get_network(pkl, 'G_ema').eval().requires_grad_(False).to('cuda')
@@ -299,6 +304,7 @@ class Renderer:
 
         G.rendering_kwargs['depth_resolution'] = int(G.rendering_kwargs['depth_resolution_default'] * depth_mult)
         G.rendering_kwargs['depth_resolution_importance'] = int(G.rendering_kwargs['depth_resolution_importance_default'] * depth_importance_mult)
+        G.rendering_kwargs['ray_chunk_memory_mb'] = ray_chunk_memory_mb
 
         # Set input transform.
         if res.has_input_transform:
@@ -428,8 +434,8 @@ class Renderer:
 
     @staticmethod
     def interpolate_w_by_cam(ws: List[np.ndarray], cs: List[np.ndarray], c: np.ndarray):
-        angle = np.array([CamItem(c).xz_angle()])
-        cs = np.array([CamItem(cs[i]).xz_angle() for i in range(len(cs))])
+        angle = PoseTable(torch.as_tensor(c)).yaw.cpu().numpy()
+        cs = PoseTable.from_cams([torch.as_tensor(c_) for c_ in cs]).yaw.cpu().numpy()
 
         cs_diff = np.abs(cs - angle)
         closest_index, second_closest_index = np.argpartition(cs_diff, 2)[:2]
@@ -486,11 +492,11 @@ class Renderer:
         if pkl != self.last_pkl:
             self.last_pkl = pkl
             _, w_path = get_pkl_and_w(str(Path(pkl).parent))
-            self.checkpoint = np.load(w_path)
+            self.checkpoint = load_checkpoint(w_path)
             self.use_interpolate = "ws" in self.checkpoint.keys()
             if self.use_interpolate:
                 self.ws = [torch.tensor(w_).to("cuda") for w_ in self.checkpoint['ws']]
-                self.cs = [torch.tensor(c_).to("cuda") for c_ in self.checkpoint['cs']]
+                self.cs = PoseTable.from_cams([torch.tensor(c_).to("cuda") for c_ in self.checkpoint['cs']])
 
         if self.use_interpolate:
             return interpolate_w_by_cam(self.ws, self.cs, c, verbose=False).to("cuda")